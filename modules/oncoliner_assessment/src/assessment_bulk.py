@@ -7,6 +7,8 @@ from concurrent.futures import ProcessPoolExecutor
 from assessment_main import main  # noqa
 from vcf_ops.constants import DEFAULT_CONTIGS, DEFAULT_VARIANT_TYPES, DEFAULT_INDEL_THRESHOLD, DEFAULT_WINDOW_RADIUS, DEFAULT_SV_BINS  # noqa
 from vcf_ops.metrics import aggregate_metrics, combine_precision_recall_metrics  # noqa
+from vcf_ops.reference import prepare_reference  # noqa
+from vcf_ops.masks import read_bed_regions  # noqa
 
 import pandas as pd
 import logging
@@ -22,6 +24,8 @@ def read_config(config_path: str) -> pd.DataFrame:
     config['truth_vcf_paths'] = config['truth_vcf_paths'].map(lambda x: [f.strip() for f in x.split(',')])
     config['test_vcf_paths'] = config['test_vcf_paths'].map(lambda x: [f.strip() for f in x.split(',')])
     config['bed_mask_paths'] = config['bed_mask_paths'].map(lambda x: [f.strip() for f in x.split(',')]) if 'bed_mask_paths' in config else [''] * len(config)
+    config['region_bed_paths'] = config['region_bed_paths'].map(lambda x: [f.strip() for f in x.split(',')] if isinstance(x, str) else []) \
+        if 'region_bed_paths' in config else [[] for _ in range(len(config))]
     config['sample_types'] = config['sample_types'].map(lambda x: set([f.strip() for f in x.split(',')]))
     # There must be at least one recall and one precision sample
     if len(config[config['sample_types'].map(lambda x: 'recall' in x)]) == 0:
@@ -39,6 +43,7 @@ def run_evaluator_sample(output_folder: str, sample: pd.Series, indel_threshold:
     truth_vcf_paths = sample['truth_vcf_paths']
     test_vcf_paths = sample['test_vcf_paths']
     bed_mask_paths = sample['bed_mask_paths'] if 'bed_mask_paths' in sample else []
+    region_bed_paths = sample['region_bed_paths'] if 'region_bed_paths' in sample else []
     fasta_path = sample['reference_fasta_path']
     output_folder = os.path.join(output_folder, sample_name)
     os.makedirs(output_folder, exist_ok=True)
@@ -48,7 +53,7 @@ def run_evaluator_sample(output_folder: str, sample: pd.Series, indel_threshold:
         logging.info(f'Skipping {sample_name} evaluation because the metrics file already exists')
         return
     main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_path, indel_threshold,
-         window_radius, sv_size_bins, contigs, variant_types, keep_intermediates, no_gzip)
+         window_radius, sv_size_bins, contigs, variant_types, keep_intermediates, no_gzip, region_bed_paths=region_bed_paths)
 
 
 def aggregate_metrics_from_samples(output_file: str, samples_folder: str, recall_samples: Iterable[str], precision_samples: Iterable[str]):
@@ -94,6 +99,14 @@ if __name__ == '__main__':
     args.config_file = os.path.abspath(args.config_file)
 
     config = read_config(args.config_file)
+    # Prepare the packed references once, so that all the workers share them
+    for fasta_path in config['reference_fasta_path'].unique():
+        prepare_reference(fasta_path)
+    # Preprocess the BED files once, before the workers are forked, so that they share them
+    bed_paths = {bed_path for column in ['bed_mask_paths', 'region_bed_paths'] for file_patterns in config[column]
+                 for file_pattern in file_patterns for bed_path in glob.glob(file_pattern)}
+    for bed_path in sorted(bed_paths):
+        read_bed_regions(bed_path)
     pool = ProcessPoolExecutor(max_workers=args.max_processes)
     samples_output_folder = os.path.join(args.output_folder, 'samples')
     os.makedirs(samples_output_folder, exist_ok=True)
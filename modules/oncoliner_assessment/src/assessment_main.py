@@ -2,68 +2,44 @@ import os
 import sys
 import argparse
 import glob
-import pandas as pd
 
 # Add vcf-ops to the path
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '..', 'shared', 'vcf_ops', 'src'))
 
-from vcf_ops import VariantType  # noqa
-from vcf_ops.i_o import read_vcfs, write_masked_vcfs  # noqa
+from vcf_ops.i_o import read_vcfs, write_labelled_vcfs  # noqa
+from vcf_ops.schema import compact_variants, concat_variants  # noqa
 from vcf_ops.genes import combine_gene_annotations  # noqa
-from vcf_ops.masks import snv_mask, indel_mask  # noqa
-from vcf_ops.intersect import intersect  # noqa
-from vcf_ops.metrics import compute_metrics  # noqa
+from vcf_ops.masks import snv_mask, indel_mask, VariantFilter, BedMask  # noqa
+from vcf_ops.intersect import intersect, intersect_window_radii  # noqa
+from vcf_ops.metrics import compute_metrics, compute_pr_curves  # noqa
 from vcf_ops.constants import DEFAULT_CONTIGS, DEFAULT_VARIANT_TYPES, DEFAULT_INDEL_THRESHOLD, DEFAULT_WINDOW_RADIUS, DEFAULT_SV_BINS  # noqa
 from indel_sv_converter import sv_to_indel, indel_to_sv  # noqa
 
 
-def _ingest(truth_vcfs, test_vcfs, fasta_ref, indel_threshold, output_prefix, contigs, variant_types, keep_intermediates=False):
-    # Load truth and test VCFs
-    df_truth = read_vcfs(truth_vcfs)
-    df_test = read_vcfs(test_vcfs)
-
-    contigs = set(contigs)
+def _ingest(truth_vcfs, test_vcfs, fasta_ref, indel_threshold, output_prefix, contigs, variant_types, keep_intermediates=False, score_field=None, processes=1, lean=False, regions=None):
     # Skip 0-length variants, variants without contig in contigs list and variants without variant type in variant_types list
-    contigs_truth_mask = df_truth['start_chrom'].isin(contigs) & df_truth['end_chrom'].isin(contigs)
-    contigs_test_mask = df_test['start_chrom'].isin(contigs) & df_test['end_chrom'].isin(contigs)
-    length_truth_mask = (df_truth['length'] == 0) & \
-        (df_truth['type_inferred'] != VariantType.SNV.name) & (df_truth['type_inferred'] != VariantType.TRA.name) & (df_truth['type_inferred'] != VariantType.SGL.name)
-    length_test_mask = (df_test['length'] == 0) & \
-        (df_test['type_inferred'] != VariantType.SNV.name) & (df_test['type_inferred'] != VariantType.TRA.name) & (df_test['type_inferred'] != VariantType.SGL.name)
-    # Initialize masks for included variants to all false
-    variant_types_truth_mask = pd.Series([False] * len(df_truth), dtype=bool)
-    variant_types_test_mask = pd.Series([False] * len(df_test), dtype=bool)
-    for variant_type in variant_types:
-        variant_type_split = variant_type.split('-')
-        if len(variant_type_split) == 1:
-            variant_types_truth_mask |= df_truth['type_inferred'] == variant_type
-            variant_types_test_mask |= df_test['type_inferred'] == variant_type
-        elif len(variant_type_split) == 2:
-            general_variant_type, specific_variant_type = variant_type_split
-            # INV and TRA do not need to filter size
-            if specific_variant_type.upper() == 'INV' or specific_variant_type.upper() == 'TRA':
-                variant_types_truth_mask |= df_truth['type_inferred'] == specific_variant_type
-                variant_types_test_mask |= df_test['type_inferred'] == specific_variant_type
-                continue
-            if general_variant_type.upper() == 'SV':
-                temp_truth_mask = df_truth['length'] > indel_threshold
-                temp_test_mask = df_test['length'] > indel_threshold
-            elif general_variant_type.upper() == 'INDEL':
-                temp_truth_mask = df_truth['length'] <= indel_threshold
-                temp_test_mask = df_test['length'] <= indel_threshold
-            else:
-                raise ValueError(f'Invalid variant type {variant_type}')
-            variant_types_truth_mask |= temp_truth_mask & (df_truth['type_inferred'] == specific_variant_type)
-            variant_types_test_mask |= temp_test_mask & (df_test['type_inferred'] == specific_variant_type)
-        else:
-            raise ValueError(f'Invalid variant type {variant_type}')
-
-    skipped_truth_mask = length_truth_mask | ~contigs_truth_mask | ~variant_types_truth_mask
-    skipped_test_mask = length_test_mask | ~contigs_test_mask | ~variant_types_test_mask
-    df_skipped_truth = df_truth[skipped_truth_mask]
-    df_skipped_test = df_test[skipped_test_mask]
-    df_truth = df_truth[~skipped_truth_mask]
-    df_test = df_test[~skipped_test_mask]
+    # If regions, only the variants in them are read (the rest are neither assessed nor skipped)
+    variant_filter = VariantFilter(contigs, variant_types, indel_threshold)
+    if lean:
+        # Skip them while reading, only counting them
+        df_truth = read_vcfs(truth_vcfs, keep_raw_records=True, processes=processes, variant_filter=variant_filter,
+                             gene_annotations=True, regions=regions)
+        df_test = read_vcfs(test_vcfs, score_field=score_field, keep_raw_records=True, processes=processes,
+                            variant_filter=variant_filter, gene_annotations=True, regions=regions)
+        df_skipped_truth, df_skipped_test = None, None
+        skipped_truth, skipped_test = df_truth.attrs['skipped_variants'], df_test.attrs['skipped_variants']
+    else:
+        # Load truth and test VCFs, keeping the records text to write them back later and their gene annotations
+        df_truth = read_vcfs(truth_vcfs, keep_raw_records=True, processes=processes, gene_annotations=True, regions=regions)
+        df_test = read_vcfs(test_vcfs, score_field=score_field, keep_raw_records=True, processes=processes, gene_annotations=True,
+                            regions=regions)
+        selected_truth_mask = variant_filter.mask(df_truth)
+        selected_test_mask = variant_filter.mask(df_test)
+        df_skipped_truth = df_truth[~selected_truth_mask]
+        df_skipped_test = df_test[~selected_test_mask]
+        df_truth = df_truth[selected_truth_mask]
+        df_test = df_test[selected_test_mask]
+        skipped_truth, skipped_test = len(df_skipped_truth), len(df_skipped_test)
 
     # Separate indels and SNVs from SVs
     indel_snv_truth_mask = snv_mask(df_truth) | indel_mask(df_truth, indel_threshold)
@@ -86,31 +62,25 @@ def _ingest(truth_vcfs, test_vcfs, fasta_ref, indel_threshold, output_prefix, co
         df_truth_indel.to_csv(output_prefix + 'truth_indel_snv.csv', index=False)
         df_test_indel.to_csv(output_prefix + 'test_indel_snv.csv', index=False)
 
-    # Concat SVs and indels
-    df_truth = pd.concat([df_truth_indel, df_truth_sv], ignore_index=True)
-    df_test = pd.concat([df_test_indel, df_test_sv], ignore_index=True)
-
-    return df_truth, df_test, df_skipped_truth, df_skipped_test
-
-def skip_fp_variants(df, bed_masks):
-    for bed_mask in bed_masks:
-        bed_df = pd.read_csv(bed_mask, sep='\t', header=None)
-        # Set the first column as string
-        bed_df[0] = bed_df[0].astype(str)
-        # Join the chroms with the start and end
-        for _, row in bed_df.iterrows():
-            start_mask = (df['start_chrom'] == row[0]) & (df['start'] >= row[1]) & (df['start'] <= row[2])
-            end_mask = (df['end_chrom'] == row[0]) & (df['end'] >= row[1]) & (df['end'] <= row[2])
-            mask = start_mask | end_mask
-            df_skipped = df[mask]
-            df = df[~mask]
-    return df, df_skipped
-
-def main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_ref, indel_threshold, window_radius, sv_size_bins, contigs, variant_types, keep_intermediates, no_gzip):
+    # Concat SVs and indels, compacting the columns changed by the conversions
+    df_truth = compact_variants(concat_variants([df_truth_indel, df_truth_sv], ignore_index=True))
+    df_test = compact_variants(concat_variants([df_test_indel, df_test_sv], ignore_index=True))
+
+    return df_truth, df_test, df_skipped_truth, df_skipped_test, skipped_truth, skipped_test
+
+def skip_fp_variants(df, bed_mask: BedMask):
+    # Split the variants with a breakpoint in the BED regions
+    mask = bed_mask.mask(df)
+    return df[~mask], df[mask]
+
+def main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_ref, indel_threshold, window_radius, sv_size_bins, contigs, variant_types, keep_intermediates, no_gzip, processes=1, sweep_window_radii=None, score_field=None, output_index=None, lean=False, region_bed_paths=None):
     # Get files from the truth and test vcfs
     truth_vcfs = [file for file_pattern in truth_vcf_paths for file in glob.glob(file_pattern)]
     test_vcfs = [file for file_pattern in test_vcf_paths for file in glob.glob(file_pattern)]
     bed_masks = [file for file_pattern in bed_mask_paths for file in glob.glob(file_pattern)]
+    bed_mask = BedMask(bed_masks) if len(bed_masks) > 0 else None
+    region_beds = [file for file_pattern in region_bed_paths or [] for file in glob.glob(file_pattern)]
+    regions = BedMask(region_beds) if len(region_beds) > 0 else None
 
     # Sort bins
     sv_size_bins.sort()
@@ -118,8 +88,9 @@ def main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_r
         raise ValueError(f'SV size bins must be greater than {indel_threshold}')
 
     # Read the input files
-    df_truth, df_test, df_skipped_truth, df_skipped_test = _ingest(
-        truth_vcfs, test_vcfs, fasta_ref, indel_threshold, output_prefix, contigs, variant_types, keep_intermediates)
+    df_truth, df_test, df_skipped_truth, df_skipped_test, skipped_truth, skipped_test = _ingest(
+        truth_vcfs, test_vcfs, fasta_ref, indel_threshold, output_prefix, contigs, variant_types, keep_intermediates, score_field, processes,
+        lean, regions)
 
     if len(df_truth) == 0:
         raise ValueError(f'No truth VCF variants found in {truth_vcf_paths}')
@@ -127,46 +98,45 @@ def main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_r
         raise ValueError(f'No test VCF variants found in {test_vcf_paths}')
 
     # Run benchmark
-    df_tp, df_tp_dup, \
-        df_fp, df_fp_dup, \
-        df_fn, df_fn_dup = intersect(df_truth, df_test, indel_threshold, window_radius)
+    if sweep_window_radii:
+        # Intersect with all the window radii at once
+        window_radii = list(dict.fromkeys([window_radius] + sweep_window_radii))
+        radii_results = dict(zip(window_radii, intersect_window_radii(df_truth, df_test, indel_threshold, window_radii,
+                                                                      processes=processes)))
+        df_tp, df_tp_dup, \
+            df_fp, df_fp_dup, \
+            df_fn, df_fn_dup = radii_results[window_radius]
+    else:
+        df_tp, df_tp_dup, \
+            df_fp, df_fp_dup, \
+            df_fn, df_fn_dup = intersect(df_truth, df_test, indel_threshold, window_radius, processes=processes)
     df_tp['GENES'] = combine_gene_annotations(df_tp, df_truth)
 
     # Skip the FP that overlap with the bed masks
     if len(bed_masks) > 0:
-        df_fp, df_fp_skipped = skip_fp_variants(df_fp, bed_masks)
-        df_fp_dup, df_fp_dup_skipped = skip_fp_variants(df_fp_dup, bed_masks)
-        df_skipped_test = pd.concat([df_skipped_test, df_fp_skipped, df_fp_dup_skipped], ignore_index=True)
-
-    # Write VCF files
+        df_fp, df_fp_skipped = skip_fp_variants(df_fp, bed_mask)
+        df_fp_dup, df_fp_dup_skipped = skip_fp_variants(df_fp_dup, bed_mask)
+        skipped_test += len(df_fp_skipped) + len(df_fp_dup_skipped)
+        if not lean:
+            df_skipped_test = concat_variants([df_skipped_test, df_fp_skipped, df_fp_dup_skipped], ignore_index=True)
+
+    # Write VCF files (all at once, so that each input VCF is read once)
+    # Skipped variants are only counted in lean mode
     command = ' '.join(sys.argv)
-    if len(df_tp) > 0:
-        write_masked_vcfs(df_tp, f'{output_prefix}tp.', indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'True positives can be found in {output_prefix}tp.*')
-    if len(df_tp_dup) > 0:
-        write_masked_vcfs(df_tp_dup, f'{output_prefix}tp_dup.', indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'True positives (duplicates) can be found in {output_prefix}tp_dup.*')
-    if len(df_fp) > 0:
-        write_masked_vcfs(df_fp, f'{output_prefix}fp.', indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'False positives can be found in {output_prefix}fp.*')
-    if len(df_fp_dup) > 0:
-        write_masked_vcfs(df_fp_dup, f'{output_prefix}fp_dup.', indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'False positives (duplicates) can be found in {output_prefix}fp_dup.*')
-    if len(df_skipped_test) > 0:
-        write_masked_vcfs(df_skipped_test, f'{output_prefix}skipped_test.',
-                          indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'Skipped test variants can be found in {output_prefix}skipped_test.*')
-    if len(df_fn) > 0:
-        write_masked_vcfs(df_fn, f'{output_prefix}fn.', indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'False negatives can be found in {output_prefix}fn.*')
-    if len(df_fn_dup) > 0:
-        write_masked_vcfs(df_fn_dup, f'{output_prefix}fn_dup.',
-                          indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'False negatives (duplicates) can be found in {output_prefix}fn_dup.*')
-    if len(df_skipped_truth) > 0:
-        write_masked_vcfs(df_skipped_truth, f'{output_prefix}skipped_truth.',
-                          indel_threshold, fasta_ref, command, not no_gzip)
-        print(f'Skipped truth variants can be found in {output_prefix}skipped_truth.*')
+    outputs = [(df_tp, 'tp', 'True positives'),
+               (df_tp_dup, 'tp_dup', 'True positives (duplicates)'),
+               (df_fp, 'fp', 'False positives'),
+               (df_fp_dup, 'fp_dup', 'False positives (duplicates)'),
+               (df_skipped_test, 'skipped_test', 'Skipped test variants'),
+               (df_fn, 'fn', 'False negatives'),
+               (df_fn_dup, 'fn_dup', 'False negatives (duplicates)'),
+               (df_skipped_truth, 'skipped_truth', 'Skipped truth variants')]
+    outputs = [(df, label, description) for df, label, description in outputs if df is not None]
+    write_labelled_vcfs({f'{output_prefix}{label}.': df for df, label, _ in outputs if len(df) > 0},
+                        indel_threshold, fasta_ref, command, not no_gzip, threads=processes, index=output_index)
+    for df, label, description in outputs:
+        if len(df) > 0:
+            print(f'{description} can be found in {output_prefix}{label}.*')
 
     # Compute metrics
     metrics_df = compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size_bins, variant_types)
@@ -177,13 +147,34 @@ def main(truth_vcf_paths, test_vcf_paths, bed_mask_paths, output_prefix, fasta_r
     print(f'True positives: {len(df_tp)} + {len(df_tp_dup)} duplicates')
     print(f'False positives: {len(df_fp)} + {len(df_fp_dup)} duplicates')
     print(f'False negatives: {len(df_fn)} + {len(df_fn_dup)} duplicates')
-    print(f'Total truth variants analyzed: {len(df_truth)} + {len(df_skipped_truth)} skipped')
-    print(f'Total test variants analyzed: {len(df_test)} + {len(df_skipped_test)} skipped')
+    print(f'Total truth variants analyzed: {len(df_truth)} + {skipped_truth} skipped')
+    print(f'Total test variants analyzed: {len(df_test)} + {skipped_test} skipped')
     print('Benchmark metrics:')
     # Drop all columns that end with _genes
     print(metrics_df.drop([col for col in metrics_df.columns if col.endswith('_genes')], axis=1).to_string(index=False))
     print(f'Benchmark metrics can be found in {output_prefix}metrics.csv')
 
+    # Compute precision-recall curves over the score of the test variants
+    if score_field is not None:
+        pr_curves_df = compute_pr_curves(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size_bins, variant_types)
+        pr_curves_df.to_csv(f'{output_prefix}pr_curves.csv', index=False)
+        print(f'Precision-recall curves over {score_field} can be found in {output_prefix}pr_curves.csv')
+
+    # Compute metrics for each window radius of the sweep
+    for sweep_window_radius in sweep_window_radii or []:
+        if sweep_window_radius == window_radius:
+            sweep_metrics_df = metrics_df
+        else:
+            sweep_tp, _, sweep_fp, _, sweep_fn, _ = radii_results[sweep_window_radius]
+            sweep_tp['GENES'] = combine_gene_annotations(sweep_tp, df_truth)
+            if len(bed_masks) > 0:
+                sweep_fp, _ = skip_fp_variants(sweep_fp, bed_mask)
+            sweep_metrics_df = compute_metrics(sweep_tp, sweep_fp, sweep_fn, indel_threshold,
+                                               sweep_window_radius, sv_size_bins, variant_types)
+        sweep_metrics_df.to_csv(f'{output_prefix}metrics.wr{sweep_window_radius}.csv', index=False)
+        print(f'Benchmark metrics with window radius {sweep_window_radius} can be found in '
+              f'{output_prefix}metrics.wr{sweep_window_radius}.csv')
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='ONCOLINER Assessment')
@@ -199,7 +190,9 @@ if __name__ == '__main__':
     parser.add_argument(
         '--sv-size-bins', help=f'SV size bins for the output_prefix metrics (default={DEFAULT_SV_BINS})', nargs='+', default=DEFAULT_SV_BINS, type=int)
     parser.add_argument('--bed-masks', nargs='+', default=[], type=str,
-                        help='Path to the BED mask files. All False Positive (FP) variants will be skipped if they overlap with any of the regions in the BED mask files')
+                        help='Path to the BED mask files. All False Positive (FP) variants will be skipped if they overlap with any of the regions in the BED mask files. Chromosomes are matched with or without the chr prefix')
+    parser.add_argument('--regions', nargs='+', default=[], type=str,
+                        help='Path to BED files with the regions to assess (e.g. a gene panel or high-confidence regions). Only the variants with a breakpoint in them are read, querying the index of the VCF files if they have one (tabix or CSI). Chromosomes are matched with or without the chr prefix')
     parser.add_argument('--contigs', nargs='+', default=DEFAULT_CONTIGS, type=str,
                         help=f'Contigs to process (default={DEFAULT_CONTIGS})')
     parser.add_argument('--variant-types', nargs='+', default=DEFAULT_VARIANT_TYPES, type=str,
@@ -207,7 +200,19 @@ if __name__ == '__main__':
     parser.add_argument('--keep-intermediates',
                         help='Keep intermediate CSV/VCF files from input VCF files', action='store_true', default=False)
     parser.add_argument('--no-gzip', help='Do not gzip output_prefix VCF files', action='store_true', default=False)
+    parser.add_argument('-p', '--processes', help='Number of processes to use, sharding by chromosome and reading indexed VCF files by contig, and of threads to compress the output VCF files (default=1)',
+                        default=1, type=int)
+    parser.add_argument('--sweep-window-radii', nargs='+', default=None, type=int,
+                        help='Window radii to compute additional metrics with in the same run. Candidate pairs are generated once with the largest radius (per chromosome with --processes)')
+    parser.add_argument('--score-field', default=None, type=str,
+                        help='Score of the test variants to compute precision-recall curves with (QUAL, INFO/<KEY> or FORMAT/<KEY>)')
+    parser.add_argument('--output-index', default=None, choices=['tbi', 'csi'],
+                        help='Sort the output VCF files by position and index them with tabix (tbi or csi). Not compatible with --no-gzip')
+    parser.add_argument('--lean', action='store_true', default=False,
+                        help='Skip the variants out of --contigs and --variant-types while reading the VCF files. Skipped variants are only counted, not written')
     args = parser.parse_args()
+    if args.output_index and args.no_gzip:
+        parser.error('--output-index is not compatible with --no-gzip')
 
     # Convert everything to absolute paths
     args.truths = [os.path.abspath(x) for x in args.truths]
@@ -216,4 +221,5 @@ if __name__ == '__main__':
     args.output_prefix = os.path.abspath(args.output_prefix)
 
     main(args.truths, args.tests, args.bed_masks, args.output_prefix, args.fasta_ref, args.indel_threshold,
-         args.window_radius, args.sv_size_bins, args.contigs, args.variant_types, args.keep_intermediates, args.no_gzip)
+         args.window_radius, args.sv_size_bins, args.contigs, args.variant_types, args.keep_intermediates, args.no_gzip,
+         args.processes, args.sweep_window_radii, args.score_field, args.output_index, args.lean, args.regions)
@@ -1,12 +1,15 @@
+import numpy as np
 import pandas as pd
-import pysam
 
 from variant_extractor.variants import VariantType
+from vcf_ops.reference import open_reference  # noqa
+from vcf_ops.schema import concat_variants  # noqa
+from vcf_ops.constants import REFERENCE_FETCH_SIZE  # noqa
 
 
 SV_REGEX = r'[\[\]<>.]'
 
-def _get_chrom_preffix(fasta: pysam.FastaFile):
+def _get_chrom_preffix(fasta):
     # Fix chr1 vs 1
     chrom_preffix = ''
     if fasta.references[0].startswith('chr'):
@@ -14,68 +17,123 @@ def _get_chrom_preffix(fasta: pysam.FastaFile):
     return chrom_preffix
 
 
+def _fetch_bases(fasta, chrom_preffix: str, chroms: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    # Reference bases of each variant from starts to ends (0-based, truncated at the end of the contig), concatenated,
+    # and their lengths. The variants starting in the same window of REFERENCE_FETCH_SIZE bases of a chromosome are
+    # fetched at once, so that each fetch spans at most two windows plus the longest variant
+    chrom_codes, chrom_names = pd.factorize(chroms)
+    contig_lengths = np.array([fasta.get_reference_length(chrom_preffix + chrom) for chrom in chrom_names], dtype=np.int64)
+    starts = starts.astype(np.int64)
+    lengths = np.maximum(np.minimum(ends.astype(np.int64), contig_lengths[chrom_codes]) - starts, 0)
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    windows = chrom_codes * (contig_lengths.max(initial=0) // REFERENCE_FETCH_SIZE + 1) + starts // REFERENCE_FETCH_SIZE
+    bases_windows = np.repeat(windows, lengths)
+    bases_chrom_codes = np.repeat(chrom_codes, lengths)
+    bases = np.zeros(len(positions), dtype=np.uint8)
+    # Bases of each window, in order
+    order = np.argsort(bases_windows, kind='stable')
+    window_starts = np.flatnonzero(np.diff(bases_windows[order], prepend=-1) != 0)
+    for window_start, window_end in zip(window_starts.tolist(), np.append(window_starts[1:], len(order)).tolist()):
+        window_bases = order[window_start:window_end]
+        window_positions = positions[window_bases]
+        span_start = window_positions.min()
+        sequence = fasta.bases(chrom_preffix + chrom_names[bases_chrom_codes[window_bases[0]]], span_start,
+                               window_positions.max() + 1)
+        bases[window_bases] = sequence[window_positions - span_start]
+    return bases, lengths
+
+
+def _replace_variants(variants_df: pd.DataFrame, variants_mask: pd.Series, converted_df: pd.DataFrame) -> pd.DataFrame:
+    # Variants out of variants_mask followed by the converted ones
+    # Empty parts are skipped, as pandas warns that they will change the types of the result
+    return concat_variants([df for df in (variants_df[~variants_mask], converted_df) if len(df) > 0] or [converted_df],
+                           ignore_index=True)
+
+
+def _check_chroms(variants_df: pd.DataFrame, fasta, chrom_preffix: str):
+    # Check all chromosomes are in the reference
+    for chrom in variants_df['start_chrom'].unique():
+        if chrom_preffix + chrom not in fasta.references:
+            raise ValueError(f'Chromosome {chrom} not in FASTA references {fasta.references}')
+
+
 def indel_to_sv(variants_df: pd.DataFrame, fasta_ref: str) -> pd.DataFrame:
     if len(variants_df) == 0:
         return variants_df
 
-    fasta = pysam.FastaFile(fasta_ref)
+    fasta = open_reference(fasta_ref)
 
     # Fix chr1 vs 1
     chrom_preffix = _get_chrom_preffix(fasta)
 
-    # Check all chromosomes are in the reference
-    for chrom in variants_df['start_chrom'].unique():
-        if chrom_preffix + chrom not in fasta.references:
-            raise ValueError(f'Chromosome {chrom} not in FASTA references {fasta.references}')
-
-    def convert_row(row):
-        # Only convert INS
-        # Ignore INS with <INS> in the ALF field
-        # Check if the INS is actually a DUP
-        # Search if the ALT sequence is repeated in the reference
-        if row['alt'] == fasta.fetch(chrom_preffix + row['start_chrom'], row['start'] - 1, row['start'] + row['length']):
-            row['type_inferred'] = VariantType.DUP.name
-            # Change to bracket notation offsetting 1 from start
-            row['start'] += 1
-            row['length'] -= 1
-            row['end'] = row['start'] + row['length']
-            row['ref'] = row['alt'][1]
-            row['alt'] = f']{chrom_preffix+row["start_chrom"]}:{row["end"]}]{row["ref"]}'
-            row['brackets'] = ']N'
-        return row
+    _check_chroms(variants_df, fasta, chrom_preffix)
 
+    # Only convert INS
+    # Ignore INS with <INS> in the ALF field
     variants_mask = (variants_df['type_inferred'] == VariantType.INS.name) & \
         (variants_df['alt'] != '<INS>')
-    return pd.concat([variants_df[~variants_mask], variants_df.loc[variants_mask, :].apply(convert_row, axis=1)], ignore_index=True)
+    ins_df = variants_df.loc[variants_mask, :].copy()
+    # Check if the INS is actually a DUP
+    # Search if the ALT sequence is repeated in the reference
+    alts = ins_df['alt'].astype(str).to_numpy(dtype=object)
+    starts = ins_df['start'].to_numpy().astype(np.int64)
+    lengths = ins_df['length'].to_numpy().astype(np.int64)
+    chroms = ins_df['start_chrom'].astype(str).to_numpy(dtype=object)
+    ref_bases, ref_lengths = _fetch_bases(fasta, chrom_preffix, chroms, starts - 1, starts + lengths)
+    # Only ALT sequences as long as their reference sequence can be equal to it
+    candidates_mask = np.array([len(alt) for alt in alts], dtype=np.int64) == ref_lengths
+    candidates = np.flatnonzero(candidates_mask)
+    alt_bases = np.frombuffer(''.join(alts[candidates]).encode('latin-1'), dtype=np.uint8)
+    ref_bases = ref_bases[np.repeat(candidates_mask, ref_lengths)]
+    mismatches = np.bincount(np.repeat(np.arange(len(candidates)), ref_lengths[candidates]),
+                             weights=alt_bases != ref_bases, minlength=len(candidates))
+    is_dup = np.zeros(len(ins_df), dtype=bool)
+    is_dup[candidates[mismatches == 0]] = True
+
+    # Change DUPs to bracket notation offsetting 1 from start
+    starts = starts + is_dup
+    lengths = lengths - is_dup
+    ends = np.where(is_dup, starts + lengths, ins_df['end'].to_numpy().astype(np.int64))
+    dup_refs = np.array([alt[1] if dup else None for alt, dup in zip(alts, is_dup)], dtype=object)
+    dup_alts = np.array([f']{chrom_preffix + chrom}:{end}]{ref}' if dup else None
+                         for chrom, end, ref, dup in zip(chroms, ends.tolist(), dup_refs, is_dup)], dtype=object)
+    ins_df['type_inferred'] = np.where(is_dup, VariantType.DUP.name, ins_df['type_inferred'].astype(str).to_numpy(dtype=object))
+    ins_df['start'] = starts
+    ins_df['length'] = lengths
+    ins_df['end'] = ends
+    ins_df['ref'] = np.where(is_dup, dup_refs, ins_df['ref'].astype(str).to_numpy(dtype=object))
+    ins_df['alt'] = np.where(is_dup, dup_alts, alts)
+    ins_df['brackets'] = np.where(is_dup, ']N', ins_df['brackets'].astype(str).to_numpy(dtype=object))
+    return _replace_variants(variants_df, variants_mask, ins_df)
 
 
 def sv_to_indel(variants_df: pd.DataFrame, fasta_ref: str) -> pd.DataFrame:
     if len(variants_df) == 0:
         return
 
-    fasta = pysam.FastaFile(fasta_ref)
+    fasta = open_reference(fasta_ref)
 
     # Fix chr1 vs 1
     chrom_preffix = _get_chrom_preffix(fasta)
 
-    # Check all chromosomes are in the reference
-    for chrom in variants_df['start_chrom'].unique():
-        if chrom_preffix + chrom not in fasta.references:
-            raise ValueError(f'Chromosome {chrom} not in FASTA references {fasta.references}')
-
-    def convert_row(row):
-        if row['type_inferred'] == VariantType.DUP.name:
-            row['start'] -= 1
-            row['length'] += 1
-            new_alt = fasta.fetch(chrom_preffix + row['start_chrom'], row['start'] - 1, row['start'] + row['length']).upper()
-            row['end'] = row['start']
-            row['alt'] = new_alt
-            row['ref'] = new_alt[0]
-        else:
-            raise ValueError('Unknown variant type: ' + row['type_inferred'])
-        return row
+    _check_chroms(variants_df, fasta, chrom_preffix)
 
     variants_mask = (variants_df['type_inferred'] == VariantType.DUP.name) & \
         (variants_df['alt'].str.contains(SV_REGEX))
+    dup_df = variants_df.loc[variants_mask, :].copy()
+    # Offset 1 from start and replace the ALT with the duplicated reference sequence
+    starts = dup_df['start'].to_numpy().astype(np.int64) - 1
+    lengths = dup_df['length'].to_numpy().astype(np.int64) + 1
+    ref_bases, ref_lengths = _fetch_bases(fasta, chrom_preffix, dup_df['start_chrom'].astype(str).to_numpy(dtype=object),
+                                          starts - 1, starts + lengths)
+    sequences = ref_bases.tobytes().decode('latin-1').upper()
+    alt_ends = np.cumsum(ref_lengths).tolist()
+    new_alts = np.array([sequences[alt_end - alt_length:alt_end] for alt_end, alt_length in zip(alt_ends, ref_lengths.tolist())],
+                        dtype=object)
+    dup_df['start'] = starts
+    dup_df['length'] = lengths
+    dup_df['end'] = starts
+    dup_df['alt'] = new_alts
+    dup_df['ref'] = np.array([new_alt[0] for new_alt in new_alts], dtype=object)
     # Return the updated dataframe
-    return pd.concat([variants_df[~variants_mask], variants_df.loc[variants_mask, :].apply(convert_row, axis=1)], ignore_index=True)
+    return _replace_variants(variants_df, variants_mask, dup_df)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Add the assessment module and vcf-ops to the path
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '..', 'shared', 'vcf_ops', 'src'))
@@ -0,0 +1,106 @@
+import random
+import pandas as pd
+import pysam
+import pytest
+
+from variant_extractor.variants import VariantType
+from vcf_ops.i_o import read_vcfs  # noqa
+from vcf_ops.reference import prepare_reference  # noqa
+import indel_sv_converter  # noqa
+
+_COLUMNS = ['start_chrom', 'start', 'end_chrom', 'end', 'ref', 'alt', 'length', 'brackets', 'type_inferred']
+
+
+def _baseline_indel_to_sv(variants_df, fasta_ref):
+    # Row by row conversion of the INS that are DUPs, as indel_to_sv did before fetching the bases of all the variants at once
+    fasta = pysam.FastaFile(fasta_ref)
+    chrom_preffix = 'chr' if fasta.references[0].startswith('chr') else ''
+
+    def convert_row(row):
+        if row['alt'] == fasta.fetch(chrom_preffix + row['start_chrom'], row['start'] - 1, row['start'] + row['length']):
+            row['type_inferred'] = VariantType.DUP.name
+            row['start'] += 1
+            row['length'] -= 1
+            row['end'] = row['start'] + row['length']
+            row['ref'] = row['alt'][1]
+            row['alt'] = f']{chrom_preffix+row["start_chrom"]}:{row["end"]}]{row["ref"]}'
+            row['brackets'] = ']N'
+        return row
+
+    variants_mask = (variants_df['type_inferred'] == VariantType.INS.name) & (variants_df['alt'] != '<INS>')
+    return pd.concat([variants_df[~variants_mask], variants_df.loc[variants_mask, :].apply(convert_row, axis=1)],
+                     ignore_index=True)
+
+
+def _baseline_sv_to_indel(variants_df, fasta_ref):
+    # Row by row conversion of the DUPs, as sv_to_indel did before fetching the bases of all the variants at once
+    fasta = pysam.FastaFile(fasta_ref)
+    chrom_preffix = 'chr' if fasta.references[0].startswith('chr') else ''
+
+    def convert_row(row):
+        row['start'] -= 1
+        row['length'] += 1
+        new_alt = fasta.fetch(chrom_preffix + row['start_chrom'], row['start'] - 1, row['start'] + row['length']).upper()
+        row['end'] = row['start']
+        row['alt'] = new_alt
+        row['ref'] = new_alt[0]
+        return row
+
+    variants_mask = (variants_df['type_inferred'] == VariantType.DUP.name) & \
+        (variants_df['alt'].str.contains(indel_sv_converter.SV_REGEX))
+    return pd.concat([variants_df[~variants_mask], variants_df.loc[variants_mask, :].apply(convert_row, axis=1)],
+                     ignore_index=True)
+
+
+def _values(variants_df):
+    return variants_df[_COLUMNS].astype(str).values.tolist()
+
+
+@pytest.fixture(params=['', 'chr'])
+def fasta_ref(tmp_path, request):
+    # Lowercase bases too, as in soft-masked references
+    rng = random.Random(1)
+    sequences = {'1': ''.join(rng.choice('ACGTacgt') for _ in range(300)), '2': ''.join(rng.choice('ACGT') for _ in range(100))}
+    fasta_path = str(tmp_path / 'ref.fa')
+    with open(fasta_path, 'w') as f:
+        for contig, sequence in sequences.items():
+            f.write(f'>{request.param}{contig}\n')
+            f.write('\n'.join(sequence[i:i + 60] for i in range(0, len(sequence), 60)) + '\n')
+    pysam.faidx(fasta_path)
+    return fasta_path, sequences
+
+
+@pytest.mark.parametrize('packed', [False, True])
+@pytest.mark.parametrize('fetch_size', [16, 16 * 1024 * 1024])
+def test_conversions_match_the_row_by_row_conversions(tmp_path, monkeypatch, fasta_ref, packed, fetch_size):
+    fasta_path, sequences = fasta_ref
+    if packed:
+        assert prepare_reference(fasta_path)
+    # Windows of a few bases, so that the variants are fetched in several spans
+    monkeypatch.setattr(indel_sv_converter, 'REFERENCE_FETCH_SIZE', fetch_size)
+    seq1, seq2 = sequences['1'], sequences['2']
+    records = [
+        # INS that duplicate the following bases (DUPs), with the case of the reference
+        ('1', 10, 'dup_ins1', seq1[9], seq1[9:20]),
+        ('1', 150, 'dup_ins2', seq1[149], seq1[149:152]),
+        ('2', 40, 'dup_ins3', seq2[39], seq2[39:70]),
+        # INS that do not, or are truncated at the end of the contig
+        ('1', 60, 'ins1', seq1[59], seq1[59] + 'ACGTACGT'),
+        ('2', 98, 'ins2', seq2[97], seq2[97:] + 'AAAA'),
+        ('1', 200, 'sv_ins1', seq1[199], '<INS>'),
+        ('1', 250, 'snv1', seq1[249], 'A' if seq1[249] != 'A' else 'C'),
+    ]
+    vcf_path = tmp_path / 'input.vcf'
+    with open(vcf_path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n##contig=<ID=1,length=300>\n##contig=<ID=2,length=100>\n')
+        f.write('##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length">\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos, id_, ref, alt in records:
+            f.write(f'{chrom}\t{pos}\t{id_}\t{ref}\t{alt}\t.\tPASS\t{"SVLEN=10" if alt == "<INS>" else "."}\n')
+    variants_df = read_vcfs([str(vcf_path)])
+    expected_sv_df = _baseline_indel_to_sv(variants_df, fasta_path)
+    sv_df = indel_sv_converter.indel_to_sv(variants_df, fasta_path)
+    assert _values(sv_df) == _values(expected_sv_df)
+    assert (sv_df['type_inferred'] == VariantType.DUP.name).sum() == 3
+    # And back to indels
+    assert _values(indel_sv_converter.sv_to_indel(sv_df, fasta_path)) == _values(_baseline_sv_to_indel(sv_df, fasta_path))
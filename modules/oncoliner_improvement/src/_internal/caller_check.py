@@ -1,16 +1,18 @@
 import os
 import glob
 import logging
+import functools
 import pandas as pd
 
 from vcf_ops.i_o import read_vcfs, write_masked_vcfs  # noqa
-from vcf_ops.intersect import intersect  # noqa
+from vcf_ops.intersect import intersect, IntersectIndex  # noqa
 from vcf_ops.genes import combine_gene_annotations  # noqa
 from vcf_ops.union import union  # noqa
-from vcf_ops.metrics import compute_metrics, aggregate_metrics  # noqa
+from vcf_ops.metrics import compute_metrics, aggregate_metrics, variants_in_bins  # noqa
 from .common import build_result_dataframe, INTERSECTION_SYMBOL, UNION_SYMBOL  # noqa
 
 MIN_RECALL = 0.05
+USER_VARIANTS_CACHE_SIZE = 16
 
 
 def _caller_metrics_mask(caller_samples_folder, recall_samples, precision_samples):
@@ -25,49 +27,50 @@ def _caller_metrics_mask(caller_samples_folder, recall_samples, precision_sample
 
 
 def _caller_masked_variants(df, masked_metrics):
-    final_mask = pd.Series(False, index=df.index)
-    for _, row in masked_metrics.iterrows():
-        variant_type = row['variant_type']
-        if variant_type == 'INDEL' or variant_type == 'SV':
-            continue
-        else:
-            if '/' in variant_type:
-                variant_type_1, variant_type_2 = variant_type.split('/')
-                current_mask = (df['type_inferred'] == variant_type_1) | (df['type_inferred'] == variant_type_2)
-            else:
-                current_mask = df['type_inferred'] == variant_type
-            if '>' in row['variant_size']:
-                variant_size = int(row['variant_size'].replace('>', '').strip())
-                current_mask &= df['length'] > variant_size
-            elif '-' in row['variant_size']:
-                variant_size_1, variant_size_2 = row['variant_size'].split('-')
-                variant_size_1 = int(variant_size_1.strip())
-                variant_size_2 = int(variant_size_2.strip())
-                current_mask &= (df['length'] >= variant_size_1) & (df['length'] <= variant_size_2)
-            final_mask |= current_mask
-    return final_mask
+    return variants_in_bins(df, masked_metrics['variant_type'], masked_metrics['variant_size'])
+
+
+def _user_variants_files(user_sample_folder, variants_name):
+    # Files of the user variants with their modification time and size, so that files changed on disk are read again
+    vcf_files = glob.glob(os.path.join(user_sample_folder, f'*{variants_name}.*'))
+    return tuple((vcf_file, os.stat(vcf_file).st_mtime_ns, os.stat(vcf_file).st_size) for vcf_file in vcf_files)
+
+
+@functools.lru_cache(maxsize=USER_VARIANTS_CACHE_SIZE)
+def _read_indexed_user_variants(user_variants_files, indel_threshold, combine_genes):
+    # Their records text is kept too, as they are written back for every caller
+    df_user = read_vcfs([vcf_file for vcf_file, _, _ in user_variants_files], keep_raw_records=True,
+                        gene_annotations=combine_genes)
+    if combine_genes:
+        df_user['GENES'] = combine_gene_annotations(df_user)
+    return df_user, IntersectIndex(df_user, indel_threshold)
+
+
+def _read_user_variants(user_sample_folder, variants_name, indel_threshold, combine_genes=False):
+    # The user variants are the same for every caller, so they are read and indexed once per process
+    # Each caller gets its own copy of the variants, as the cached ones are shared (the index is only read by intersect)
+    df_user, user_index = _read_indexed_user_variants(_user_variants_files(user_sample_folder, variants_name), indel_threshold,
+                                                      combine_genes)
+    return df_user.copy(), user_index
 
 
 def _execute_intersection(user_sample_folder, caller_sample_folder, indel_threshold, window_radius, sv_size_bins, variant_types):
     # Read TP files
-    tp_user_path = glob.glob(os.path.join(user_sample_folder, '*tp.*'))
-    tp_df_user = read_vcfs(tp_user_path)
-    tp_df_user['GENES'] = combine_gene_annotations(tp_df_user)
+    tp_df_user, tp_user_index = _read_user_variants(user_sample_folder, 'tp', indel_threshold, combine_genes=True)
     tp_caller_path = glob.glob(os.path.join(caller_sample_folder, '*tp.*'))
-    tp_df_caller = read_vcfs(tp_caller_path)
+    tp_df_caller = read_vcfs(tp_caller_path, gene_annotations=True)
     # Intersect TP files
     tp_df_tp, _, _, _, tp_df_fn, _ = \
-        intersect(tp_df_caller, tp_df_user, indel_threshold, window_radius)
+        intersect(tp_df_caller, tp_user_index, indel_threshold, window_radius)
     tp_df_tp['GENES'] = combine_gene_annotations(tp_df_tp, tp_df_caller)
 
     # Read FP files
-    fp_user_path = glob.glob(os.path.join(user_sample_folder, '*fp.*'))
-    fp_df_user = read_vcfs(fp_user_path)
+    fp_df_user, fp_user_index = _read_user_variants(user_sample_folder, 'fp', indel_threshold)
     fp_caller_path = glob.glob(os.path.join(caller_sample_folder, '*fp.*'))
     fp_df_caller = read_vcfs(fp_caller_path)
     # Intersect FP files
     fp_df_tp, _, _, _, _, _ = \
-        intersect(fp_df_caller, fp_df_user, indel_threshold, window_radius)
+        intersect(fp_df_caller, fp_user_index, indel_threshold, window_radius)
 
     # Read FN files
     fn_user_path = glob.glob(os.path.join(user_sample_folder, '*fn.*'))
@@ -103,20 +106,18 @@ def _execute_intersection(user_sample_folder, caller_sample_folder, indel_thresh
 
 def _execute_union(user_sample_folder, caller_sample_folder, indel_threshold, window_radius, sv_size_bins, variant_types):
     # Read TP files
-    tp_user_path = glob.glob(os.path.join(user_sample_folder, '*tp.*'))
-    tp_df_user = read_vcfs(tp_user_path)
+    _, tp_user_index = _read_user_variants(user_sample_folder, 'tp', indel_threshold)
     tp_caller_path = glob.glob(os.path.join(caller_sample_folder, '*tp.*'))
     tp_df_caller = read_vcfs(tp_caller_path)
     # Union TP files
-    tp_df_tp, _ = union(tp_df_caller, tp_df_user, indel_threshold, window_radius)
+    tp_df_tp, _ = union(tp_df_caller, tp_user_index, indel_threshold, window_radius)
 
     # Read FP files
-    fp_user_path = glob.glob(os.path.join(user_sample_folder, '*fp.*'))
-    fp_df_user = read_vcfs(fp_user_path)
+    _, fp_user_index = _read_user_variants(user_sample_folder, 'fp', indel_threshold)
     fp_caller_path = glob.glob(os.path.join(caller_sample_folder, '*fp.*'))
     fp_df_caller = read_vcfs(fp_caller_path)
     # Union FP files
-    fp_df_tp, _ = union(fp_df_caller, fp_df_user, indel_threshold, window_radius)
+    fp_df_tp, _ = union(fp_df_caller, fp_user_index, indel_threshold, window_radius)
 
     # Read FN files
     fn_user_path = glob.glob(os.path.join(user_sample_folder, '*fn.*'))
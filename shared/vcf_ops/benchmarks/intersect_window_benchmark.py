@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+# Add vcf-ops to the path
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'src'))
+
+from vcf_ops._internal.internal_ops import intersect_window  # noqa
+from vcf_ops.constants import DEFAULT_WINDOW_RADIUS  # noqa
+
+
+def random_insertions(rng, size, chroms, max_position):
+    # Insertions at random positions and with random lengths, as window matched by intersect (see _INS_WINDOW_FIELDS)
+    return pd.DataFrame({'start_chrom': pd.Categorical(rng.choice(chroms, size)),
+                         'start': rng.integers(1, max_position, size, dtype=np.int64),
+                         'length': rng.integers(101, 1000, size, dtype=np.int64)})
+
+
+def benchmark(size, window_radius, chroms, density, repeats, seed):
+    rng = np.random.default_rng(seed)
+    # Same number of variants per base for every size, so that the windows are equally dense
+    max_position = max(int(size / len(chroms) / density), 2)
+    df_truth = random_insertions(rng, size, chroms, max_position)
+    df_test = random_insertions(rng, size, chroms, max_position)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        df_tp, _, _, _, _, _ = intersect_window(df_truth, df_test, ['start_chrom'], ['start', 'length'], window_radius)
+        times.append(time.perf_counter() - start_time)
+    return min(times), len(df_tp)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of intersect_window with random insertions')
+    parser.add_argument('-s', '--sizes', nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7], type=int,
+                        help='Number of truth and test variants of each run (default=10^4 to 10^7)')
+    parser.add_argument('-wr', '--window-radius', default=DEFAULT_WINDOW_RADIUS, type=int,
+                        help=f'Window radius (default={DEFAULT_WINDOW_RADIUS})')
+    parser.add_argument('--chroms', nargs='+', default=[str(x) for x in range(1, 23)], type=str,
+                        help='Chromosomes of the variants (default=1 to 22)')
+    parser.add_argument('--density', default=1e-4, type=float, help='Variants per base of each chromosome (default=1e-4)')
+    parser.add_argument('-r', '--repeats', default=1, type=int, help='Runs of each size, the fastest one is reported (default=1)')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed (default=0)')
+    args = parser.parse_args()
+
+    print('size\tseconds\ttp')
+    for size in args.sizes:
+        seconds, tp = benchmark(size, args.window_radius, args.chroms, args.density, args.repeats, args.seed)
+        print(f'{size}\t{seconds:.3f}\t{tp}')
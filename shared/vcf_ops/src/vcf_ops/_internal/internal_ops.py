@@ -4,181 +4,295 @@
 import pandas as pd
 import numpy as np
 
+from ..constants import DEFAULT_MAX_WINDOW_PAIRS
+from ..schema import concat_variants
+
 
 def intersect_exact(df_truth, df_test, matching_fields):
+    # Encode matching fields as integer keys
+    truth_keys, test_keys = _matching_keys(df_truth, df_test, matching_fields)
+    # Sort all keys at once so that entries with the same key are contiguous, truth entries first
+    keys = np.concatenate([truth_keys, test_keys])
+    keys_order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[keys_order]
+    sorted_group_ids = np.cumsum(np.concatenate([[False], sorted_keys[1:] != sorted_keys[:-1]])) if len(keys) > 0 \
+        else np.empty(0, dtype=np.int64)
+    sorted_truth_mask = keys_order < len(df_truth)
+    group_sizes = np.bincount(sorted_group_ids)
+    group_truth_counts = np.bincount(sorted_group_ids[sorted_truth_mask], minlength=len(group_sizes))
+    group_test_counts = group_sizes - group_truth_counts
+    group_starts = np.cumsum(group_sizes) - group_sizes
     # Find exact matches
-    df_all_tp = pd.merge(df_test[matching_fields].reset_index(), df_truth[matching_fields].reset_index(), how='inner', on=matching_fields,
-                         copy=False, suffixes=(None, '_truth')).set_index('index')
-    # Drop columns from truth
-    df_all_tp.drop([col for col in df_all_tp.columns if col.endswith('_truth') and not col == 'index_truth'], axis=1, inplace=True)
-    df_all_tp.rename(columns={'index_truth': 'idx_truth'}, inplace=True)
-    # Find duplicates
-    df_test_tp_mask = df_test.index.isin(df_all_tp.index)
-    df_tp = df_test[df_test_tp_mask]
-    df_tp_dup_mask = df_tp.duplicated(subset=matching_fields, keep='first')
-    df_tp_dup = df_tp[df_tp_dup_mask]
-    df_tp = df_tp[~df_tp_dup_mask]
+    sorted_tp_mask = np.where(sorted_truth_mask, group_test_counts[sorted_group_ids] > 0,
+                              group_truth_counts[sorted_group_ids] > 0)
+    # Find duplicates, that is, entries that are not the first of their dataframe with the same key
+    sorted_ranks = np.arange(len(keys)) - group_starts[sorted_group_ids]
+    sorted_dup_mask = np.where(sorted_truth_mask, sorted_ranks > 0, sorted_ranks > group_truth_counts[sorted_group_ids])
+    tp_mask = np.empty(len(keys), dtype=bool)
+    tp_mask[keys_order] = sorted_tp_mask
+    dup_mask = np.empty(len(keys), dtype=bool)
+    dup_mask[keys_order] = sorted_dup_mask
+    group_ids = np.empty(len(keys), dtype=np.int64)
+    group_ids[keys_order] = sorted_group_ids
+    df_truth_tp_mask, df_test_tp_mask = tp_mask[:len(df_truth)], tp_mask[len(df_truth):]
+    df_truth_dup_mask, df_test_dup_mask = dup_mask[:len(df_truth)], dup_mask[len(df_truth):]
+    df_tp = df_test[df_test_tp_mask & ~df_test_dup_mask]
+    df_tp_dup = df_test[df_test_tp_mask & df_test_dup_mask]
     # Add idx_truth to df_tp
-    # Handle duplicate indices in df_all_tp by taking the first occurrence
-    df_tp.loc[df_tp.index, 'idx_truth'] = df_all_tp.loc[df_tp.index, 'idx_truth'].groupby(level=0).first()
+    # Handle multiple truth entries with the same key by taking the first occurrence
+    tp_group_ids = group_ids[len(df_truth):][df_test_tp_mask & ~df_test_dup_mask]
+    df_tp = df_tp.assign(idx_truth=df_truth.index[keys_order[group_starts[tp_group_ids]]])
     # Find false positives
-    df_fp = df_test[~df_test_tp_mask]
-    # Find duplicates
-    df_fp_dup_mask = df_fp.duplicated(subset=matching_fields, keep='first')
-    df_fp_dup = df_fp[df_fp_dup_mask]
-    df_fp = df_fp[~df_fp_dup_mask]
+    df_fp = df_test[~df_test_tp_mask & ~df_test_dup_mask]
+    df_fp_dup = df_test[~df_test_tp_mask & df_test_dup_mask]
     # Find false negatives
-    # Find duplicates
-    df_all_fn = df_truth[~df_truth.index.isin(df_all_tp['idx_truth'])]
-    df_fn_dup_mask = df_all_fn.duplicated(subset=matching_fields, keep='first')
-    df_fn_dup = df_all_fn[df_fn_dup_mask]
-    df_fn = df_all_fn[~df_fn_dup_mask]
+    df_fn = df_truth[~df_truth_tp_mask & ~df_truth_dup_mask]
+    df_fn_dup = df_truth[~df_truth_tp_mask & df_truth_dup_mask]
     return df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup
 
 
-def _prefilter_windows(df_truth, df_test, window_fields, window_radius):
-    prefiltering_truth_mask = pd.Series(False, index=df_truth.index)
-    prefiltering_test_mask = pd.Series(False, index=df_test.index)
-    if len(df_truth) == 0 or len(df_test) == 0:
-        # If either dataframe is empty, return empty masks
-        return prefiltering_truth_mask, prefiltering_test_mask
-    for window_field in window_fields:
-        # Sort each dataframe by the window field
-        df_sorted_truth = df_truth.sort_values(by=window_field)
-        df_sorted_test = df_test.sort_values(by=window_field)
-        test_index = 0
-        for truth_index in range(len(df_sorted_truth)):
-            test_value = df_sorted_test.iloc[test_index][window_field]
-            truth_value = df_sorted_truth.iloc[truth_index][window_field]
-            while truth_value > window_radius + test_value:
-                # Move to the next test entry
-                test_index += 1
-                if test_index < len(df_sorted_test):
-                    test_value = df_sorted_test.iloc[test_index][window_field]
-                else:
-                    break
-            if test_index >= len(df_sorted_test):
-                # No more test entries to compare with
-                break
-            exploring_test_index_offset = 0
-            while np.abs(np.subtract(truth_value, test_value)) <= window_radius:
-                # The truth entry is within the window of the test entry
-                prefiltering_truth_mask[df_sorted_truth.index[truth_index]] = True
-                prefiltering_test_mask[df_sorted_test.index[test_index + exploring_test_index_offset]] = True
-                exploring_test_index_offset += 1
-                if test_index + exploring_test_index_offset < len(df_sorted_test):
-                    test_value = df_sorted_test.iloc[test_index + exploring_test_index_offset][window_field]
-                else:
-                    break
-    return prefiltering_truth_mask, prefiltering_test_mask
-
-
-def _entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius):
-    # Prefilter the dataframes to only include variants that are within windows
-    # This is not estrictly necessary, but it can significantly reduce memory usage
-    # Note that these variants may not even be in the same chromosome, so the next steps
-    # are still necessary to filter them out
-    prefiltering_truth_mask, prefiltering_test_mask = _prefilter_windows(df_truth, df_test, window_fields, window_radius)
-    df_truth = df_truth[prefiltering_truth_mask]
-    df_test = df_test[prefiltering_test_mask]
-    # Necessary columns
-    necessary_cols = matching_fields + window_fields
-    # Drop unnecessary columns
-    curr_df_test = df_test[necessary_cols]
-    curr_df_truth = df_truth[necessary_cols]
-    # Merge on matching fields
-    cross_merge = pd.merge(curr_df_truth.reset_index(), curr_df_test.reset_index(), suffixes=('_truth', '_test'),
-                           how='inner', on=matching_fields, copy=False)
-    # Drop entries that are not in the window
-    for window_field in window_fields:
-        window_field_test = window_field + '_test'
-        window_field_truth = window_field + '_truth'
-        diff = (cross_merge[window_field_truth].astype(int) - cross_merge[window_field_test].astype(int)).abs()
-        cross_merge = cross_merge[diff <= window_radius]
-    return cross_merge.drop(matching_fields, axis=1)
-
-
-def _matching_window_entries(df_truth, df_test, matching_fields, window_fields, window_radius):
+def _matching_keys(df_truth, df_test, matching_fields):
+    # Encode the matching fields (e.g. chromosome, position and allele) of both dataframes as shared 64-bit integer keys
+    keys = np.zeros(len(df_truth) + len(df_test), dtype=np.int64)
+    for matching_field in matching_fields:
+        truth_values = df_truth[matching_field]
+        test_values = df_test[matching_field]
+        if pd.api.types.is_integer_dtype(truth_values) and pd.api.types.is_integer_dtype(test_values):
+            # Integer fields (e.g. positions) are packed directly
+            values = np.concatenate([truth_values.to_numpy(dtype=np.int64), test_values.to_numpy(dtype=np.int64)])
+            codes = values - values.min(initial=0)
+            codes_count = codes.max(initial=0) + 1
+        elif isinstance(truth_values.dtype, pd.CategoricalDtype) and isinstance(test_values.dtype, pd.CategoricalDtype):
+            # Categorical fields are encoded by their categories, without comparing their values
+            uniques = truth_values.cat.categories.union(test_values.cat.categories)
+            # Missing values (code -1) are encoded as an additional code
+            truth_codes = np.append(uniques.get_indexer(truth_values.cat.categories), len(uniques))[truth_values.cat.codes]
+            test_codes = np.append(uniques.get_indexer(test_values.cat.categories), len(uniques))[test_values.cat.codes]
+            codes = np.concatenate([truth_codes, test_codes])
+            codes_count = len(uniques) + 1
+        else:
+            # The rest of fields (e.g. chromosomes and alleles) are interned
+            values = pd.concat([truth_values.astype(object), test_values.astype(object)], ignore_index=True)
+            codes, uniques = pd.factorize(values)
+            # Missing values are encoded as an additional code
+            codes[codes < 0] = len(uniques)
+            codes_count = len(uniques) + 1
+        if keys.max(initial=0) >= np.iinfo(np.int64).max // codes_count:
+            # Re-encode the keys densely to avoid overflows
+            keys, _ = pd.factorize(keys)
+        keys = keys * codes_count + codes
+    return keys[:len(df_truth)], keys[len(df_truth):]
+
+
+def window_index(df, matching_fields, window_fields):
+    # Group the entries by their matching fields (e.g. chromosome) and sort each group by the first window field
+    # The index only depends on df, so it can be built once and reused in multiple intersections
+    window_values = [df[w].to_numpy(dtype=np.int64) for w in window_fields]
+    key_groups = {}
+    if len(df) == 0:
+        return window_values, key_groups
+    for key, positions in df.groupby(matching_fields, sort=False, dropna=False, observed=True).indices.items():
+        key = key if isinstance(key, tuple) else (key,)
+        # Missing values match each other
+        key = tuple(None if pd.isna(k) else k for k in key)
+        positions_order = np.argsort(window_values[0][positions], kind='stable')
+        sorted_positions = positions[positions_order]
+        key_groups[key] = (positions, sorted_positions, window_values[0][sorted_positions])
+    return window_values, key_groups
+
+
+def _window_pairs(values, sorted_other_values, other_order, window_radius, max_window_pairs):
+    # Find the window of each entry in the sorted entries of the other dataframe
+    window_starts = np.searchsorted(sorted_other_values, values - window_radius, side='left')
+    window_ends = np.searchsorted(sorted_other_values, values + window_radius, side='right')
+    pair_counts = window_ends - window_starts
+    pair_counts_cumsum = np.cumsum(pair_counts)
+    # Only generate the pairs of as many entries as fit in max_window_pairs at once
+    chunk_start = 0
+    while chunk_start < len(values):
+        pairs_before_chunk = pair_counts_cumsum[chunk_start - 1] if chunk_start > 0 else 0
+        chunk_end = np.searchsorted(pair_counts_cumsum, pairs_before_chunk + max_window_pairs, side='right')
+        # A single entry is never split, even if its window exceeds max_window_pairs
+        chunk_end = max(chunk_end, chunk_start + 1)
+        chunk_pair_counts = pair_counts[chunk_start:chunk_end]
+        idxs = np.repeat(np.arange(chunk_start, chunk_end), chunk_pair_counts)
+        offsets = np.arange(len(idxs)) - np.repeat(np.cumsum(chunk_pair_counts) - chunk_pair_counts, chunk_pair_counts)
+        other_idxs = other_order[np.repeat(window_starts[chunk_start:chunk_end], chunk_pair_counts) + offsets]
+        yield idxs, other_idxs
+        chunk_start = chunk_end
+
+
+def _entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS,
+                       truth_window_index=None, test_window_index=None, candidates=None):
+    if candidates is not None:
+        return _filter_window_candidates(candidates, df_truth, df_test, window_radius)
+    # Index both dataframes if they were not indexed beforehand
+    if truth_window_index is None:
+        truth_window_index = window_index(df_truth, matching_fields, window_fields)
+    if test_window_index is None:
+        test_window_index = truth_window_index if df_test is df_truth else window_index(df_test, matching_fields, window_fields)
+    truth_window_values, truth_key_groups = truth_window_index
+    test_window_values, test_key_groups = test_window_index
+    # Generate the pairs in the window for each matching key (e.g. chromosome) independently
+    truth_pairs_list = [np.empty(0, dtype=np.int64)]
+    test_pairs_list = [np.empty(0, dtype=np.int64)]
+    for key, (truth_positions, sorted_truth_positions, sorted_truth_values) in truth_key_groups.items():
+        if key not in test_key_groups:
+            continue
+        test_positions, sorted_test_positions, sorted_test_values = test_key_groups[key]
+        # Candidates are generated with the first window field, looking up the entries of the smallest group
+        # in the sorted entries of the other one
+        if len(truth_positions) <= len(test_positions):
+            window_pairs = _window_pairs(truth_window_values[0][truth_positions], sorted_test_values, sorted_test_positions,
+                                         window_radius, max_window_pairs)
+            window_pairs = ((truth_positions[truth_idxs], test_idxs) for truth_idxs, test_idxs in window_pairs)
+        else:
+            window_pairs = _window_pairs(test_window_values[0][test_positions], sorted_truth_values, sorted_truth_positions,
+                                         window_radius, max_window_pairs)
+            window_pairs = ((truth_idxs, test_positions[test_idxs]) for test_idxs, truth_idxs in window_pairs)
+        for truth_idxs, test_idxs in window_pairs:
+            # Drop entries that are not in the window of the rest of window fields
+            in_window_mask = np.ones(len(truth_idxs), dtype=bool)
+            for truth_values, test_values in zip(truth_window_values[1:], test_window_values[1:]):
+                in_window_mask &= np.abs(truth_values[truth_idxs] - test_values[test_idxs]) <= window_radius
+            truth_pairs_list.append(truth_idxs[in_window_mask])
+            test_pairs_list.append(test_idxs[in_window_mask])
+    truth_pairs = np.concatenate(truth_pairs_list)
+    test_pairs = np.concatenate(test_pairs_list)
+    # Keep the order of a merge on the matching fields (truth order first, then test order)
+    pairs_order = np.lexsort((test_pairs, truth_pairs))
+    truth_pairs = truth_pairs[pairs_order]
+    test_pairs = test_pairs[pairs_order]
+    cross_merge = pd.DataFrame({'index_truth': df_truth.index[truth_pairs],
+                                **{w + '_truth': values[truth_pairs] for w, values in zip(window_fields, truth_window_values)},
+                                'index_test': df_test.index[test_pairs],
+                                **{w + '_test': values[test_pairs] for w, values in zip(window_fields, test_window_values)}})
+    return cross_merge
+
+
+def _filter_window_candidates(candidates, df_truth, df_test, window_radius):
+    # Keep the candidates of the given dataframes that are within the window radius
+    truth_pairs = df_truth.index.get_indexer(candidates['index_truth'])
+    test_pairs = df_test.index.get_indexer(candidates['index_test'])
+    in_window_mask = (truth_pairs >= 0) & (test_pairs >= 0) & (candidates['window_distance'].to_numpy() <= window_radius)
+    # Keep the order of a merge on the matching fields (truth order first, then test order)
+    pairs_order = np.lexsort((test_pairs[in_window_mask], truth_pairs[in_window_mask]))
+    return candidates[in_window_mask].iloc[pairs_order].drop(columns='window_distance').reset_index(drop=True)
+
+
+def window_candidates(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS,
+                      truth_window_index=None, test_window_index=None):
+    # Generate all the truth-test, test-test and truth-truth pairs that intersect_window may need
+    # with the largest window radius to evaluate, so that smaller radii only need to filter them
+    truth_test_candidates = _entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs,
+                                               truth_window_index, test_window_index)
+    test_candidates = _entries_in_window(df_test, df_test, matching_fields, window_fields, window_radius, max_window_pairs,
+                                         test_window_index, test_window_index)
+    truth_candidates = _entries_in_window(df_truth, df_truth, matching_fields, window_fields, window_radius, max_window_pairs,
+                                          truth_window_index, truth_window_index)
+    for candidates in (truth_test_candidates, test_candidates, truth_candidates):
+        # The largest difference of the window fields is the smallest radius where the pair is in the window
+        window_diffs = [(candidates[w + '_truth'] - candidates[w + '_test']).abs().to_numpy() for w in window_fields]
+        candidates['window_distance'] = np.max(window_diffs, axis=0)
+    return truth_test_candidates, test_candidates, truth_candidates
+
+
+def _window_fields_sum_diff(cross_merge, window_fields):
+    window_fields_sum_test = cross_merge[[w + '_test' for w in window_fields]].to_numpy(dtype=np.int64).sum(axis=1)
+    window_fields_sum_truth = cross_merge[[w + '_truth' for w in window_fields]].to_numpy(dtype=np.int64).sum(axis=1)
+    return np.abs(window_fields_sum_test - window_fields_sum_truth)
+
+
+def _greedy_matching(truth_codes, test_codes, truth_count, test_count):
+    # Entries must be sorted by priority
+    # Select the first pair of each test entry whose truth entry has not been selected yet
+    selected_truths = bytearray(truth_count)
+    selected_tests = bytearray(test_count)
+    selected_pairs = []
+    for i, (truth_code, test_code) in enumerate(zip(truth_codes.tolist(), test_codes.tolist())):
+        if selected_tests[test_code] or selected_truths[truth_code]:
+            continue
+        selected_tests[test_code] = 1
+        selected_truths[truth_code] = 1
+        selected_pairs.append(i)
+    selected_mask = np.zeros(len(truth_codes), dtype=bool)
+    selected_mask[selected_pairs] = True
+    # Test entries that were not selected have all their truth entries already matched,
+    # so they are marked as duplicates of the truth entry of their first pair
+    _, first_pairs = np.unique(test_codes, return_index=True)
+    selected_tests_mask = np.frombuffer(selected_tests, dtype=bool)
+    duplicated_pairs = first_pairs[~selected_tests_mask[test_codes[first_pairs]]]
+    duplicated_mask = np.zeros(len(truth_codes), dtype=bool)
+    duplicated_mask[duplicated_pairs] = True
+    return selected_mask, duplicated_mask
+
+
+def _matching_window_entries(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS,
+                             truth_window_index=None, test_window_index=None, candidates=None):
     # Get matching window entries
-    cross_merge = _entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius)
-    # Calculate window_fields_sum_diff
-    cross_merge['window_fields_sum_test'] = cross_merge[[w + '_test' for w in window_fields]].sum(axis=1)
-    cross_merge['window_fields_sum_truth'] = cross_merge[[w + '_truth' for w in window_fields]].sum(axis=1)
-    cross_merge['window_fields_sum_diff'] = (
-        cross_merge['window_fields_sum_test'] - cross_merge['window_fields_sum_truth']).abs()
-    # Sort by window_fields_sum_diff
-    cross_merge.sort_values(by='window_fields_sum_diff', inplace=True)
+    cross_merge = _entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs,
+                                     truth_window_index, test_window_index, candidates)
+    # Sort by window_fields_sum_diff, keeping the order of the pairs in case of a tie
+    sorted_pairs = np.argsort(_window_fields_sum_diff(cross_merge, window_fields), kind='stable')
+    truth_idxs = cross_merge['index_truth'].to_numpy()[sorted_pairs]
+    test_idxs = cross_merge['index_test'].to_numpy()[sorted_pairs]
+    truth_codes, truth_uniques = pd.factorize(truth_idxs)
+    test_codes, test_uniques = pd.factorize(test_idxs)
     # Right now, a test entry can match multiple truth entries
     # We want to match a test entry to only one truth entry
     # A truth entry can still be matched to multiple test entries
     # We want to leave the least amount of truth entries unmatched
     # In the case of a tie, we want to select the test entry to the truth entry with the least window_fields_sum_diff
-    entries_to_keep = pd.Series(False, index=cross_merge.index)
-    curr_cross_merge = cross_merge
-    while True:
-        duplicated_truth_mask = curr_cross_merge.duplicated(subset=['index_truth'], keep=False)
-        unique_truth_df = curr_cross_merge[~duplicated_truth_mask]
-        duplicated_truth_df = curr_cross_merge[duplicated_truth_mask]
-        new_duplicated_truth_df = duplicated_truth_df[~duplicated_truth_df['index_test'].isin(
-            unique_truth_df['index_test'])]
-        entries_to_keep.loc[unique_truth_df.index.union(new_duplicated_truth_df.index)] = True
-        curr_cross_merge = curr_cross_merge.loc[unique_truth_df.index.union(new_duplicated_truth_df.index)]
-        if len(new_duplicated_truth_df) == len(duplicated_truth_df):
-            break
-    cross_merge = cross_merge[entries_to_keep]
+    # Drop the pairs of truth entries with multiple test entries if the test entry is the only one of another truth entry
+    duplicated_truth_mask = np.bincount(truth_codes, minlength=len(truth_uniques))[truth_codes] > 1
+    unique_truth_tests = np.zeros(len(test_uniques), dtype=bool)
+    unique_truth_tests[test_codes[~duplicated_truth_mask]] = True
+    entries_to_keep = ~duplicated_truth_mask | ~unique_truth_tests[test_codes]
+    truth_idxs = truth_idxs[entries_to_keep]
+    test_idxs = test_idxs[entries_to_keep]
     # Remove test entries duplicates keeping the one with the least window_fields_sum_diff
-    selected_entries = pd.Series(False, index=cross_merge.index)
     # Those test entries that are matched to an already matched truth entry are marked as duplicates
-    possible_duplications = dict()
-    already_selected_test_entries = set()
-    already_selected_truth_entries = set()
-    for idx, row in cross_merge.iterrows():
-        if row['index_test'] in already_selected_test_entries:
-            continue
-        if row['index_truth'] in already_selected_truth_entries:
-            possible_duplications.setdefault(row['index_test'], []).append(idx)
-            continue
-        already_selected_test_entries.add(row['index_test'])
-        already_selected_truth_entries.add(row['index_truth'])
-        selected_entries.loc[idx] = True  # type: ignore
-    duplicated_entries = pd.Series(False, index=cross_merge.index)
-    for index_test, duplicated_idxs in possible_duplications.items():
-        if index_test in already_selected_test_entries:
-            continue
-        duplicated_entries.loc[duplicated_idxs[0]] = True
-    selected_cross_merge = cross_merge[selected_entries]
-    duplicated_cross_merge = cross_merge[duplicated_entries]
-    df_tp_test = df_test.loc[selected_cross_merge['index_test']]
-    df_tp_dup_test = df_test.loc[duplicated_cross_merge['index_test']]
-    df_tp_truth = df_truth.loc[selected_cross_merge['index_truth'].unique()]
-    df_tp_test['idx_truth'] = df_truth.loc[selected_cross_merge['index_truth']].index
+    selected_entries, duplicated_entries = _greedy_matching(truth_codes[entries_to_keep], test_codes[entries_to_keep],
+                                                            len(truth_uniques), len(test_uniques))
+    df_tp_test = df_test.loc[test_idxs[selected_entries]]
+    df_tp_dup_test = df_test.loc[test_idxs[duplicated_entries]]
+    df_tp_truth = df_truth.loc[pd.unique(truth_idxs[selected_entries])]
+    df_tp_test['idx_truth'] = df_truth.loc[truth_idxs[selected_entries]].index
     return df_tp_test, df_tp_dup_test, df_tp_truth
 
 
-def _matching_window_duplicate_entries(df, matching_fields, window_fields, window_radius):
+def _matching_window_duplicate_entries(df, matching_fields, window_fields, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS,
+                                       candidates=None):
     # Get matching window entries
-    cross_merge = _entries_in_window(df, df, matching_fields, window_fields, window_radius)
+    cross_merge = _entries_in_window(df, df, matching_fields, window_fields, window_radius, max_window_pairs,
+                                     candidates=candidates)
     # Avoid returning the same entry
     cross_merge = cross_merge[cross_merge['index_truth'] != cross_merge['index_test']]
     # Calculate window_fields_sum_diff
-    cross_merge['window_fields_sum_test'] = cross_merge[[w + '_test' for w in window_fields]].sum(axis=1)
-    cross_merge['window_fields_sum_truth'] = cross_merge[[w + '_truth' for w in window_fields]].sum(axis=1)
-    cross_merge['window_fields_sum_diff'] = (
-        cross_merge['window_fields_sum_test'] - cross_merge['window_fields_sum_truth']).abs()
-    # Group by index_truth and get the count of index_test and sum of window_fields_sum_diff
-    grouped = cross_merge.groupby('index_truth', sort=False).agg(
-        {'index_test': 'count', 'window_fields_sum_diff': 'sum'})
-    grouped.rename(columns={'index_test': 'mate_count'}, inplace=True)
+    window_fields_sum_diff = _window_fields_sum_diff(cross_merge, window_fields)
+    # Group by index_truth (in order of appearance) as adjacency lists of index_test
+    entry_codes, entry_uniques = pd.factorize(cross_merge['index_truth'].to_numpy())
+    mates_order = np.argsort(entry_codes, kind='stable')
+    mate_count = np.bincount(entry_codes, minlength=len(entry_uniques))
+    mates_ends = np.cumsum(mate_count)
+    mates_starts = mates_ends - mate_count
+    sorted_mates = cross_merge['index_test'].to_numpy()[mates_order]
+    sorted_mates_codes = pd.Index(entry_uniques).get_indexer(sorted_mates)
+    window_fields_sum_diff = np.add.reduceat(window_fields_sum_diff[mates_order], mates_starts) if len(mates_order) > 0 \
+        else np.empty(0, dtype=np.int64)
     # Sort by mate_count and window_fields_sum_diff
-    grouped.sort_values(by=['mate_count', 'window_fields_sum_diff'], ascending=[False, True], inplace=True)
+    entries_priority = np.lexsort((window_fields_sum_diff, -mate_count))
     # The entries with the most mates are the non-duplicated ones
+    removed_entries = np.zeros(len(entry_uniques), dtype=bool)
     duplicated_entries = set()
-    while len(grouped) > 0:
-        mates_to_remove = cross_merge.loc[cross_merge['index_truth'] == grouped.index[0], 'index_test']
+    for entry_code in entries_priority.tolist():
+        if removed_entries[entry_code]:
+            continue
         # Remove the selected entry and its mates
-        grouped.drop(index=grouped.index[0], inplace=True)
-        grouped.drop(index=mates_to_remove, inplace=True, errors='ignore')  # type: ignore
-        duplicated_entries.update(mates_to_remove.values)
+        mates_slice = slice(mates_starts[entry_code], mates_ends[entry_code])
+        mates_codes = sorted_mates_codes[mates_slice]
+        removed_entries[mates_codes[mates_codes >= 0]] = True
+        duplicated_entries.update(sorted_mates[mates_slice])
 
     # Get the original entries from the selected_truth_entries and the same_entry_mask
     duplicated_entries = df.loc[list(duplicated_entries)]
@@ -186,25 +300,31 @@ def _matching_window_duplicate_entries(df, matching_fields, window_fields, windo
     return original_entries, duplicated_entries
 
 
-def intersect_window(df_truth, df_test, matching_fields, window_fields, window_radius):
+def intersect_window(df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS,
+                     truth_window_index=None, test_window_index=None, candidates=None):
+    # The window indexes (see window_index) and the candidates (see window_candidates) are optional
+    # and must have been built with the same fields (and a window radius not smaller than window_radius)
+    truth_test_candidates, test_candidates, truth_candidates = candidates if candidates is not None else (None, None, None)
     # Compute TP
     df_tp, df_tp_dup_test, df_all_truth_tp = _matching_window_entries(
-        df_truth, df_test, matching_fields, window_fields, window_radius)
+        df_truth, df_test, matching_fields, window_fields, window_radius, max_window_pairs, truth_window_index, test_window_index,
+        truth_test_candidates)
     df_all_test_tp = df_test.loc[df_tp.index.union(df_tp_dup_test.index)]
     # Find FP
     df_all_fp = df_test.loc[~df_test.index.isin(df_all_test_tp.index)]
     # Find duplicates in FP
     df_fp, df_fp_dup = _matching_window_duplicate_entries(
-        df_all_fp, matching_fields, window_fields, window_radius)
+        df_all_fp, matching_fields, window_fields, window_radius, max_window_pairs, test_candidates)
     # Find FN
     df_all_fn = df_truth.drop(df_all_truth_tp.index)
     # Find duplicates in TP from truth
     df_1, df_2, df_tp_dup_truth = _matching_window_entries(
-        df_all_truth_tp, df_all_fn, matching_fields, window_fields, window_radius)
+        df_all_truth_tp, df_all_fn, matching_fields, window_fields, window_radius, max_window_pairs,
+        candidates=truth_candidates)
     # Concat truth TP and truth TP duplicates
-    df_tp_dup = pd.concat([df_tp_dup_test, df_tp_dup_truth], ignore_index=True)
+    df_tp_dup = concat_variants([df_tp_dup_test, df_tp_dup_truth], ignore_index=True)
     # Find duplicates in FN
     df_all_fn = df_all_fn.drop(df_1.index.union(df_2.index))
     df_fn, df_fn_dup = _matching_window_duplicate_entries(
-        df_all_fn, matching_fields, window_fields, window_radius)
+        df_all_fn, matching_fields, window_fields, window_radius, max_window_pairs, truth_candidates)
     return df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup
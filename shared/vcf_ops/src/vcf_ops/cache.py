@@ -0,0 +1,195 @@
+# Copyright 2023 - Barcelona Supercomputing Center
+# Author: Rodrigo Martín
+# BSC Dual License
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+
+from .gene_annotations import gene_ids, gene_symbols  # noqa
+from .constants import VCF_CACHE_DIR_ENV, VCF_CACHE_MAX_SIZE, VCF_CACHE_VERSION  # noqa
+
+# Content hash of the files already hashed by this process, by path and signature
+_CONTENT_HASHES = {}
+_HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def cache_dir_from_env():
+    # The cache is only enabled if the environment variable is set
+    return os.environ.get(VCF_CACHE_DIR_ENV) or None
+
+
+def _content_hash(vcf_file: str, signature) -> str:
+    memo_key = (os.path.abspath(vcf_file), signature)
+    if memo_key not in _CONTENT_HASHES:
+        content_hash = hashlib.blake2b(digest_size=20)
+        with open(vcf_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+                content_hash.update(chunk)
+        _CONTENT_HASHES[memo_key] = content_hash.hexdigest()
+    return _CONTENT_HASHES[memo_key]
+
+
+def cache_key(vcf_file: str, signature, pass_only: bool, ensure_pairs: bool, score_field, variant_filter=None,
+              gene_annotations=False, regions=None) -> str:
+    # Files with the same content share their entry, wherever they are
+    key = f'{VCF_CACHE_VERSION}|{_content_hash(vcf_file, signature)}|{pass_only}|{ensure_pairs}|{score_field}|{variant_filter!r}|' \
+        f'{gene_annotations}'
+    if regions is not None:
+        key += f'|{regions!r}'
+    return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+
+def regions_cache_key(bed_file: str, signature) -> str:
+    # BED files with the same content share their preprocessed regions (see read_bed_regions), with chromosomes without chr
+    key = f'{VCF_CACHE_VERSION}|regions-nochr|{_content_hash(bed_file, signature)}'
+    return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+
+def load_cached_regions(cache_dir: str, key: str):
+    # Returns the chromosomes, and the chromosome codes, starts and ends (memory-mapped) of the regions of the entry
+    entry_path = os.path.join(cache_dir, key)
+    columns_path = os.path.join(entry_path, 'columns.json')
+    if not os.path.exists(columns_path):
+        return None
+    try:
+        with open(columns_path) as f:
+            entry = json.load(f)
+        chroms = entry['columns'][0]['categories']
+        # Empty files cannot be memory-mapped
+        mmap_mode = 'r' if entry['attrs']['regions'] > 0 else None
+        regions = tuple(np.load(os.path.join(entry_path, name + '.npy'), mmap_mode=mmap_mode) for name in ('chrom', 'start', 'end'))
+        os.utime(columns_path)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        logging.warning(f'Could not load entry {key} from VCF cache {cache_dir}: {e}')
+        return None
+    return (chroms,) + regions
+
+
+def store_cached_regions(cache_dir: str, key: str, chroms, chrom_codes: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                         max_size=VCF_CACHE_MAX_SIZE):
+    # Stored as a dataframe entry, so that they share the eviction of the parsed VCF files
+    regions_df = pd.DataFrame({'chrom': pd.Categorical.from_codes(chrom_codes, categories=chroms), 'start': starts, 'end': ends})
+    regions_df.attrs['regions'] = len(regions_df)
+    store_cached_variants(cache_dir, key, regions_df, max_size=max_size)
+
+
+def load_cached_variants(cache_dir: str, key: str):
+    # Returns the variants dataframe, the record index (or None), the raw records (or None) and the gene annotations
+    # (or None) of the entry
+    # Raw records are memory-mapped, as they are only sliced when writing them. Columns are read, as building the
+    # dataframe (and concatenating it in read_vcfs) copies them anyway
+    entry_path = os.path.join(cache_dir, key)
+    columns_path = os.path.join(entry_path, 'columns.json')
+    if not os.path.exists(columns_path):
+        return None
+    try:
+        with open(columns_path) as f:
+            entry = json.load(f)
+        columns = entry['columns']
+        data = {}
+        for column in columns:
+            values = np.load(os.path.join(entry_path, column['name'] + '.npy'))
+            if 'categories' in column:
+                values = pd.Categorical.from_codes(values, categories=column['categories'])
+            data[column['name']] = values
+        variants_df = pd.DataFrame(data, columns=[column['name'] for column in columns])
+        variants_df.attrs.update(entry['attrs'])
+        record_index = None
+        if os.path.exists(os.path.join(entry_path, 'offsets.npy')):
+            record_index = (np.load(os.path.join(entry_path, 'offsets.npy')),
+                            np.load(os.path.join(entry_path, 'ordinals.npy')))
+        raw_records = None
+        if os.path.exists(os.path.join(entry_path, 'raw_ends.npy')):
+            raw_ends = np.load(os.path.join(entry_path, 'raw_ends.npy'))
+            raw_data = np.memmap(os.path.join(entry_path, 'raw.bin'), dtype=np.uint8, mode='r') if raw_ends[-1] > 0 \
+                else np.zeros(0, dtype=np.uint8)
+            raw_records = (raw_data, raw_ends)
+        gene_annotations = None
+        if 'genes' in entry:
+            # Gene ids are local to the entry
+            symbols_ids = gene_ids(entry['genes']['symbols'])
+            gene_annotations = (entry['genes']['annotated'], np.load(os.path.join(entry_path, 'gene_ends.npy')),
+                                symbols_ids[np.load(os.path.join(entry_path, 'gene_ids.npy'))])
+        # Most recently used entries are kept when evicting
+        os.utime(columns_path)
+    except (OSError, ValueError, KeyError) as e:
+        # Entry being evicted or corrupted, parse the file again
+        logging.warning(f'Could not load entry {key} from VCF cache {cache_dir}: {e}')
+        return None
+    return variants_df, record_index, raw_records, gene_annotations
+
+
+def store_cached_variants(cache_dir: str, key: str, variants_df: pd.DataFrame, record_index=None, raw_records=None,
+                          gene_annotations=None, max_size=VCF_CACHE_MAX_SIZE):
+    # Writes the entry in a temporary folder that is renamed at the end, so that readers never see partial entries
+    entry_path = os.path.join(cache_dir, key)
+    if os.path.exists(entry_path):
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    except OSError as e:
+        logging.warning(f'Could not store entry {key} in VCF cache {cache_dir}: {e}')
+        return
+    try:
+        columns = []
+        for name in variants_df.columns:
+            values = variants_df[name]
+            column = {'name': name}
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                column['categories'] = values.cat.categories.tolist()
+                values = values.cat.codes
+            np.save(os.path.join(temp_path, name + '.npy'), values.to_numpy())
+            columns.append(column)
+        if record_index is not None:
+            np.save(os.path.join(temp_path, 'offsets.npy'), record_index[0])
+            np.save(os.path.join(temp_path, 'ordinals.npy'), record_index[1])
+        if raw_records is not None:
+            raw_records[0].tofile(os.path.join(temp_path, 'raw.bin'))
+            np.save(os.path.join(temp_path, 'raw_ends.npy'), raw_records[1])
+        entry = {'columns': columns, 'attrs': variants_df.attrs}
+        if gene_annotations is not None:
+            annotated, gene_ends, entry_gene_ids = gene_annotations
+            unique_ids, local_ids = np.unique(entry_gene_ids, return_inverse=True)
+            np.save(os.path.join(temp_path, 'gene_ends.npy'), gene_ends)
+            np.save(os.path.join(temp_path, 'gene_ids.npy'), local_ids.astype(np.int32))
+            entry['genes'] = {'annotated': bool(annotated), 'symbols': gene_symbols(unique_ids)}
+        # Written last, as it marks the entry as complete
+        with open(os.path.join(temp_path, 'columns.json'), 'w') as f:
+            json.dump(entry, f)
+        os.rename(temp_path, entry_path)
+    except OSError as e:
+        # Also if another process stored the same entry meanwhile
+        shutil.rmtree(temp_path, ignore_errors=True)
+        if not os.path.exists(entry_path):
+            logging.warning(f'Could not store entry {key} in VCF cache {cache_dir}: {e}')
+        return
+    _evict(cache_dir, max_size, keep=key)
+
+
+def _evict(cache_dir: str, max_size: int, keep=None):
+    # Remove the least recently used entries until the cache fits in max_size bytes
+    entries = []
+    for entry in os.scandir(cache_dir):
+        columns_path = os.path.join(entry.path, 'columns.json')
+        if entry.name.startswith('.') or not entry.is_dir() or not os.path.exists(columns_path):
+            continue
+        try:
+            entry_size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((os.stat(columns_path).st_mtime, entry_size, entry))
+        except OSError:
+            # Removed by another process
+            continue
+    total_size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry in sorted(entries, key=lambda e: e[0]):
+        if total_size <= max_size:
+            break
+        if entry.name == keep:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total_size -= entry_size
@@ -9,3 +9,18 @@ DEFAULT_VARIANT_TYPES = ['SNV', 'INDEL-INS', 'INDEL-DUP', 'INDEL-DEL', 'SV-TRA',
 UNION_SYMBOL = '_or_'
 INTERSECTION_SYMBOL = '_and_'
 ONCOLINER_INFO_GENES_NAME = 'ONCOLINER_PROT_GENES'
+DEFAULT_MAX_WINDOW_PAIRS = 10_000_000
+RECORD_INDEX_CACHE_SIZE = 32
+SEEK_MAX_VARIANTS_FRACTION = 0.5
+HEADER_CACHE_SIZE = 64
+# Bases read at once from the FASTA file when preparing a packed reference, and window of the bases of the variants
+# fetched at once when converting them (see indel_sv_converter)
+REFERENCE_FETCH_SIZE = 16 * 1024 * 1024
+# Columns of the variants dataframes stored as categories (interned strings)
+VARIANTS_CATEGORICAL_COLUMNS = ['start_chrom', 'end_chrom', 'ref', 'alt', 'brackets', 'type_inferred', 'vcf_file']
+# Columns of the variants dataframes stored as 32-bit integers (64-bit if they do not fit)
+VARIANTS_POSITION_COLUMNS = ['start', 'end', 'length']
+# Environment variable with the folder of the parsed VCF files cache (disabled if not set)
+VCF_CACHE_DIR_ENV = 'ONCOLINER_VCF_CACHE_DIR'
+VCF_CACHE_MAX_SIZE = 20 * 1024 ** 3
+VCF_CACHE_VERSION = 1
@@ -0,0 +1,149 @@
+# Copyright 2023 - Barcelona Supercomputing Center
+# Author: Rodrigo Martín
+# BSC Dual License
+from typing import List, Set, Sequence
+import os
+import numpy as np
+import pandas as pd
+
+from .constants import ONCOLINER_INFO_GENES_NAME
+
+# Lazy load
+_PROTEIN_CODING_GENES = None
+_CANCER_CENSUS_GENES = None
+# Ids of the gene symbols captured by read_vcfs, shared by all the files
+_GENE_IDS = {}
+_GENE_SYMBOLS = []
+# Gene annotations captured by read_vcfs, by VCF file, pass_only and regions (see store_gene_annotations)
+_GENE_ANNOTATIONS = {}
+
+
+def encode_genes(variants_genes: Sequence[Sequence[str]]):
+    # CSR encoding of the genes of each variant: the ids of the genes of the i-th variant are gene_ids[gene_ends[i]:gene_ends[i + 1]]
+    gene_ends = np.zeros(len(variants_genes) + 1, dtype=np.int64)
+    gene_ids = []
+    for i, genes in enumerate(variants_genes):
+        gene_ids.extend(_gene_id(gene) for gene in genes)
+        gene_ends[i + 1] = len(gene_ids)
+    return gene_ends, np.array(gene_ids, dtype=np.int32)
+
+
+def _gene_id(gene: str) -> int:
+    if gene not in _GENE_IDS:
+        _GENE_IDS[gene] = len(_GENE_SYMBOLS)
+        _GENE_SYMBOLS.append(gene)
+    return _GENE_IDS[gene]
+
+
+def gene_symbols(gene_ids: np.ndarray) -> List[str]:
+    return [_GENE_SYMBOLS[gene_id] for gene_id in gene_ids.tolist()]
+
+
+def gene_ids(symbols: Sequence[str]) -> np.ndarray:
+    return np.array([_gene_id(gene) for gene in symbols], dtype=np.int32)
+
+
+def store_gene_annotations(vcf_file: str, pass_only: bool, annotated: bool, gene_ends: np.ndarray, gene_ids: np.ndarray,
+                           regions=None):
+    # annotated tells if any variant of the file is gene annotated, even if it affects no protein coding gene
+    # Files read restricted to some regions number their variants among those in them (see read_vcfs)
+    _GENE_ANNOTATIONS[(vcf_file, pass_only, repr(regions) if regions is not None else None)] = (annotated, gene_ends, gene_ids)
+
+
+def get_gene_annotations(vcf_file: str, pass_only: bool, regions=None):
+    return _GENE_ANNOTATIONS.get((vcf_file, pass_only, repr(regions) if regions is not None else None))
+
+
+def _read_genes_file(genes_tsv_file_path: str):
+    df = pd.read_csv(genes_tsv_file_path, sep='\t')
+    # Lowercase all columns
+    df.columns = [col.lower() for col in df.columns]
+    # Get all the genes in the "symbol" column
+    return frozenset(df['symbol'].unique())
+
+
+def _extract_annotations(variant_record_obj, annotation_field_name: str) -> List[str]:
+    annotations = variant_record_obj.info[annotation_field_name]
+    if annotations is None:
+        return []
+    elif isinstance(annotations, str):
+        annotations = [annotations]
+    return annotations
+
+
+def get_cancer_census_genes():
+    # Lazy load CANCER_CENSUS_GENES
+    global _CANCER_CENSUS_GENES
+    if _CANCER_CENSUS_GENES is None:
+        _CANCER_CENSUS_GENES = _read_genes_file(os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'genes_cancer.tsv'))
+    return _CANCER_CENSUS_GENES
+
+
+def _extract_protein_affected_genes_from_oncoliner(variant_record_obj) -> Set[str]:
+    # Extract protein coding genes from ONCOLINER annotation
+    return set(_extract_annotations(variant_record_obj, ONCOLINER_INFO_GENES_NAME))
+
+
+def _extract_protein_affected_genes_from_funnsv(variant_record_obj) -> Set[str]:
+    # Extract protein coding genes from funnSV annotation
+    protein_affected_genes = set()
+    for annotation in _extract_annotations(variant_record_obj, 'FUNNSV_ANNOTATIONS'):
+        for ann in annotation.split('|'):
+            if ann in _PROTEIN_CODING_GENES:
+                protein_affected_genes.add(ann)
+    return protein_affected_genes
+
+
+def _extract_protein_affected_genes_from_vep(variant_record_obj) -> Set[str]:
+    # Extract protein coding genes from VEP annotation
+    protein_affected_consequences = set(['stop_gained', 'frameshift_variant', 'stop_lost', 'start_lost', 'inframe_insertion',
+                                        'inframe_deletion', 'missense_variant', 'protein_altering_variant', 'coding_sequence_variant', 'coding_transcript_variant'])
+    protein_affected_genes = set()
+    for vep_annotation in _extract_annotations(variant_record_obj, 'CSQ'):
+        # Find an annotation with a protein affecting consequence
+        found = False
+        for ann in vep_annotation.split('|'):
+            if len(set(ann.split('&')).intersection(protein_affected_consequences)) > 0:
+                found = True
+                break
+        if not found:
+            continue
+        # Extract the gene symbol
+        for ann in vep_annotation.split('|'):
+            if ann in _PROTEIN_CODING_GENES:
+                protein_affected_genes.add(ann)
+    return protein_affected_genes
+
+
+def extract_protein_affected_genes(variant_record_obj) -> Set[str]:
+    # Load PROTEIN_CODING_GENES
+    global _PROTEIN_CODING_GENES
+    if _PROTEIN_CODING_GENES is None:
+        _PROTEIN_CODING_GENES = _read_genes_file(os.path.join(os.path.dirname(
+            __file__), '..', '..', 'data', 'genes_with_protein_product.tsv'))
+    # Check for ONCOLINER annotation
+    if _is_gene_annotated_in_oncoliner(variant_record_obj):
+        return _extract_protein_affected_genes_from_oncoliner(variant_record_obj)
+    # Check for VEP annotation
+    if _is_gene_annotated_in_vep(variant_record_obj):
+        return _extract_protein_affected_genes_from_vep(variant_record_obj)
+    # Check for funnSV annotation
+    if _is_gene_annotated_in_funnsv(variant_record_obj):
+        return _extract_protein_affected_genes_from_funnsv(variant_record_obj)
+    return set()
+
+
+def _is_gene_annotated_in_vep(variant_record_obj) -> bool:
+    return 'CSQ' in variant_record_obj.info
+
+
+def _is_gene_annotated_in_funnsv(variant_record_obj) -> bool:
+    return 'FUNNSV_ANNOTATIONS' in variant_record_obj.info
+
+
+def _is_gene_annotated_in_oncoliner(variant_record_obj) -> bool:
+    return ONCOLINER_INFO_GENES_NAME in variant_record_obj.info
+
+
+def is_gene_annotated(variant_record_obj) -> bool:
+    return _is_gene_annotated_in_oncoliner(variant_record_obj) or _is_gene_annotated_in_vep(variant_record_obj) or _is_gene_annotated_in_funnsv(variant_record_obj)
@@ -1,9 +1,17 @@
 # Copyright 2023 - Barcelona Supercomputing Center
 # Author: Rodrigo Martín
 # BSC Dual License
-from typing import List, Tuple, Sequence, Iterator
+from typing import Dict, List, Tuple, Sequence, Iterator
 from collections import OrderedDict
-import gzip
+import os
+import re
+import copy
+import zlib
+import struct
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import pysam
 
@@ -11,11 +19,46 @@ from variant_extractor import VariantExtractor
 from variant_extractor.variants import VariantRecord
 
 from .masks import snv_mask, indel_mask  # noqa
-from .constants import ONCOLINER_INFO_GENES_NAME  # noqa
+from .schema import compact_variants, concat_variants, extractor_variants  # noqa
+from .gene_annotations import encode_genes, extract_protein_affected_genes, get_gene_annotations, is_gene_annotated, \
+    store_gene_annotations  # noqa
+from .cache import cache_dir_from_env, cache_key, load_cached_variants, store_cached_variants  # noqa
+from .constants import ONCOLINER_INFO_GENES_NAME, RECORD_INDEX_CACHE_SIZE, SEEK_MAX_VARIANTS_FRACTION, HEADER_CACHE_SIZE  # noqa
+
+# Record indexes and raw records of the last VCF files read (by file, pass_only and regions), see _IndexedVariantExtractor
+_RECORD_INDEXES = OrderedDict()
+_RAW_RECORDS = OrderedDict()
+# Headers of the VCF files (and merged headers of groups of them) already read by this process, see _extract_header
+_HEADERS = OrderedDict()
+# Mate position in the ALT of a breakend
+_BREAKEND_MATE_REGEX = re.compile(r'[\[\]]([^\[\]:]+):(\d+)[\[\]]')
+# Maximum uncompressed size of a BGZF block (same as htslib) and BGZF end-of-file marker
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Contig of the marker records that number the records read by _IndexedVariantExtractor
+_MARKER_CONTIG = 'vcf_ops_record'
 
 
 def _extract_header(vcf_files: List[str]) -> Tuple[pysam.VariantHeader, bool, bool]:
-    headers = [pysam.VariantFile(open(vcf_file)).header for vcf_file in vcf_files]
+    # Headers are cached by the path and signature of their VCF files, so that each one is parsed and merged once per process
+    # (worker processes keep their own cache). A copy is returned, as writers modify it
+    key = tuple((vcf_file, _file_signature(vcf_file)) for vcf_file in vcf_files)
+    if key not in _HEADERS:
+        if len(vcf_files) == 1:
+            with open(vcf_files[0]) as f:
+                variant_file = pysam.VariantFile(f)
+                _HEADERS[key] = (variant_file.header.copy(), True, True)
+                variant_file.close()
+        else:
+            _HEADERS[key] = _merge_headers([_extract_header([vcf_file])[0] for vcf_file in vcf_files])
+    _HEADERS.move_to_end(key)
+    header, same_samples, same_formats = _HEADERS[key]
+    while len(_HEADERS) > HEADER_CACHE_SIZE:
+        _HEADERS.popitem(last=False)
+    return header.copy(), same_samples, same_formats
+
+
+def _merge_headers(headers: List[pysam.VariantHeader]) -> Tuple[pysam.VariantHeader, bool, bool]:
     main_header = headers[0]
     # Check if samples are the same in all VCFs
     same_samples = True
@@ -46,14 +89,6 @@ def _get_contigs(header: pysam.VariantHeader, fasta_ref=None):
     return contigs
 
 
-def _get_contig_order(contigs: OrderedDict):
-    # Set contigs from fasta_ref
-    contig_order = dict()
-    for i, contig in enumerate(contigs):
-        contig_order[contig] = i
-    return contig_order
-
-
 def _set_contigs(header: pysam.VariantHeader, contigs: OrderedDict, remove_chr: bool):
     if remove_chr:
         contigs = OrderedDict((contig.replace('chr', ''), length) for contig, length in contigs.items())
@@ -65,7 +100,7 @@ def _set_contigs(header: pysam.VariantHeader, contigs: OrderedDict, remove_chr:
             header.contigs.remove_header(contig)
 
 
-def _write_raw_file(f, header: pysam.VariantHeader, variant_record_list: Sequence[VariantRecord], same_samples: bool, same_formats: bool, remove_chr: bool):
+def _write_raw_header(f, header: pysam.VariantHeader, same_samples: bool, same_formats: bool):
     # Remove all format fields except GT for compatibility between VCFs
     if not same_formats or not same_samples:
         for format_ in header.formats:
@@ -80,118 +115,886 @@ def _write_raw_file(f, header: pysam.VariantHeader, variant_record_list: Sequenc
         custom_header_header = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tDUMMY_NORMAL\tDUMMY_TUMOR\n'
         header_str = header_str[:header_pos] + custom_header_header
     f.write(header_str)
-    # Dummy samples (in case samples are not the same in all VCFs)
-    dummy_samples = {'DUMMY_NORMAL': {'GT': (0, 0)}, 'DUMMY_TUMOR': {'GT': (0, 1)}}
-    # Write variants
-    for variant_record in variant_record_list:
-        # Reset samples if they are not the same in all VCFs
-        if not same_formats or not same_samples:
-            # Remove all format fields except GT for compatibility between VCFs
-            variant_record.format = ['GT']
-        if not same_samples:
-            variant_record.samples = dummy_samples
-        if remove_chr:
-            # Remove chr from the first 4 fields
-            variant_record_split = str(variant_record).split('\t')
-            variant_record_str = '\t'.join([variant_record_split[0].replace('chr', '')] + variant_record_split[1:4] +
-                                           [variant_record_split[4].replace('chr', '')] + variant_record_split[5:])
+
+
+# Dummy samples (in case samples are not the same in all VCFs)
+_DUMMY_SAMPLES = {'DUMMY_NORMAL': {'GT': (0, 0)}, 'DUMMY_TUMOR': {'GT': (0, 1)}}
+
+
+def _write_raw_record(f, variant_record: VariantRecord, genes_symbols, same_samples: bool, same_formats: bool, remove_chr: bool):
+    # The record may be written to several files, so it is modified in a copy
+    variant_record = copy.copy(variant_record)
+    if genes_symbols is not None and len(genes_symbols) > 0:
+        variant_record.info = {**variant_record.info, ONCOLINER_INFO_GENES_NAME: list(genes_symbols)}
+    # Reset samples if they are not the same in all VCFs
+    if not same_formats or not same_samples:
+        # Remove all format fields except GT for compatibility between VCFs
+        variant_record.format = ['GT']
+    if not same_samples:
+        variant_record.samples = _DUMMY_SAMPLES
+    if remove_chr:
+        # Remove chr from the first 4 fields
+        variant_record_split = str(variant_record).split('\t')
+        variant_record_str = '\t'.join([variant_record_split[0].replace('chr', '')] + variant_record_split[1:4] +
+                                       [variant_record_split[4].replace('chr', '')] + variant_record_split[5:])
+    else:
+        variant_record_str = str(variant_record)
+    f.write(variant_record_str + '\n')
+
+
+def _edit_raw_record(variant_record_str: str, genes_symbols, same_samples: bool, same_formats: bool, remove_chr: bool) -> str:
+    # Same as _write_raw_record, editing the text of the record instead of parsing it
+    if (genes_symbols is None or len(genes_symbols) == 0) and same_samples and same_formats and not remove_chr:
+        return variant_record_str
+    fields = variant_record_str.rstrip('\n').split('\t')
+    if genes_symbols is not None and len(genes_symbols) > 0:
+        genes_info = f'{ONCOLINER_INFO_GENES_NAME}={",".join(genes_symbols)}'
+        info = [] if fields[7] == '.' else fields[7].split(';')
+        genes_pos = [i for i, value in enumerate(info) if value.split('=')[0] == ONCOLINER_INFO_GENES_NAME]
+        if len(genes_pos) > 0:
+            info[genes_pos[0]] = genes_info
         else:
-            variant_record_str = str(variant_record)
-        f.write(variant_record_str + '\n')
+            info.append(genes_info)
+        fields[7] = ';'.join(info)
+    if not same_samples:
+        fields[8:] = ['GT', '0/0', '0/1']
+    elif not same_formats:
+        # Keep only GT, unphased as in VariantRecord
+        format_ = fields[8].split(':')
+        gt_pos = format_.index('GT') if 'GT' in format_ else len(format_)
+        samples = [sample.split(':') for sample in fields[9:]]
+        fields[8:] = ['GT'] + [sample[gt_pos].replace('|', '/') if gt_pos < len(sample) else '.' for sample in samples]
+    if remove_chr:
+        # Remove chr from the first 4 fields
+        fields[0] = fields[0].replace('chr', '')
+        fields[4] = fields[4].replace('chr', '')
+    return '\t'.join(fields) + '\n'
+
+
+def _is_breakend(record: pysam.VariantRecord) -> bool:
+    return any('[' in alt or ']' in alt for alt in record.alts or ())
+
+
+def _breakend_mate_ids(record: pysam.VariantRecord) -> Tuple[str, ...]:
+    # IDs of the mates of a breakend (MATEID or PARID, as VariantExtractor pairs them), empty if it has none
+    for key in ('MATEID', 'PARID'):
+        if key in record.info:
+            mate_ids = record.info[key]
+            return (mate_ids,) if isinstance(mate_ids, str) else tuple(mate_ids)
+    return ()
+
 
+def _is_breakend_mate(record: pysam.VariantRecord, chrom: str, pos: int, mate_ids: Tuple[str, ...]) -> bool:
+    # Whether record is a mate of the breakend at chrom:pos with mate_ids, that is, whether its ID is one of mate_ids
+    # or, if the breakend has no mate IDs, whether its ALT points to chrom:pos
+    if len(mate_ids) > 0:
+        return record.id in mate_ids
+    for alt in record.alts:
+        mate = _BREAKEND_MATE_REGEX.search(alt)
+        if mate is not None and mate.group(1) == chrom and int(mate.group(2)) == pos:
+            return True
+    return False
 
-def extract_variants(vcf_file: str, idx_list: List[int], pass_only: bool = True) -> Iterator[VariantRecord]:
+
+def _fetch_ranges(regions, contigs: List[str]) -> List[Tuple[str, int, int]]:
+    # Ranges (0-based, half-open) of the contigs of an indexed VCF file with the records of the variants in regions
+    # (see BedMask, whose regions are closed intervals of VCF positions)
+    ranges = []
+    for contig in contigs:
+        if contig.replace('chr', '') not in regions.regions:
+            continue
+        starts, ends = regions.regions[contig.replace('chr', '')]
+        ranges.extend((contig, max(start - 1, 0), end) for start, end in zip(starts.tolist(), ends.tolist()))
+    return ranges
+
+
+class _VcfRecords:
+    # pysam handle of a VCF file that keeps the offset of the last record read (BGZF virtual offset if compressed)
+    # If contig, only the records of that contig are read (the file must be indexed)
+    # If offsets, only the records at those offsets are read
+    # If skip_breakends, breakend records are not read, but their number and offset are kept in skipped_breakends
+    # If ranges, only the records overlapping them are read (the file must be indexed), followed by the mates of their
+    # breakends, so that they can be paired
+    def __init__(self, variant_file: pysam.VariantFile, contig=None, offsets=None, skip_breakends=False, ranges=None):
+        self.__variant_file = variant_file
+        self.__contig = contig
+        self.__offsets = offsets
+        self.__skip_breakends = skip_breakends
+        self.ranges = ranges
+        self.__range_offset = None
+        self.header = variant_file.header
+        self.offset = None
+        self.breakend = False
+        # Number of the last record read (in the contig, or in offsets, if set)
+        self.number = None
+        self.end_offset = None
+        self.skipped_breakends = []
+
+    def __iter__(self):
+        number = 0
+        if self.ranges is not None:
+            records_iter = self.__ranges_records()
+        elif self.__contig is not None:
+            records_iter = self.__variant_file.fetch(self.__contig)
+        else:
+            records_iter = self.__variant_file
+        while True:
+            if self.__offsets is not None:
+                if number == len(self.__offsets):
+                    break
+                self.seek(self.__offsets[number])
+            # The offset before fetching the first record of a contig is not known
+            offset = self.__variant_file.tell() if self.__contig is None or number > 0 else None
+            record = next(records_iter, None)
+            if record is None:
+                break
+            if self.ranges is not None:
+                offset = self.__range_offset
+            if self.__contig is not None:
+                self.end_offset = self.__variant_file.tell()
+            breakend = _is_breakend(record)
+            if breakend and self.__skip_breakends:
+                self.skipped_breakends.append((number, offset))
+                number += 1
+                continue
+            self.offset = offset
+            self.breakend = breakend
+            self.number = number
+            number += 1
+            yield record
+        self.offset = None
+        self.number = None
+
+    def __ranges_records(self):
+        # Records are read once, even if they overlap several ranges, telling them apart by their end offset
+        read_ends = set()
+        contigs = set(self.__variant_file.index)
+        mates = []
+        for ranges, mates_pass in ((self.ranges, False), (mates, True)):
+            for contig, start, end, *breakend_record in ranges:
+                # The offset before fetching the first record of a range is not known
+                self.__range_offset = None
+                for record in self.__variant_file.fetch(contig, start, end):
+                    end_offset = self.__variant_file.tell()
+                    breakend = _is_breakend(record)
+                    # Other breakends at the position of a mate are not read, as their mates may not be
+                    if end_offset not in read_ends and \
+                            (not mates_pass or (breakend and _is_breakend_mate(record, *breakend_record))):
+                        read_ends.add(end_offset)
+                        if breakend and not mates_pass:
+                            mate_ids = _breakend_mate_ids(record)
+                            for alt in record.alts:
+                                mate = _BREAKEND_MATE_REGEX.search(alt)
+                                if mate is not None and mate.group(1) in contigs:
+                                    mates.append((mate.group(1), int(mate.group(2)) - 1, int(mate.group(2)),
+                                                  record.chrom, record.pos, mate_ids))
+                        yield record
+                    self.__range_offset = end_offset
+
+    def seek(self, offset: int):
+        current = self.__variant_file.tell()
+        # Records in the same BGZF block are read through instead of decompressing the block again
+        if self.__variant_file.compression == 'BGZF' and current <= offset and current >> 16 == offset >> 16:
+            while current < offset:
+                next(self.__variant_file)
+                current = self.__variant_file.tell()
+        elif current != offset:
+            self.__variant_file.seek(offset)
+
+    def close(self):
+        self.__variant_file.close()
+
+
+class _IndexedVariantExtractor(VariantExtractor):
+    # VariantExtractor that keeps, for each variant, the offset of the VCF record it comes from and its position among
+    # the variants of that record, so that it can be extracted again without reading the whole file
+    # Breakends depend on their mates, so they are not indexed (offset -1)
+    # VariantExtractor reads the VCF file as a stream, which cannot tell offsets, so the records are read with pysam and
+    # VariantExtractor parses a temporary copy of them, where each one follows a marker record with its offset and number
+    # If raw_records, the text of the variants is also kept in a temporary file
+    # contig, offsets and skip_breakends restrict the records read (see _VcfRecords), numbers keeps the record of each variant
+    # If variant_filter, only the variants it selects are yielded, but all of them are indexed (selected keeps which ones)
+    # If gene_annotations, the protein affected genes of each selected variant are kept, and whether any variant is annotated
+    # If regions (see BedMask), only the variants in them are read, fetching their records if the file is indexed, and
+    # everything else (offsets, selected, raw records...) only refers to them
+    def __init__(self, vcf_file: str, pass_only=False, ensure_pairs=True, raw_records=False, contig=None, offsets=None,
+                 skip_breakends=False, variant_filter=None, gene_annotations=False, regions=None):
+        self.records = None
+        self.offsets = []
+        self.ordinals = []
+        self.numbers = []
+        self.variant_filter = variant_filter
+        self.regions = regions
+        self.selected = []
+        self.raw_file = tempfile.TemporaryFile() if raw_records else None
+        self.raw_ends = []
+        self.genes = [] if gene_annotations else None
+        self.gene_annotated = False
+        save = pysam.set_verbosity(0)
+        try:
+            variant_file = pysam.VariantFile(vcf_file)
+        except (OSError, NotImplementedError):
+            # Not seekable (e.g. gzip instead of BGZF compressed), keep reading the stream
+            variant_file = None
+        pysam.set_verbosity(save)
+        if variant_file is None:
+            if contig is not None or offsets is not None:
+                raise ValueError(f'VCF file {vcf_file} is not seekable')
+            super().__init__(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs)
+            return
+        ranges = _fetch_ranges(regions, list(variant_file.index)) \
+            if regions is not None and variant_file.index is not None and contig is None and offsets is None else None
+        self.records = _VcfRecords(variant_file, contig=contig, offsets=offsets, skip_breakends=skip_breakends, ranges=ranges)
+        with tempfile.NamedTemporaryFile('w', suffix='.vcf', delete=False) as marked_file:
+            _write_marked_records(marked_file, self.records)
+        self.records.close()
+        try:
+            super().__init__(marked_file.name, pass_only=pass_only, ensure_pairs=ensure_pairs)
+        finally:
+            # VariantExtractor keeps the file open
+            os.unlink(marked_file.name)
+
+    def __iter__(self):
+        previous_offset = -1
+        # Variants yielded after the last record (unpaired breakends) are not indexed
+        record_offset, record_number = -1, -1
+        for variant_record in super().__iter__():
+            if variant_record.contig == _MARKER_CONTIG:
+                record_offset, record_number = (int(value) for value in variant_record.id.split('_'))
+                continue
+            if self.regions is not None and not self.regions(variant_record):
+                continue
+            offset = record_offset
+            self.ordinals.append(self.ordinals[-1] + 1 if offset != -1 and offset == previous_offset else 0)
+            self.offsets.append(offset)
+            self.numbers.append(record_number)
+            previous_offset = offset
+            if self.variant_filter is not None:
+                self.selected.append(self.variant_filter(variant_record))
+                if not self.selected[-1]:
+                    # Skipped variants keep their position, without text
+                    if self.raw_file is not None:
+                        self.raw_ends.append(self.raw_ends[-1] if len(self.raw_ends) > 0 else 0)
+                    if self.genes is not None:
+                        self._capture_genes(variant_record, False)
+                    continue
+            if self.raw_file is not None:
+                # Before yielding, as loading INFO or FORMAT fields changes the text of the record
+                raw_end = self.raw_ends[-1] if len(self.raw_ends) > 0 else 0
+                self.raw_ends.append(raw_end + self.raw_file.write((str(variant_record) + '\n').encode()))
+            if self.genes is not None:
+                # After keeping the text, as it loads the INFO fields
+                self._capture_genes(variant_record, True)
+            yield variant_record
+
+    def _capture_genes(self, variant_record: VariantRecord, selected: bool):
+        self.gene_annotated = self.gene_annotated or is_gene_annotated(variant_record)
+        self.genes.append(tuple(extract_protein_affected_genes(variant_record)) if selected else ())
+
+
+def _write_marked_records(f, records: _VcfRecords):
+    # Writes the records as a VCF file, each one after a marker record whose ID has its offset (-1 if it is not indexed)
+    # and its number (see _VcfRecords), followed by a last marker with neither
+    header = records.header.copy()
+    header.contigs.add(_MARKER_CONTIG)
+    f.write(str(header))
+    for record in records:
+        offset = -1 if records.offset is None or records.breakend else records.offset
+        f.write(f'{_MARKER_CONTIG}\t1\t{offset}_{records.number}\tAA\tA\t.\tPASS\t.\n')
+        f.write(str(record))
+    f.write(f'{_MARKER_CONTIG}\t1\t-1_-1\tAA\tA\t.\tPASS\t.\n')
+
+
+def _file_signature(vcf_file: str):
+    stat = os.stat(vcf_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _records_key(vcf_file: str, pass_only: bool, regions=None):
+    # Reads restricted to some regions number the variants among those in them, so their records are kept apart
+    return vcf_file, pass_only, repr(regions) if regions is not None else None
+
+
+def _store_record_index(vcf_file: str, pass_only: bool, offsets: np.ndarray, ordinals: np.ndarray, regions=None):
+    key = _records_key(vcf_file, pass_only, regions)
+    _RECORD_INDEXES[key] = (_file_signature(vcf_file), offsets, ordinals)
+    _RECORD_INDEXES.move_to_end(key)
+    while len(_RECORD_INDEXES) > RECORD_INDEX_CACHE_SIZE:
+        _RECORD_INDEXES.popitem(last=False)
+
+
+def _store_raw_records(vcf_file: str, pass_only: bool, raw_file, raw_ends: List[int], regions=None):
+    raw_file.flush()
+    if len(raw_ends) > 0 and raw_ends[-1] > 0:
+        # The mapping is kept after closing (and deleting) the temporary file
+        raw_data = np.memmap(raw_file, dtype=np.uint8, mode='r')
+    else:
+        raw_data = np.zeros(0, dtype=np.uint8)
+    raw_file.close()
+    _put_raw_records(vcf_file, pass_only, raw_data, np.concatenate([[0], raw_ends]).astype(np.int64), regions)
+
+
+def _put_raw_records(vcf_file: str, pass_only: bool, raw_data: np.ndarray, raw_ends: np.ndarray, regions=None):
+    # raw_ends starts with 0, so that the text of the i-th variant is raw_data[raw_ends[i]:raw_ends[i + 1]]
+    key = _records_key(vcf_file, pass_only, regions)
+    _RAW_RECORDS[key] = (_file_signature(vcf_file), raw_data, raw_ends)
+    _RAW_RECORDS.move_to_end(key)
+    while len(_RAW_RECORDS) > RECORD_INDEX_CACHE_SIZE:
+        _RAW_RECORDS.popitem(last=False)
+
+
+def _get_raw_records(vcf_file: str, pass_only: bool, regions=None):
+    raw_records = _RAW_RECORDS.get(_records_key(vcf_file, pass_only, regions))
+    # Discard the raw records if the file changed
+    if raw_records is None or raw_records[0] != _file_signature(vcf_file):
+        return None
+    return raw_records[1], raw_records[2]
+
+
+def _get_record_index(vcf_file: str, pass_only: bool, regions=None):
+    record_index = _RECORD_INDEXES.get(_records_key(vcf_file, pass_only, regions))
+    # Discard the index if the file changed
+    if record_index is None or record_index[0] != _file_signature(vcf_file):
+        return None
+    return record_index[1], record_index[2]
+
+
+def extract_variants(vcf_file: str, idx_list: List[int], pass_only: bool = True, regions=None) -> Iterator[VariantRecord]:
+    # If regions, idx_list are positions among the variants in them (see read_vcfs)
     if len(idx_list) == 0:
         return
-    extractor = VariantExtractor(vcf_file, pass_only=pass_only)
-    idx_list = set(idx_list)
+    idx_list = np.unique(np.asarray(idx_list, dtype=np.int64))
+    record_index = _get_record_index(vcf_file, pass_only, regions)
+    # Seeking is slower than reading the file when most of the variants are extracted
+    if record_index is not None and idx_list[-1] < len(record_index[0]) and (record_index[0][idx_list] >= 0).all() and \
+            len(idx_list) <= SEEK_MAX_VARIANTS_FRACTION * len(record_index[0]):
+        # Seek the records of the variants, which are read in the same order as the variants
+        offsets = record_index[0][idx_list]
+        record_offsets = offsets[np.flatnonzero(np.diff(offsets, prepend=-2) != 0)]
+        extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, offsets=record_offsets.tolist(), regions=regions)
+        variants = zip(offsets.tolist(), record_index[1][idx_list].tolist())
+        variant = next(variants)
+        for variant_record in extractor:
+            if (extractor.offsets[-1], extractor.ordinals[-1]) == variant:
+                yield variant_record
+                variant = next(variants, None)
+                if variant is None:
+                    break
+        extractor.close()
+        if variant is not None:
+            raise ValueError(f'Variants at offset {variant[0]} of VCF file {vcf_file} not found')
+        return
+    # Read the whole file, indexing it if not done yet
+    if record_index is None or regions is not None:
+        extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, regions=regions)
+    else:
+        extractor = VariantExtractor(vcf_file, pass_only=pass_only)
+    idx_list = set(idx_list.tolist())
     for i, variant_record in enumerate(extractor):
         if i in idx_list:
             idx_list.remove(i)
             yield variant_record
-            # If the idx_list is empty, we can stop
-            if len(idx_list) == 0:
+            # If the idx_list is empty, we can stop (unless indexing)
+            if len(idx_list) == 0 and record_index is not None:
                 break
+    if record_index is None and extractor.records is not None:
+        _store_record_index(vcf_file, pass_only, np.array(extractor.offsets, dtype=np.int64),
+                            np.array(extractor.ordinals, dtype=np.int64), regions)
     if len(idx_list) > 0:
         raise ValueError(f'Indices {idx_list} not found in VCF file {vcf_file}')
     extractor.close()
 
 
-def _iterate_records(variants_df: pd.DataFrame, template_vcfs: List[str]) -> Iterator[VariantRecord]:
-    # For each template_vcf create a VariantExtractor
-    for vcf_file in template_vcfs:
-        vcf_variants = variants_df[variants_df['vcf_file'] == vcf_file]
-        for i, variant_record in enumerate(extract_variants(vcf_file, vcf_variants['idx_in_file'], vcf_variants['pass_only'].iloc[0])):
-            variant_info = vcf_variants.iloc[i]
-            if 'GENES' in variant_info:
-                genes_symbols = variant_info['GENES']
-                if genes_symbols is not None and len(genes_symbols) > 0:
-                    variant_record.info[ONCOLINER_INFO_GENES_NAME] = list(genes_symbols)
-            yield variant_record
+def _bgzf_block(data: bytes, compresslevel: int) -> bytes:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra field holding the block size minus 1
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(compressed_data) + 25)
+    return header + compressed_data + struct.pack('<II', zlib.crc32(data), len(data))
 
 
-def write_masked_vcfs(variants_df: pd.DataFrame, output_path_prefix: str, indel_threshold: int, fasta_ref=None, command=None, gzip=True):
-    df_snv_mask = snv_mask(variants_df)
-    df_indel_mask = indel_mask(variants_df, indel_threshold)
-    df_snv = variants_df[df_snv_mask]
-    df_indel = variants_df[df_indel_mask]
-    df_sv = variants_df[~df_snv_mask & ~df_indel_mask]
-    for df_split, var_type in zip([df_snv, df_indel, df_sv], ['snv', 'indel', 'sv']):
-        if len(df_split) == 0:
-            continue
-        output_file_path = f'{output_path_prefix}{var_type}.vcf'
-        if gzip:
-            output_file_path += '.gz'
-        write_vcf(df_split, output_file_path, fasta_ref, command)
+class _BgzfWriter:
+    # Text file with BGZF compression (so that it can be indexed with tabix)
+    # The blocks are compressed in parallel by a pool of threads, as zlib releases the GIL
+    def __init__(self, path: str, threads=1, compresslevel=6):
+        self.__file = open(path, 'wb')
+        self.__threads = threads
+        self.__compresslevel = compresslevel
+        self.__pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.__pending_blocks = deque()
+        self.__buffer = []
+        self.__buffer_size = 0
+
+    def write(self, text: str):
+        data = text.encode()
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+        if self.__buffer_size >= _BGZF_BLOCK_SIZE:
+            self.__flush_blocks()
+
+    def __flush_blocks(self, final=False):
+        data = b''.join(self.__buffer)
+        blocks_end = len(data) if final else len(data) - len(data) % _BGZF_BLOCK_SIZE
+        for start in range(0, blocks_end, _BGZF_BLOCK_SIZE):
+            block = data[start:start + _BGZF_BLOCK_SIZE]
+            if self.__pool is None:
+                self.__file.write(_bgzf_block(block, self.__compresslevel))
+                continue
+            self.__pending_blocks.append(self.__pool.submit(_bgzf_block, block, self.__compresslevel))
+            # Write the finished blocks in order, keeping a few blocks per thread in flight
+            while len(self.__pending_blocks) > 4 * self.__threads or \
+                    (len(self.__pending_blocks) > 0 and self.__pending_blocks[0].done()):
+                self.__file.write(self.__pending_blocks.popleft().result())
+        self.__buffer = [data[blocks_end:]]
+        self.__buffer_size = len(data) - blocks_end
 
+    def close(self):
+        self.__flush_blocks(final=True)
+        while len(self.__pending_blocks) > 0:
+            self.__file.write(self.__pending_blocks.popleft().result())
+        if self.__pool is not None:
+            self.__pool.shutdown()
+        self.__file.write(_BGZF_EOF)
+        self.__file.close()
+
+
+class _SortedVcfWriter:
+    # Keeps the records to write them sorted by contig (in header order) and position when closed, as required by tabix
+    def __init__(self, f, contigs: List[str]):
+        self.__file = f
+        self.__contigs_order = {contig: i for i, contig in enumerate(contigs)}
+        self.__records = []
+
+    def write(self, variant_record_str: str):
+        chrom, pos, _ = variant_record_str.split('\t', 2)
+        contig_order = self.__contigs_order.get(chrom)
+        # Unknown contigs go last, grouped by name
+        if contig_order is None:
+            self.__records.append(((len(self.__contigs_order), chrom, int(pos)), variant_record_str))
+        else:
+            self.__records.append(((contig_order, '', int(pos)), variant_record_str))
 
-def write_vcf(variants_df: pd.DataFrame, output_vcf: str, fasta_ref=None, command=None, remove_chr=False):
+    def close(self):
+        self.__records.sort(key=lambda record: record[0])
+        for _, variant_record_str in self.__records:
+            self.__file.write(variant_record_str)
+        self.__file.close()
+
+
+def _open_vcf(variants_df: pd.DataFrame, output_vcf: str, fasta_ref=None, command=None, remove_chr=False, threads=1, index=None):
+    # Open output_vcf and write the header merged from the template VCFs of variants_df
     template_vcfs = list(variants_df['vcf_file'].unique())
     header, same_samples, same_formats = _extract_header(template_vcfs)
     # Add meta field with the command used to generate the VCF
     if command:
         header.add_meta('vcf_ops', command)
-    # Get contigs
-    contigs = _get_contigs(header, fasta_ref)
-    # Get contig order
-    contig_order = _get_contig_order(contigs)
-    # Add contig_order column
-    variants_df = variants_df.assign(contig_order=variants_df['start_chrom'].map(contig_order))
-    # Sort by chromosome and position
-    variants_df.sort_values(by=['contig_order', 'start'], inplace=True)
     # Apply contigs to header
-    _set_contigs(header, contigs, remove_chr)
+    _set_contigs(header, _get_contigs(header, fasta_ref), remove_chr)
     # Check if the VCF is gzipped
     if output_vcf.endswith('.gz'):
-        f = gzip.open(output_vcf, 'wt')
+        f = _BgzfWriter(output_vcf, threads)
     else:
         f = open(output_vcf, 'w', encoding='utf-8')
-    # Write the file
-    _write_raw_file(f, header, _iterate_records(variants_df, template_vcfs), same_samples, same_formats, remove_chr)
-    f.close()
+    _write_raw_header(f, header, same_samples, same_formats)
+    if index is not None:
+        f = _SortedVcfWriter(f, list(header.contigs))
+    return f, same_samples, same_formats
+
+
+def write_vcfs(variants_dfs: Dict[str, pd.DataFrame], fasta_ref=None, command=None, remove_chr=False, threads=1, index=None):
+    # Write each variants_df to its output VCF (the keys of variants_dfs) reading each template VCF once
+    # Compressed outputs are BGZF, compressed by threads in parallel
+    # If index is tbi or csi, the outputs are sorted by position and indexed with tabix
+    if index not in (None, 'tbi', 'csi'):
+        raise ValueError(f'Invalid index type {index}, it must be tbi or csi')
+    variants_dfs = {output_vcf: variants_df for output_vcf, variants_df in variants_dfs.items() if len(variants_df) > 0}
+    # Check all the outputs before opening any of them
+    if index is not None:
+        for output_vcf in variants_dfs:
+            if not output_vcf.endswith('.gz'):
+                raise ValueError(f'Only compressed VCF files can be indexed: {output_vcf}')
+    if len(variants_dfs) == 0:
+        return
+    outputs = []
+    try:
+        _write_vcfs(variants_dfs, outputs, fasta_ref, command, remove_chr, threads, index)
+    except BaseException:
+        # Close the outputs opened so far, so that their files and compression threads are released
+        for f, _, _, _ in outputs:
+            f.close()
+        raise
+    for f, _, _, output_vcf in outputs:
+        f.close()
+        if index is not None:
+            pysam.tabix_index(output_vcf, preset='vcf', force=True, csi=index == 'csi')
+
+
+def _write_vcfs(variants_dfs: Dict[str, pd.DataFrame], outputs: list, fasta_ref, command, remove_chr, threads, index):
+    # Open each output VCF (appending it to outputs) and write the records of its variants, see write_vcfs
+    routes = []
+    # Regions of the variants read restricted to them, by their repr (see read_vcfs)
+    views = {'': None}
+    for output_vcf, variants_df in variants_dfs.items():
+        outputs.append(_open_vcf(variants_df, output_vcf, fasta_ref, command, remove_chr, threads, index) + (output_vcf,))
+        vcf_routes = pd.DataFrame({'vcf_file': variants_df['vcf_file'].astype(str).to_numpy(),
+                                   'pass_only': variants_df['pass_only'].to_numpy(),
+                                   'view': '',
+                                   'idx_in_file': variants_df['idx_in_file'].to_numpy(),
+                                   'output': len(outputs) - 1,
+                                   'GENES': variants_df['GENES'].to_numpy() if 'GENES' in variants_df.columns else None})
+        for (vcf_file, pass_only), regions in variants_df.attrs.get('regions', {}).items():
+            views[repr(regions)] = regions
+            vcf_routes.loc[(vcf_routes['vcf_file'] == vcf_file) & (vcf_routes['pass_only'] == pass_only), 'view'] = repr(regions)
+        routes.append(vcf_routes)
+    # Each record is written once per output it is in
+    routes = pd.concat(routes, ignore_index=True).drop_duplicates(subset=['vcf_file', 'pass_only', 'view', 'idx_in_file', 'output'])
+    for (vcf_file, pass_only, view), vcf_routes in routes.groupby(['vcf_file', 'pass_only', 'view'], sort=False, observed=True):
+        regions = views[view]
+        vcf_routes = vcf_routes.sort_values(by=['idx_in_file', 'output'], kind='stable')
+        idx_in_file = vcf_routes['idx_in_file'].to_numpy()
+        routes_outputs = vcf_routes['output'].to_numpy()
+        routes_genes = vcf_routes['GENES'].to_numpy()
+        raw_records = _get_raw_records(vcf_file, pass_only, regions)
+        # Variants skipped by a filter have no text (see _IndexedVariantExtractor)
+        if raw_records is not None and idx_in_file[-1] < len(raw_records[1]) - 1 and \
+                np.all(raw_records[1][idx_in_file + 1] > raw_records[1][idx_in_file]):
+            # Copy the text of the records kept by read_vcfs
+            raw_data, raw_ends = raw_records
+            for i, idx in enumerate(idx_in_file.tolist()):
+                f, same_samples, same_formats, _ = outputs[routes_outputs[i]]
+                variant_record_str = bytes(raw_data[raw_ends[idx]:raw_ends[idx + 1]]).decode()
+                f.write(_edit_raw_record(variant_record_str, routes_genes[i], same_samples, same_formats, remove_chr))
+            continue
+        records_starts = np.flatnonzero(np.concatenate([[True], idx_in_file[1:] != idx_in_file[:-1]]))
+        records_ends = np.append(records_starts[1:], len(idx_in_file))
+        variant_records = extract_variants(vcf_file, idx_in_file[records_starts], pass_only, regions)
+        for start, end, variant_record in zip(records_starts, records_ends, variant_records):
+            for i in range(start, end):
+                f, same_samples, same_formats, _ = outputs[routes_outputs[i]]
+                _write_raw_record(f, variant_record, routes_genes[i], same_samples, same_formats, remove_chr)
+
+
+def write_labelled_vcfs(variants_dfs: Dict[str, pd.DataFrame], indel_threshold: int, fasta_ref=None, command=None, gzip=True,
+                        threads=1, index=None):
+    # Same as write_masked_vcfs for several variants_df at once, the keys of variants_dfs are the output path prefixes
+    output_dfs = dict()
+    for output_path_prefix, variants_df in variants_dfs.items():
+        df_snv_mask = snv_mask(variants_df)
+        df_indel_mask = indel_mask(variants_df, indel_threshold)
+        df_snv = variants_df[df_snv_mask]
+        df_indel = variants_df[df_indel_mask]
+        df_sv = variants_df[~df_snv_mask & ~df_indel_mask]
+        for df_split, var_type in zip([df_snv, df_indel, df_sv], ['snv', 'indel', 'sv']):
+            if len(df_split) == 0:
+                continue
+            output_file_path = f'{output_path_prefix}{var_type}.vcf'
+            if gzip:
+                output_file_path += '.gz'
+            output_dfs[output_file_path] = df_split
+    write_vcfs(output_dfs, fasta_ref, command, threads=threads, index=index)
+
+
+def write_masked_vcfs(variants_df: pd.DataFrame, output_path_prefix: str, indel_threshold: int, fasta_ref=None, command=None, gzip=True,
+                      threads=1, index=None):
+    write_labelled_vcfs({output_path_prefix: variants_df}, indel_threshold, fasta_ref, command, gzip, threads, index)
+
+
+def write_vcf(variants_df: pd.DataFrame, output_vcf: str, fasta_ref=None, command=None, remove_chr=False, threads=1, index=None):
+    write_vcfs({output_vcf: variants_df}, fasta_ref, command, remove_chr, threads, index)
+
+
+def _score_value(value):
+    # Multiple values (e.g. one per allele) are reduced to the maximum one
+    if isinstance(value, (tuple, list)):
+        values = [v for v in value if isinstance(v, (int, float))]
+        return max(values) if len(values) > 0 else None
+    return value if isinstance(value, (int, float)) else None
+
+
+def _score_getter(score_field):
+    # Score fields are QUAL, INFO/<KEY> or FORMAT/<KEY> (maximum value of all samples)
+    if score_field.upper() == 'QUAL':
+        return lambda variant_record: variant_record.qual
+    field_type, _, key = score_field.partition('/')
+    if field_type.upper() == 'INFO' and key:
+        return lambda variant_record: _score_value(variant_record.info.get(key))
+    if field_type.upper() == 'FORMAT' and key:
+        def format_score(variant_record):
+            values = [_score_value(sample.get(key)) for sample in variant_record.samples.values()]
+            values = [v for v in values if v is not None]
+            return max(values) if len(values) > 0 else None
+        return format_score
+    raise ValueError(f'Invalid score field {score_field}, it must be QUAL, INFO/<KEY> or FORMAT/<KEY>')
+
+
+def _variants_dataframe(extractor: VariantExtractor, score_field=None) -> pd.DataFrame:
+    if score_field is None:
+        return extractor.to_dataframe()
+    score_getter = _score_getter(score_field)
+    variants_df = extractor.to_dataframe(extra_fields=['variant_record_obj'])
+    variants_df['score'] = pd.to_numeric(variants_df['variant_record_obj'].map(score_getter), errors='coerce').astype(float)
+    variants_df.drop(columns='variant_record_obj', inplace=True)
+    return variants_df
 
 
-def _extract_variants(vcf_file, pass_only=True, ensure_pairs=True) -> pd.DataFrame:
+def _indexed_contigs(vcf_file: str):
+    # Contigs of an indexed VCF file and the offset of its first record (None if it is not indexed)
+    save = pysam.set_verbosity(0)
     try:
-        extractor = VariantExtractor(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs)
-        variants_df = extractor.to_dataframe()
+        variant_file = pysam.VariantFile(vcf_file)
+    except (OSError, NotImplementedError):
+        return None, None
+    finally:
+        pysam.set_verbosity(save)
+    contigs = list(variant_file.index) if variant_file.index is not None else None
+    first_offset = variant_file.tell()
+    variant_file.close()
+    return contigs, first_offset
+
+
+def _selected_variants(variants_df: pd.DataFrame, selected: np.ndarray):
+    # Variants read with a filter keep the index of the variant in the file, and the number of skipped ones
+    variants_df['idx_in_file'] = np.flatnonzero(selected)
+    variants_df.attrs['skipped_variants'] = int(len(selected) - len(variants_df))
+
+
+def _extract_contig_variants(vcf_file: str, contig: str, pass_only: bool, score_field, keep_raw_records: bool, variant_filter,
+                             gene_annotations: bool):
+    # Variants of the records of a contig, except breakends, which are paired with their mates afterwards
+    extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, raw_records=keep_raw_records, contig=contig,
+                                         skip_breakends=True, variant_filter=variant_filter, gene_annotations=gene_annotations)
+    variants_df = _variants_dataframe(extractor, score_field)
+    extractor.close()
+    raw_data = None
+    if extractor.raw_file is not None:
+        extractor.raw_file.seek(0)
+        raw_data = extractor.raw_file.read()
+        extractor.raw_file.close()
+    selected = np.array(extractor.selected, dtype=bool) if variant_filter is not None else np.ones(len(extractor.offsets), dtype=bool)
+    return variants_df, np.array(extractor.numbers, dtype=np.int64), np.array(extractor.offsets, dtype=np.int64), \
+        raw_data, np.array(extractor.raw_ends, dtype=np.int64), extractor.records.skipped_breakends, extractor.records.end_offset, \
+        selected, extractor.genes, extractor.gene_annotated
+
+
+def _record_ordinals(offsets: np.ndarray) -> np.ndarray:
+    # Position of each variant among the consecutive variants of the same record
+    positions = np.arange(len(offsets))
+    same_record = np.zeros(len(offsets), dtype=bool)
+    same_record[1:] = (offsets[1:] == offsets[:-1]) & (offsets[1:] != -1)
+    return positions - np.maximum.accumulate(np.where(same_record, 0, positions))
+
+
+def _write_reordered(raw_file, raw_data: bytes, raw_ends: np.ndarray, order: np.ndarray) -> np.ndarray:
+    # Writes the raw records in order, returning their new ends
+    ends = raw_ends[order]
+    starts = np.concatenate([[0], raw_ends[:-1]]).astype(np.int64)[order]
+    # Runs of records already consecutive in raw_data are written at once
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    raw_view = memoryview(raw_data)
+    for run_start, run_end in zip(np.concatenate([[0], breaks]).tolist(), np.concatenate([breaks, [len(order)]]).tolist()):
+        if run_end > run_start:
+            raw_file.write(raw_view[starts[run_start]:ends[run_end - 1]])
+    return np.cumsum(ends - starts)
+
+
+def _extract_variants_by_contig(vcf_file, contigs, first_offset, pool, pass_only=True, ensure_pairs=True, score_field=None,
+                                keep_raw_records=False, variant_filter=None, gene_annotations=False) -> pd.DataFrame:
+    # Each contig is parsed in the pool, then the breakends are paired reading only their records
+    # The variants are sorted as if the file had been read at once, so that idx_in_file does not change
+    futures = [pool.submit(_extract_contig_variants, vcf_file, contig, pass_only, score_field, keep_raw_records, variant_filter,
+                           gene_annotations)
+               for contig in contigs]
+    contig_results = [future.result() for future in futures]
+    # Records of a contig are contiguous in indexed files, so contigs are in file order sorting by their end offsets
+    contig_results = sorted([result for result in contig_results if result[6] is not None], key=lambda result: result[6])
+
+    variants_dfs, ranks, numbers, offsets, selected, raw_datas, raw_lengths = [], [], [], [], [], [], []
+    breakend_ranks, breakend_numbers, breakend_offsets = [], [], []
+    genes, gene_annotated = [], False
+    start_offset = first_offset
+    for rank, (variants_df, contig_numbers, contig_offsets, raw_data, raw_ends, skipped_breakends, end_offset, contig_selected,
+               contig_genes, contig_gene_annotated) in enumerate(contig_results):
+        # The first record of a contig starts where the previous one ends
+        contig_offsets[contig_numbers == 0] = start_offset
+        for number, offset in skipped_breakends:
+            breakend_ranks.append(rank)
+            breakend_numbers.append(number)
+            breakend_offsets.append(start_offset if offset is None else offset)
+        variants_dfs.append(variants_df)
+        ranks.append(np.full(len(contig_numbers), rank, dtype=np.int64))
+        numbers.append(contig_numbers)
+        offsets.append(contig_offsets)
+        selected.append(contig_selected)
+        if keep_raw_records:
+            raw_datas.append(raw_data)
+            raw_lengths.append(np.diff(raw_ends, prepend=0))
+        if gene_annotations:
+            genes.extend(contig_genes)
+            gene_annotated = gene_annotated or contig_gene_annotated
+        start_offset = end_offset
+
+    if len(breakend_offsets) > 0:
+        # Breakend variants are yielded with the record of their last mate, and unpaired ones at the end of the file
+        extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs,
+                                             raw_records=keep_raw_records, offsets=breakend_offsets, variant_filter=variant_filter,
+                                             gene_annotations=gene_annotations)
+        variants_df = _variants_dataframe(extractor, score_field)
         extractor.close()
+        breakend_positions = np.array(extractor.numbers, dtype=np.int64)
+        paired = breakend_positions >= 0
+        variants_dfs.append(variants_df)
+        ranks.append(np.where(paired, np.array(breakend_ranks, dtype=np.int64)[breakend_positions], len(contig_results)))
+        numbers.append(np.where(paired, np.array(breakend_numbers, dtype=np.int64)[breakend_positions], 0))
+        offsets.append(np.full(len(breakend_positions), -1, dtype=np.int64))
+        selected.append(np.array(extractor.selected, dtype=bool) if variant_filter is not None
+                        else np.ones(len(breakend_positions), dtype=bool))
+        if keep_raw_records:
+            extractor.raw_file.seek(0)
+            raw_datas.append(extractor.raw_file.read())
+            extractor.raw_file.close()
+            raw_lengths.append(np.diff(np.array(extractor.raw_ends, dtype=np.int64), prepend=0))
+        if gene_annotations:
+            genes.extend(extractor.genes)
+            gene_annotated = gene_annotated or extractor.gene_annotated
+
+    if len(variants_dfs) == 0:
+        variants_df = VariantExtractor.empty_dataframe(['score'] if score_field is not None else [])
+        if score_field is not None:
+            variants_df['score'] = variants_df['score'].astype(float)
+    else:
+        # Contigs without selected variants do not add rows
+        variants_df = pd.concat([df for df in variants_dfs if len(df) > 0] or variants_dfs[:1], ignore_index=True)
+    ranks = np.concatenate(ranks) if len(ranks) > 0 else np.zeros(0, dtype=np.int64)
+    numbers = np.concatenate(numbers) if len(numbers) > 0 else np.zeros(0, dtype=np.int64)
+    selected = np.concatenate(selected) if len(selected) > 0 else np.zeros(0, dtype=bool)
+    order = np.lexsort((numbers, ranks))
+    # The dataframes only have a row for each selected variant
+    sorted_selected = selected[order]
+    variants_df = variants_df.iloc[(np.cumsum(selected) - 1)[order][sorted_selected]].reset_index(drop=True)
+    # Same types as VariantExtractor.to_dataframe
+    variants_df = extractor_variants(variants_df)
+    if variant_filter is not None:
+        _selected_variants(variants_df, sorted_selected)
+
+    offsets = np.concatenate(offsets)[order] if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+    _store_record_index(vcf_file, pass_only, offsets, _record_ordinals(offsets))
+    if keep_raw_records:
+        raw_file = tempfile.TemporaryFile()
+        raw_ends = np.cumsum(np.concatenate(raw_lengths)) if len(raw_lengths) > 0 else np.zeros(0, dtype=np.int64)
+        raw_ends = _write_reordered(raw_file, b''.join(raw_datas), raw_ends, order)
+        _store_raw_records(vcf_file, pass_only, raw_file, raw_ends)
+    if gene_annotations:
+        store_gene_annotations(vcf_file, pass_only, gene_annotated, *encode_genes([genes[i] for i in order.tolist()]))
+    return variants_df
+
+
+def _extract_variants(vcf_file, pass_only=True, ensure_pairs=True, score_field=None, keep_raw_records=False, pool=None,
+                      cache_dir=None, variant_filter=None, gene_annotations=False, regions=None) -> pd.DataFrame:
+    try:
+        key = cache_key(vcf_file, _file_signature(vcf_file), pass_only, ensure_pairs, score_field, variant_filter,
+                        gene_annotations, regions) if cache_dir is not None else None
+        cached = load_cached_variants(cache_dir, key) if key is not None else None
+        if cached is not None:
+            variants_df, record_index, raw_records, cached_gene_annotations = cached
+            if record_index is not None:
+                _store_record_index(vcf_file, pass_only, *record_index, regions)
+            if raw_records is not None and keep_raw_records:
+                _put_raw_records(vcf_file, pass_only, *raw_records, regions)
+            if cached_gene_annotations is not None:
+                store_gene_annotations(vcf_file, pass_only, *cached_gene_annotations, regions)
+        else:
+            variants_df = _parse_variants(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs, score_field=score_field,
+                                          keep_raw_records=keep_raw_records or key is not None, pool=pool,
+                                          variant_filter=variant_filter, gene_annotations=gene_annotations, regions=regions)
+            if key is not None:
+                store_cached_variants(cache_dir, key, variants_df, _get_record_index(vcf_file, pass_only, regions),
+                                      _get_raw_records(vcf_file, pass_only, regions),
+                                      get_gene_annotations(vcf_file, pass_only, regions) if gene_annotations else None)
     except Exception as e:
         raise IOError(f'Error reading VCF file {vcf_file}') from e
+    idx_in_file = variants_df.pop('idx_in_file') if 'idx_in_file' in variants_df.columns else variants_df.index
     variants_df['vcf_file'] = vcf_file
     variants_df['vcf_file'] = variants_df['vcf_file'].astype('category')
     variants_df['pass_only'] = pass_only
     variants_df['pass_only'] = variants_df['pass_only'].astype('bool')
-    variants_df['idx_in_file'] = variants_df.index
+    variants_df['idx_in_file'] = idx_in_file
+    if regions is not None:
+        variants_df.attrs['regions'] = {(vcf_file, pass_only): regions}
     return variants_df
 
 
-def read_vcfs(vcf_files, pass_only=True, ensure_pairs=True) -> pd.DataFrame:
+def _parse_variants(vcf_file, pass_only=True, ensure_pairs=True, score_field=None, keep_raw_records=False, pool=None,
+                    variant_filter=None, gene_annotations=False, regions=None) -> pd.DataFrame:
+    contigs, first_offset = _indexed_contigs(vcf_file) if pool is not None and regions is None else (None, None)
+    if contigs is not None and len(contigs) > 1:
+        return _extract_variants_by_contig(vcf_file, contigs, first_offset, pool, pass_only=pass_only,
+                                           ensure_pairs=ensure_pairs, score_field=score_field,
+                                           keep_raw_records=keep_raw_records, variant_filter=variant_filter,
+                                           gene_annotations=gene_annotations)
+    extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs, raw_records=keep_raw_records,
+                                         variant_filter=variant_filter, gene_annotations=gene_annotations, regions=regions)
+    variants_df = _variants_dataframe(extractor, score_field)
+    extractor.close()
+    if variant_filter is not None:
+        _selected_variants(variants_df, np.array(extractor.selected, dtype=bool))
+    # Index the records so that extract_variants can seek them
+    if extractor.records is not None:
+        _store_record_index(vcf_file, pass_only, np.array(extractor.offsets, dtype=np.int64),
+                            np.array(extractor.ordinals, dtype=np.int64), regions)
+    if extractor.raw_file is not None:
+        _store_raw_records(vcf_file, pass_only, extractor.raw_file, extractor.raw_ends, regions)
+    if gene_annotations:
+        store_gene_annotations(vcf_file, pass_only, extractor.gene_annotated, *encode_genes(extractor.genes), regions)
+    return variants_df
+
+
+def read_gene_annotations(vcf_file: str, pass_only: bool = True, regions=None):
+    # Gene annotations of the variants of a VCF file, as captured by read_vcfs(gene_annotations=True), see store_gene_annotations
+    # Unpaired breakends are numbered the same whether they are ensured or not
+    extractor = _IndexedVariantExtractor(vcf_file, pass_only=pass_only, ensure_pairs=False, gene_annotations=True,
+                                         regions=regions)
+    for _ in extractor:
+        pass
+    extractor.close()
+    store_gene_annotations(vcf_file, pass_only, extractor.gene_annotated, *encode_genes(extractor.genes), regions)
+    return get_gene_annotations(vcf_file, pass_only, regions)
+
+
+def read_vcfs(vcf_files, pass_only=True, ensure_pairs=True, score_field=None, keep_raw_records=False, processes=1,
+              cache_dir=None, variant_filter=None, gene_annotations=False, regions=None) -> pd.DataFrame:
+    # If score_field is set (QUAL, INFO/<KEY> or FORMAT/<KEY>), its value is stored in the score column
+    # If keep_raw_records, the text of the records is kept (memory-mapped) so that writing them does not parse the VCF again
+    # If processes > 1, indexed VCF files are parsed by contig in parallel
+    # If cache_dir (by default, the ONCOLINER_VCF_CACHE_DIR environment variable) is set, parsed files are cached there
+    # by content, and files with the same content are loaded from it instead of parsed again
+    # If variant_filter (see VariantFilter), only the variants it selects are added to the dataframe (keeping their
+    # idx_in_file), and the number of skipped variants is stored in its skipped_variants attribute
+    # If gene_annotations, the protein affected genes of the variants are kept for combine_gene_annotations
+    # If regions (see BedMask), only the variants with a breakpoint in them are read, fetching their records if the VCF file
+    # is indexed (tabix or CSI), and their idx_in_file is their position among them. The regions are kept in the regions
+    # attribute of the dataframe (see regions_view), so dataframes with these variants must be concatenated with concat_variants
+    cache_dir = cache_dir if cache_dir is not None else cache_dir_from_env()
     if len(vcf_files) == 0:
-        empty_df = VariantExtractor.empty_dataframe()
-        empty_df.columns += ['vcf_file', 'pass_only', 'idx_in_file']
+        empty_df = VariantExtractor.empty_dataframe(['score'] if score_field is not None else [])
+        empty_df = empty_df.reindex(columns=list(empty_df.columns) + ['vcf_file', 'pass_only', 'idx_in_file'])
         empty_df['vcf_file'] = empty_df['vcf_file'].astype('category')
         empty_df['pass_only'] = empty_df['pass_only'].astype('bool')
+        if score_field is not None:
+            empty_df['score'] = empty_df['score'].astype(float)
+        empty_df = compact_variants(empty_df)
+        if variant_filter is not None:
+            empty_df.attrs['skipped_variants'] = 0
         return empty_df
-    vcf_dfs = [_extract_variants(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs) for vcf_file in vcf_files]
-    return pd.concat(vcf_dfs, ignore_index=True)
+    pool = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    try:
+        vcf_dfs = [_extract_variants(vcf_file, pass_only=pass_only, ensure_pairs=ensure_pairs, score_field=score_field,
+                                     keep_raw_records=keep_raw_records, pool=pool, cache_dir=cache_dir,
+                                     variant_filter=variant_filter, gene_annotations=gene_annotations, regions=regions)
+                   for vcf_file in vcf_files]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    variants_df = compact_variants(concat_variants(vcf_dfs, ignore_index=True))
+    if variant_filter is not None:
+        variants_df.attrs['skipped_variants'] = sum(vcf_df.attrs['skipped_variants'] for vcf_df in vcf_dfs)
+    return variants_df
@@ -1,80 +1,206 @@
 # Copyright 2023 - Barcelona Supercomputing Center
 # Author: Rodrigo Martín
 # BSC Dual License
+from concurrent.futures import ProcessPoolExecutor, Future
 import pandas as pd
 
 from variant_extractor.variants import VariantType
 
-from ._internal.internal_ops import intersect_exact, intersect_window  # noqa
+from ._internal.internal_ops import intersect_exact, intersect_window, window_index, window_candidates  # noqa
 from .masks import snv_mask, indel_mask  # noqa
-
-
-def intersect(df_truth, df_test, indel_threshold, window_radius):
-    # Intersect SNVs comparing start position and alt
-    snv_truth_mask = snv_mask(df_truth)
-    snv_test_mask = snv_mask(df_test)
-    snv_truth = df_truth[snv_truth_mask]
-    snv_test = df_test[snv_test_mask]
-    snv_tp, snv_tp_dup, snv_fp, snv_fp_dup, snv_fn, snv_fn_dup = \
-        intersect_exact(snv_truth, snv_test, ['start_chrom', 'start', 'alt'])
-    # Remove from the rest from the intersection
-    df_truth = df_truth[~snv_truth_mask]
-    df_test = df_test[~snv_test_mask]
-
-    # Intersect indel ins/dup start position and alt
-    indel_ins_truth_mask = indel_mask(df_truth, indel_threshold) & (df_truth['type_inferred'] != VariantType.DEL.name)
-    indel_ins_test_mask = indel_mask(df_test, indel_threshold) & (df_test['type_inferred'] != VariantType.DEL.name)
-    indel_ins_truth = df_truth[indel_ins_truth_mask]
-    indel_ins_test = df_test[indel_ins_test_mask]
-    indel_ins_tp, indel_ins_tp_dup, indel_ins_fp, indel_ins_fp_dup, indel_ins_fn, indel_ins_fn_dup = \
-        intersect_exact(indel_ins_truth, indel_ins_test, ['start_chrom', 'start', 'alt'])
-    # Remove from the rest from the intersection
-    df_truth = df_truth[~indel_ins_truth_mask]
-    df_test = df_test[~indel_ins_test_mask]
-
-    # Intersect indel deletions comparing start position and length
-    indel_del_truth_mask = indel_mask(df_truth, indel_threshold) & (df_truth['type_inferred'] == VariantType.DEL.name)
-    indel_del_test_mask = indel_mask(df_test, indel_threshold) & (df_test['type_inferred'] == VariantType.DEL.name)
-    indel_del_truth = df_truth[indel_del_truth_mask]
-    indel_del_test = df_test[indel_del_test_mask]
-    indel_del_tp, indel_del_tp_dup, indel_del_fp, indel_del_fp_dup, indel_del_fn, indel_del_fn_dup = \
-        intersect_exact(indel_del_truth, indel_del_test, ['start_chrom', 'start', 'length'])
-    # Remove from the rest from the intersection
-    df_truth = df_truth[~indel_del_truth_mask]
-    df_test = df_test[~indel_del_test_mask]
-
-    # Intersect INS comparing start position and length with a window
-    ins_truth_mask = df_truth['type_inferred'] == VariantType.INS.name
-    ins_test_mask = df_test['type_inferred'] == VariantType.INS.name
-    ins_truth = df_truth[ins_truth_mask]
-    ins_test = df_test[ins_test_mask]
+from .schema import concat_variants  # noqa
+from .constants import DEFAULT_MAX_WINDOW_PAIRS  # noqa
+
+# Matching and window fields of the variants intersected with a window
+_INS_WINDOW_FIELDS = (['start_chrom'], ['start', 'length'])
+_SV_WINDOW_FIELDS = (['start_chrom', 'end_chrom'], ['start', 'end'])
+
+
+class IntersectIndex:
+    # Variants of a dataframe split by intersection class, with the breakpoints of the classes
+    # intersected with a window already indexed
+    # Build it once to intersect the same dataframe against many others
+    def __init__(self, df, indel_threshold):
+        self.df = df
+        self.indel_threshold = indel_threshold
+        # SNVs
+        snv_df_mask = snv_mask(df)
+        self.snv = df[snv_df_mask]
+        df = df[~snv_df_mask]
+        # Indel ins/dup
+        indel_ins_df_mask = indel_mask(df, indel_threshold) & (df['type_inferred'] != VariantType.DEL.name)
+        self.indel_ins = df[indel_ins_df_mask]
+        df = df[~indel_ins_df_mask]
+        # Indel deletions
+        indel_del_df_mask = indel_mask(df, indel_threshold) & (df['type_inferred'] == VariantType.DEL.name)
+        self.indel_del = df[indel_del_df_mask]
+        df = df[~indel_del_df_mask]
+        # INS
+        ins_df_mask = df['type_inferred'] == VariantType.INS.name
+        self.ins = df[ins_df_mask]
+        self.ins_window_index = window_index(self.ins, *_INS_WINDOW_FIELDS)
+        df = df[~ins_df_mask]
+        # Rest of SVs by bracket
+        self.sv_brackets = {}
+        for bracket in df['brackets'].unique():
+            bracket_df_mask = df['brackets'] == bracket
+            sv_bracket = df[bracket_df_mask]
+            self.sv_brackets[bracket] = (sv_bracket, window_index(sv_bracket, *_SV_WINDOW_FIELDS))
+            df = df[~bracket_df_mask]
+        self.empty = df.iloc[:0]
+
+    def sv_bracket(self, bracket):
+        return self.sv_brackets.get(bracket, (self.empty, None))
+
+
+def _chromosome_shards(df_truth, df_test):
+    # All variant types are only matched within the same start chromosome,
+    # so each start chromosome can be intersected independently
+    chroms = concat_variants([df_truth[['start_chrom']], df_test[['start_chrom']]], ignore_index=True)['start_chrom']
+    chrom_codes, chrom_uniques = pd.factorize(chroms, use_na_sentinel=False)
+    truth_chrom_codes = chrom_codes[:len(df_truth)]
+    test_chrom_codes = chrom_codes[len(df_truth):]
+    for chrom_code in range(len(chrom_uniques)):
+        yield df_truth[truth_chrom_codes == chrom_code], df_test[test_chrom_codes == chrom_code]
+
+
+def _submit_intersection(pool, intersect_func, df_truth, df_test, *args, **window_indexes):
+    if pool is None:
+        return [intersect_func(df_truth, df_test, *args, **window_indexes)]
+    # Window indexes refer to the whole dataframes, so each shard builds its own
+    futures = [pool.submit(intersect_func, shard_truth, shard_test, *args)
+               for shard_truth, shard_test in _chromosome_shards(df_truth, df_test)]
+    if len(futures) == 0:
+        return [intersect_func(df_truth, df_test, *args, **window_indexes)]
+    return futures
+
+
+def _gather_intersection(results):
+    # Concatenate the results of all shards in submission order
+    results = [result.result() if isinstance(result, Future) else result for result in results]
+    return tuple(concat_variants(dfs) for dfs in zip(*results))
+
+
+def intersect(df_truth, df_test, indel_threshold, window_radius, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS, processes=1):
+    # Both df_truth and df_test can be an IntersectIndex to reuse it in multiple intersections
+    truth_index = df_truth if isinstance(df_truth, IntersectIndex) else IntersectIndex(df_truth, indel_threshold)
+    test_index = df_test if isinstance(df_test, IntersectIndex) else IntersectIndex(df_test, indel_threshold)
+    if truth_index.indel_threshold != indel_threshold or test_index.indel_threshold != indel_threshold:
+        raise ValueError(f'IntersectIndex must be built with the same indel threshold ({indel_threshold})')
+    # Shard each variant type by chromosome in a process pool if more than one process is requested
+    pool = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    try:
+        # Intersect SNVs comparing start position and alt
+        snv_results = _submit_intersection(pool, intersect_exact, truth_index.snv, test_index.snv,
+                                           ['start_chrom', 'start', 'alt'])
+
+        # Intersect indel ins/dup start position and alt
+        indel_ins_results = _submit_intersection(pool, intersect_exact, truth_index.indel_ins, test_index.indel_ins,
+                                                 ['start_chrom', 'start', 'alt'])
+
+        # Intersect indel deletions comparing start position and length
+        indel_del_results = _submit_intersection(pool, intersect_exact, truth_index.indel_del, test_index.indel_del,
+                                                 ['start_chrom', 'start', 'length'])
+
+        # Intersect INS comparing start position and length with a window
+        ins_results = _submit_intersection(pool, intersect_window, truth_index.ins, test_index.ins, *_INS_WINDOW_FIELDS,
+                                           window_radius, max_window_pairs,
+                                           truth_window_index=truth_index.ins_window_index,
+                                           test_window_index=test_index.ins_window_index)
+
+        # Intersect rest of SVs comparing start and end positions with a window
+        sv_results_list = []
+
+        for bracket in set(truth_index.sv_brackets.keys()).union(set(test_index.sv_brackets.keys())):
+            sv_truth_bracket, sv_truth_window_index = truth_index.sv_bracket(bracket)
+            sv_test_bracket, sv_test_window_index = test_index.sv_bracket(bracket)
+
+            sv_results_list.append(_submit_intersection(pool, intersect_window, sv_truth_bracket, sv_test_bracket,
+                                                        *_SV_WINDOW_FIELDS, window_radius, max_window_pairs,
+                                                        truth_window_index=sv_truth_window_index,
+                                                        test_window_index=sv_test_window_index))
+
+        snv_results = _gather_intersection(snv_results)
+        indel_ins_results = _gather_intersection(indel_ins_results)
+        indel_del_results = _gather_intersection(indel_del_results)
+        ins_results = _gather_intersection(ins_results)
+        sv_results_list = [_gather_intersection(sv_results) for sv_results in sv_results_list]
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return _concat_intersections(snv_results, indel_ins_results, indel_del_results, ins_results, sv_results_list)
+
+
+def intersect_window_radii(df_truth, df_test, indel_threshold, window_radii, max_window_pairs=DEFAULT_MAX_WINDOW_PAIRS, processes=1):
+    # Same as intersect, but for multiple window radii at once, returning a list with the results of each one
+    # The candidate pairs of the variants intersected with a window are only generated once with the largest radius
+    truth_index = df_truth if isinstance(df_truth, IntersectIndex) else IntersectIndex(df_truth, indel_threshold)
+    test_index = df_test if isinstance(df_test, IntersectIndex) else IntersectIndex(df_test, indel_threshold)
+    if truth_index.indel_threshold != indel_threshold or test_index.indel_threshold != indel_threshold:
+        raise ValueError(f'IntersectIndex must be built with the same indel threshold ({indel_threshold})')
+    if processes <= 1:
+        return _intersect_window_radii(truth_index, test_index, indel_threshold, window_radii, max_window_pairs)
+    # Shard the whole sweep by chromosome in a process pool, as intersect does
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        futures = [pool.submit(_intersect_window_radii, shard_truth, shard_test, indel_threshold, window_radii, max_window_pairs)
+                   for shard_truth, shard_test in _chromosome_shards(truth_index.df, test_index.df)]
+        if len(futures) == 0:
+            return _intersect_window_radii(truth_index, test_index, indel_threshold, window_radii, max_window_pairs)
+        shards_results = [future.result() for future in futures]
+    finally:
+        pool.shutdown(cancel_futures=True)
+    # Concatenate the results of all shards of each window radius in submission order
+    return [tuple(concat_variants(dfs) for dfs in zip(*radius_results)) for radius_results in zip(*shards_results)]
+
+
+def _intersect_window_radii(df_truth, df_test, indel_threshold, window_radii, max_window_pairs):
+    truth_index = df_truth if isinstance(df_truth, IntersectIndex) else IntersectIndex(df_truth, indel_threshold)
+    test_index = df_test if isinstance(df_test, IntersectIndex) else IntersectIndex(df_test, indel_threshold)
+    max_window_radius = max(window_radii)
+
+    # SNVs and indels do not depend on the window radius
+    snv_results = intersect_exact(truth_index.snv, test_index.snv, ['start_chrom', 'start', 'alt'])
+    indel_ins_results = intersect_exact(truth_index.indel_ins, test_index.indel_ins, ['start_chrom', 'start', 'alt'])
+    indel_del_results = intersect_exact(truth_index.indel_del, test_index.indel_del, ['start_chrom', 'start', 'length'])
+
+    # Generate the candidates of INS and the rest of SVs
+    ins_candidates = window_candidates(truth_index.ins, test_index.ins, *_INS_WINDOW_FIELDS, max_window_radius,
+                                       max_window_pairs, truth_index.ins_window_index, test_index.ins_window_index)
+    sv_brackets = []
+    for bracket in set(truth_index.sv_brackets.keys()).union(set(test_index.sv_brackets.keys())):
+        sv_truth_bracket, sv_truth_window_index = truth_index.sv_bracket(bracket)
+        sv_test_bracket, sv_test_window_index = test_index.sv_bracket(bracket)
+        sv_candidates = window_candidates(sv_truth_bracket, sv_test_bracket, *_SV_WINDOW_FIELDS, max_window_radius,
+                                          max_window_pairs, sv_truth_window_index, sv_test_window_index)
+        sv_brackets.append((sv_truth_bracket, sv_test_bracket, sv_candidates))
+
+    results = []
+    for window_radius in window_radii:
+        ins_results = intersect_window(truth_index.ins, test_index.ins, *_INS_WINDOW_FIELDS, window_radius, max_window_pairs,
+                                       candidates=ins_candidates)
+        sv_results_list = [intersect_window(sv_truth_bracket, sv_test_bracket, *_SV_WINDOW_FIELDS, window_radius,
+                                            max_window_pairs, candidates=sv_candidates)
+                           for sv_truth_bracket, sv_test_bracket, sv_candidates in sv_brackets]
+        results.append(_concat_intersections(snv_results, indel_ins_results, indel_del_results, ins_results, sv_results_list))
+    return results
+
+
+def _concat_intersections(snv_results, indel_ins_results, indel_del_results, ins_results, sv_results_list):
+    snv_tp, snv_tp_dup, snv_fp, snv_fp_dup, snv_fn, snv_fn_dup = snv_results
+    indel_ins_tp, indel_ins_tp_dup, indel_ins_fp, indel_ins_fp_dup, indel_ins_fn, indel_ins_fn_dup = indel_ins_results
+    indel_del_tp, indel_del_tp_dup, indel_del_fp, indel_del_fp_dup, indel_del_fn, indel_del_fn_dup = indel_del_results
     ins_tp, ins_tp_dup,\
         ins_fp, ins_fp_dup,\
-        ins_fn, ins_fn_dup = intersect_window(ins_truth, ins_test, ['start_chrom'],
-                                              ['start', 'length'], window_radius)
-    # Remove from the rest from the intersection
-    df_truth = df_truth[~ins_truth_mask]
-    df_test = df_test[~ins_test_mask]
-
-    # Intersect rest of SVs comparing start and end positions with a window
+        ins_fn, ins_fn_dup = ins_results
     sv_tp_list, sv_tp_dup_list = [], []
     sv_fp_list, sv_fp_dup_list = [], []
     sv_fn_list, sv_fn_dup_list = [], []
-
-    for bracket in set(df_truth['brackets'].unique()).union(set(df_test['brackets'].unique())):
-        bracket_truth_mask = df_truth['brackets'] == bracket
-        bracket_test_mask = df_test['brackets'] == bracket
-
-        sv_truth_bracket = df_truth[bracket_truth_mask]
-        sv_test_bracket = df_test[bracket_test_mask]
-
-        df_truth = df_truth[~bracket_truth_mask]
-        df_test = df_test[~bracket_test_mask]
-
+    for sv_results in sv_results_list:
         sv_tp, sv_tp_dup,\
             sv_fp, sv_fp_dup,\
-            sv_fn, sv_fn_dup = intersect_window(sv_truth_bracket, sv_test_bracket, ['start_chrom', 'end_chrom'],
-                                                ['start', 'end'], window_radius)
+            sv_fn, sv_fn_dup = sv_results
 
         sv_tp_list.append(sv_tp)
         sv_tp_dup_list.append(sv_tp_dup)
@@ -84,19 +210,19 @@ def intersect(df_truth, df_test, indel_threshold, window_radius):
         sv_fn_dup_list.append(sv_fn_dup)
 
     # Concatenate results from all bracket types
-    sv_tp = pd.concat(sv_tp_list) if sv_tp_list else pd.DataFrame()
-    sv_tp_dup = pd.concat(sv_tp_dup_list) if sv_tp_dup_list else pd.DataFrame()
-    sv_fp = pd.concat(sv_fp_list) if sv_fp_list else pd.DataFrame()
-    sv_fp_dup = pd.concat(sv_fp_dup_list) if sv_fp_dup_list else pd.DataFrame()
-    sv_fn = pd.concat(sv_fn_list) if sv_fn_list else pd.DataFrame()
-    sv_fn_dup = pd.concat(sv_fn_dup_list) if sv_fn_dup_list else pd.DataFrame()
+    sv_tp = concat_variants(sv_tp_list)
+    sv_tp_dup = concat_variants(sv_tp_dup_list)
+    sv_fp = concat_variants(sv_fp_list)
+    sv_fp_dup = concat_variants(sv_fp_dup_list)
+    sv_fn = concat_variants(sv_fn_list)
+    sv_fn_dup = concat_variants(sv_fn_dup_list)
 
     # Concatenate all results
-    df_tp = pd.concat([snv_tp, indel_ins_tp, indel_del_tp, ins_tp, sv_tp])
-    df_tp_dup = pd.concat([snv_tp_dup, indel_ins_tp_dup, indel_del_tp_dup, ins_tp_dup, sv_tp_dup])
-    df_fp = pd.concat([snv_fp, indel_ins_fp, indel_del_fp, ins_fp, sv_fp])
-    df_fp_dup = pd.concat([snv_fp_dup, indel_ins_fp_dup, indel_del_fp_dup, ins_fp_dup, sv_fp_dup])
-    df_fn = pd.concat([snv_fn, indel_ins_fn, indel_del_fn, ins_fn, sv_fn])
-    df_fn_dup = pd.concat([snv_fn_dup, indel_ins_fn_dup, indel_del_fn_dup, ins_fn_dup, sv_fn_dup])
+    df_tp = concat_variants([snv_tp, indel_ins_tp, indel_del_tp, ins_tp, sv_tp])
+    df_tp_dup = concat_variants([snv_tp_dup, indel_ins_tp_dup, indel_del_tp_dup, ins_tp_dup, sv_tp_dup])
+    df_fp = concat_variants([snv_fp, indel_ins_fp, indel_del_fp, ins_fp, sv_fp])
+    df_fp_dup = concat_variants([snv_fp_dup, indel_ins_fp_dup, indel_del_fp_dup, ins_fp_dup, sv_fp_dup])
+    df_fn = concat_variants([snv_fn, indel_ins_fn, indel_del_fn, ins_fn, sv_fn])
+    df_fn_dup = concat_variants([snv_fn_dup, indel_ins_fn_dup, indel_del_fn_dup, ins_fn_dup, sv_fn_dup])
 
     return df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup
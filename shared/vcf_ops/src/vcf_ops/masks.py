@@ -1,8 +1,18 @@
 # Copyright 2023 - Barcelona Supercomputing Center
 # Author: Rodrigo Martín
 # BSC Dual License
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from pandas.errors import EmptyDataError
 from variant_extractor.variants import VariantType
 
+from .cache import cache_dir_from_env, regions_cache_key, load_cached_regions, store_cached_regions  # noqa
+
+# Regions of the BED files already read by this process, by path and signature (see read_bed_regions)
+_BED_REGIONS = {}
+
 
 def snv_mask(df):
     return df['type_inferred'] == VariantType.SNV.name
@@ -10,5 +20,191 @@ def snv_mask(df):
 
 def indel_mask(df, indel_threshold):
     return (df['length'] > 0) & (df['length'] <= indel_threshold) & (df['alt'] != '<INS>') & \
-        (df['type_inferred'] != VariantType.SNV.name) & \
-        (df['type_inferred'] != VariantType.INV.name) & (df['type_inferred'] != VariantType.TRA.name)
+        ~df['type_inferred'].isin([VariantType.SNV.name, VariantType.INV.name, VariantType.TRA.name])
+
+
+class VariantFilter:
+    # Selects variants by contig and variant type (e.g. SNV, INDEL-DEL or SV-INV), skipping 0-length variants
+    # It can select the rows of a dataframe (mask) or the variants while reading a VCF file (see read_vcfs)
+    def __init__(self, contigs, variant_types, indel_threshold):
+        self.contigs = frozenset(contigs)
+        self.indel_threshold = indel_threshold
+        # Types selected with any length, only as indels and only as SVs
+        self.types = set()
+        self.indel_types = set()
+        self.sv_types = set()
+        for variant_type in variant_types:
+            variant_type_split = variant_type.split('-')
+            if len(variant_type_split) == 1:
+                self.types.add(variant_type)
+            elif len(variant_type_split) == 2:
+                general_variant_type, specific_variant_type = variant_type_split
+                # INV and TRA do not need to filter size
+                if specific_variant_type.upper() == 'INV' or specific_variant_type.upper() == 'TRA':
+                    self.types.add(specific_variant_type)
+                elif general_variant_type.upper() == 'SV':
+                    self.sv_types.add(specific_variant_type)
+                elif general_variant_type.upper() == 'INDEL':
+                    self.indel_types.add(specific_variant_type)
+                else:
+                    raise ValueError(f'Invalid variant type {variant_type}')
+            else:
+                raise ValueError(f'Invalid variant type {variant_type}')
+
+    def __repr__(self):
+        return f'VariantFilter(contigs={sorted(self.contigs)}, types={sorted(self.types)}, indel_types={sorted(self.indel_types)}, ' \
+            f'sv_types={sorted(self.sv_types)}, indel_threshold={self.indel_threshold})'
+
+    def mask(self, df):
+        types = df['type_inferred']
+        length = df['length']
+        types_mask = types.isin(self.types) | (types.isin(self.sv_types) & (length > self.indel_threshold)) | \
+            (types.isin(self.indel_types) & (length <= self.indel_threshold))
+        length_mask = (length == 0) & ~types.isin([VariantType.SNV.name, VariantType.TRA.name, VariantType.SGL.name])
+        contigs_mask = df['start_chrom'].isin(self.contigs) & df['end_chrom'].isin(self.contigs)
+        return types_mask & contigs_mask & ~length_mask
+
+    def __call__(self, variant_record) -> bool:
+        # Same chromosomes as VariantExtractor.to_dataframe
+        start_chrom = variant_record.contig.replace('chr', '')
+        end_chrom = variant_record.alt_sv_breakend.contig.replace('chr', '') if variant_record.alt_sv_breakend else start_chrom
+        if start_chrom not in self.contigs or end_chrom not in self.contigs:
+            return False
+        variant_type = variant_record.variant_type.name
+        length = variant_record.length
+        if length == 0 and variant_type not in (VariantType.SNV.name, VariantType.TRA.name, VariantType.SGL.name):
+            return False
+        return variant_type in self.types or (variant_type in self.sv_types and length > self.indel_threshold) or \
+            (variant_type in self.indel_types and length <= self.indel_threshold)
+
+
+def _read_bed(bed_path):
+    # Chromosome, start and end columns of a BED file (empty if the file is)
+    # Chromosomes are named without chr, as in the variants dataframes, so BED files match with or without the prefix
+    try:
+        bed_df = pd.read_csv(bed_path, sep='\t', header=None, usecols=[0, 1, 2], dtype={0: str})
+    except EmptyDataError:
+        bed_df = pd.DataFrame({0: pd.Series(dtype=str), 1: pd.Series(dtype=np.int64), 2: pd.Series(dtype=np.int64)})
+    bed_df[0] = bed_df[0].str.replace('chr', '')
+    return bed_df
+
+
+def _merge_intervals(starts, ends):
+    # Sorted, non-overlapping intervals covering the same positions as the closed intervals [starts, ends] (not empty)
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    # An interval starts a new group if it starts after all the previous ones end
+    new_group = np.ones(len(starts), dtype=bool)
+    new_group[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+    group_starts = np.flatnonzero(new_group)
+    return starts[group_starts], np.maximum.reduceat(ends, group_starts)
+
+
+def _preprocess_bed(bed_path):
+    # Chromosomes, and chromosome codes, starts and ends of the merged regions of a BED file, sorted by chromosome code
+    bed_df = _read_bed(bed_path)
+    chroms, chroms_starts, chroms_ends = [], [], []
+    for chrom, chrom_df in bed_df.groupby(0, sort=False):
+        chrom_starts, chrom_ends = _merge_intervals(chrom_df[1].to_numpy(dtype=np.int64), chrom_df[2].to_numpy(dtype=np.int64))
+        chroms.append(chrom)
+        chroms_starts.append(chrom_starts)
+        chroms_ends.append(chrom_ends)
+    chrom_codes = np.repeat(np.arange(len(chroms), dtype=np.int32), [len(chrom_starts) for chrom_starts in chroms_starts])
+    return chroms, chrom_codes, np.concatenate(chroms_starts or [np.zeros(0, dtype=np.int64)]), \
+        np.concatenate(chroms_ends or [np.zeros(0, dtype=np.int64)])
+
+
+def read_bed_regions(bed_path, cache_dir=None):
+    # Merged regions of a BED file by chromosome (see BedMask), read once per process
+    # If cache_dir (by default, the ONCOLINER_VCF_CACHE_DIR environment variable) is set, BED files are preprocessed once
+    # per content, and their regions are memory-mapped from it afterwards
+    stat = os.stat(bed_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    memo_key = (os.path.abspath(bed_path), signature)
+    if memo_key not in _BED_REGIONS:
+        cache_dir = cache_dir if cache_dir is not None else cache_dir_from_env()
+        key = regions_cache_key(bed_path, signature) if cache_dir is not None else None
+        regions = load_cached_regions(cache_dir, key) if key is not None else None
+        if regions is None:
+            regions = _preprocess_bed(bed_path)
+            if key is not None:
+                store_cached_regions(cache_dir, key, *regions)
+        chroms, chrom_codes, starts, ends = regions
+        # Each chromosome is a contiguous slice
+        bounds = np.searchsorted(chrom_codes, np.arange(len(chroms) + 1)).tolist()
+        _BED_REGIONS[memo_key] = {chrom: (starts[bounds[i]:bounds[i + 1]], ends[bounds[i]:bounds[i + 1]])
+                                  for i, chrom in enumerate(chroms)}
+    return _BED_REGIONS[memo_key]
+
+
+class BedMask:
+    # Regions of one or more BED files, merged and sorted by chromosome, to select the variants with a breakpoint in them
+    # in O((n + m) log m). Positions are compared with the closed intervals [start, end] of the BED rows
+    # It can select the rows of a dataframe (mask) or the variants while reading a VCF file (see read_vcfs)
+    # The regions of each BED file are read with read_bed_regions
+    def __init__(self, bed_paths, cache_dir=None):
+        beds_regions = [read_bed_regions(bed_path, cache_dir) for bed_path in bed_paths]
+        if len(beds_regions) == 1:
+            self.regions = dict(beds_regions[0])
+            return
+        self.regions = {}
+        for chrom in dict.fromkeys(chrom for bed_regions in beds_regions for chrom in bed_regions):
+            chrom_regions = [bed_regions[chrom] for bed_regions in beds_regions if chrom in bed_regions]
+            self.regions[chrom] = _merge_intervals(np.concatenate([starts for starts, _ in chrom_regions]),
+                                                   np.concatenate([ends for _, ends in chrom_regions]))
+
+    def __len__(self):
+        return sum(len(starts) for starts, _ in self.regions.values())
+
+    def __deepcopy__(self, memo):
+        # Regions are not modified, so the copies of the dataframes read restricted to them (which deep copy their attrs,
+        # see read_vcfs) share them
+        return self
+
+    def __repr__(self):
+        # Identifies the regions (e.g. in the keys of the parsed VCF files cache)
+        digest = hashlib.blake2b(digest_size=20)
+        for chrom in sorted(self.regions):
+            starts, ends = self.regions[chrom]
+            digest.update(chrom.encode() + b'\0')
+            digest.update(starts.tobytes())
+            digest.update(ends.tobytes())
+        return f'BedMask({digest.hexdigest()})'
+
+    def _contains(self, chrom, position) -> bool:
+        if chrom not in self.regions:
+            return False
+        starts, ends = self.regions[chrom]
+        region_index = np.searchsorted(starts, position, side='right') - 1
+        return region_index >= 0 and position <= ends[region_index]
+
+    def _positions_mask(self, chroms, positions):
+        mask = np.zeros(len(positions), dtype=bool)
+        chrom_codes, chrom_names = pd.factorize(chroms.astype(str))
+        positions = positions.to_numpy(dtype=np.int64)
+        for chrom_code, chrom in enumerate(chrom_names):
+            if chrom not in self.regions:
+                continue
+            starts, ends = self.regions[chrom]
+            chrom_indexes = np.flatnonzero(chrom_codes == chrom_code)
+            chrom_positions = positions[chrom_indexes]
+            # Last region starting before or at each position
+            region_indexes = np.searchsorted(starts, chrom_positions, side='right') - 1
+            mask[chrom_indexes] = (region_indexes >= 0) & (chrom_positions <= ends[np.maximum(region_indexes, 0)])
+        return mask
+
+    def mask(self, df):
+        # Variants whose start or end breakpoint is in a region
+        start_mask = self._positions_mask(df['start_chrom'], df['start'])
+        end_mask = self._positions_mask(df['end_chrom'], df['end'])
+        return pd.Series(start_mask | end_mask, index=df.index)
+
+    def __call__(self, variant_record) -> bool:
+        # Same breakpoints as VariantExtractor.to_dataframe
+        start_chrom = variant_record.contig.replace('chr', '')
+        end_chrom, end = start_chrom, variant_record.end
+        if variant_record.alt_sv_breakend:
+            end_chrom = variant_record.alt_sv_breakend.contig.replace('chr', '')
+            if start_chrom != end_chrom:
+                end = variant_record.alt_sv_breakend.pos
+        return self._contains(start_chrom, variant_record.pos) or self._contains(end_chrom, end)
@@ -1,5 +1,6 @@
 import pandas as pd
-from functools import reduce
+import numpy as np
+import functools
 
 from variant_extractor.variants import VariantType
 
@@ -7,6 +8,7 @@ from .genes import combine_genes_symbols, get_cancer_census_genes, GENE_SPLIT_SY
 
 METRICS_COLUMNS = ['variant_type', 'variant_size', 'window_radius', 'recall', 'precision', 'f1_score', 'tp', 'fp', 'fn',
                    'protein_affected_genes_count', 'protein_affected_driver_genes_count', 'protein_affected_genes', 'protein_affected_driver_genes']
+PR_CURVES_COLUMNS = ['variant_type', 'variant_size', 'window_radius', 'score_threshold', 'recall', 'precision', 'f1_score', 'tp', 'fp', 'fn']
 
 
 def infer_parameters_from_metrics(metrics: pd.DataFrame, window_radius=None):
@@ -123,14 +125,8 @@ def combine_precision_recall_metrics(recall_df, precision_df):
     return df
 
 
-def compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size_bins, variant_types):
-    # Add temporal benchmark column
-    df_tp = df_tp.assign(benchmark='TP')
-    df_fp = df_fp.assign(benchmark='FP')
-    df_fn = df_fn.assign(benchmark='FN')
-
-    df = pd.concat([df_tp, df_fp, df_fn], ignore_index=True)
-
+@functools.lru_cache(maxsize=None)
+def _metrics_bins(indel_threshold, window_radius, sv_size_bins, variant_types):
     # Setup repeated bin sizes
     repeated_bin_sizes = []
     for i in range(len(sv_size_bins) + 1):
@@ -192,42 +188,97 @@ def compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size
         else:
             window_radius_names.append(str(window_radius))
 
-    # Setup masks
-    masks = []
-    for i, bin_sizes_name in enumerate(bin_sizes_names):
-        if bin_names[i] == 'INDEL' or bin_names[i] == 'SV':
-            masks.append(None)  # Skip indels and SVs, fill in later
+    # Setup bins membership
+    bin_leaves = _bin_leaves(tuple(bin_names), tuple(bin_sizes_names))
+    membership = bin_leaves[2].copy()
+    # Fill INDEL bin with the existing bins
+    membership[1] = membership[2] | membership[3]
+    # Fill SV bin with the existing bins
+    membership[4] = membership[5:].any(axis=0)
+    return bin_names, bin_sizes_names, window_radius_names, (bin_leaves[0], bin_leaves[1], membership)
+
+
+def _bin_size_limits(bin_sizes_name):
+    # Inclusive length limits of a bin, None if the bin does not filter by length
+    curr_sizes = bin_sizes_name.split('-')
+    if '>' in curr_sizes[0]:
+        return int(curr_sizes[0].replace('>', '').strip()) + 1, np.inf
+    elif len(curr_sizes) == 2:
+        return int(curr_sizes[0].strip()), int(curr_sizes[1].strip())
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _bin_leaves(bin_names, bin_sizes_names):
+    # Split the variants space in leaves, one per inferred type and length interval between the bins limits
+    # Every variant falls in exactly one leaf, and each bin is a set of leaves (INDEL and SV bins are left empty)
+    bins_types = []
+    bins_limits = []
+    for bin_name, bin_sizes_name in zip(bin_names, bin_sizes_names):
+        if bin_name == 'INDEL' or bin_name == 'SV':
+            bins_types.append([])
+            bins_limits.append(None)
             continue
-        curr_names = bin_names[i].split('/')
-        curr_mask = df['type_inferred'] == curr_names[0].strip()
-        for name in curr_names[1:]:
-            curr_mask = curr_mask | (df['type_inferred'] == name.strip())
-
-        curr_sizes = bin_sizes_name.split('-')
-        if '>' in curr_sizes[0]:
-            curr_mask = curr_mask & (df['length'] > int(curr_sizes[0].replace('>', '').strip()))
-        elif len(curr_sizes) == 2:
-            curr_mask = curr_mask & (df['length'] >= int(curr_sizes[0].strip())) & \
-                (df['length'] <= int(curr_sizes[1].strip()))
-        masks.append(curr_mask)
-    # Fill INDEL mask with the existing masks
-    masks[1] = masks[2] | masks[3]
-    # Fill SV mask with the existing masks
-    masks[4] = reduce(lambda x, y: x | y, masks[6:], masks[5])
+        bins_types.append([name.strip() for name in bin_name.split('/')])
+        bins_limits.append(_bin_size_limits(bin_sizes_name))
+    types = pd.Index(list(dict.fromkeys(t for bin_types in bins_types for t in bin_types)))
+    edges = np.unique([limit for limits in bins_limits if limits is not None
+                       for limit in (limits[0], limits[1] + 1) if limit != np.inf]).astype(float)
+    # Interval i covers [edges[i-1], edges[i]), the last one is reserved for variants without length
+    intervals_start = np.concatenate([[-np.inf], edges, [np.nan]])
+    intervals_end = np.concatenate([edges, [np.inf, np.nan]])
+    # Unknown types get the last type code
+    membership = np.zeros((len(bin_names), len(types) + 1, len(intervals_start)), dtype=bool)
+    for i, (bin_types, limits) in enumerate(zip(bins_types, bins_limits)):
+        if limits is None:
+            intervals_mask = np.ones(len(intervals_start), dtype=bool)
+        else:
+            intervals_mask = (intervals_start >= limits[0]) & (intervals_end <= limits[1] + 1)
+        membership[i, types.get_indexer(bin_types)] = intervals_mask
+    return types, edges, membership.reshape(len(bin_names), -1)
+
+
+def _variant_leaves(df, types, edges):
+    # Leaf of each variant of df, see _bin_leaves
+    type_codes = types.get_indexer(df['type_inferred'])
+    type_codes[type_codes < 0] = len(types)
+    lengths = df['length'].to_numpy(dtype=float)
+    intervals = np.digitize(lengths, edges)
+    intervals[np.isnan(lengths)] = len(edges) + 1
+    return type_codes * (len(edges) + 2) + intervals
+
+
+def variants_in_bins(df, variant_types, variant_sizes):
+    # Mask of the variants of df inside any of the bins given by the variant_type and variant_size metrics columns
+    # INDEL and SV bins are skipped
+    types, edges, membership = _bin_leaves(tuple(variant_types), tuple(variant_sizes))
+    leaves_mask = membership.any(axis=0)
+    return pd.Series(leaves_mask[_variant_leaves(df, types, edges)], index=df.index)
+
+
+def compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size_bins, variant_types):
+    bin_names, bin_sizes_names, window_radius_names, (types, edges, membership) = _metrics_bins(
+        indel_threshold, window_radius, tuple(sv_size_bins), tuple(variant_types))
+
+    # Count TP, FP and FN per leaf and add the leaves of each bin
+    tp_leaves = _variant_leaves(df_tp, types, edges)
+    leaves = np.concatenate([tp_leaves, _variant_leaves(df_fp, types, edges), _variant_leaves(df_fn, types, edges)])
+    benchmark = np.repeat([0, 1, 2], [len(df_tp), len(df_fp), len(df_fn)])
+    leaves_counts = np.bincount(leaves * 3 + benchmark, minlength=membership.shape[1] * 3).reshape(-1, 3)
+    bins_counts = membership.astype(np.int64) @ leaves_counts
+
+    if 'GENES' in df_tp.columns:
+        tp_genes = df_tp['GENES'].to_numpy()
+        tp_genes_count = df_tp['GENES'].apply(len).to_numpy()
+        tp_membership = membership[:, tp_leaves]
 
     rows = []
     for i, bin_name in enumerate(bin_names):
-        df_bin = df[masks[i]]
         row = []
         row.append(bin_name)
         row.append(bin_sizes_names[i])
         row.append(window_radius_names[i])
-        tp_df = df_bin[df_bin['benchmark'] == 'TP']
-        fp_df = df_bin[df_bin['benchmark'] == 'FP']
-        fn_df = df_bin[df_bin['benchmark'] == 'FN']
-        tp = len(tp_df)
-        fp = len(fp_df)
-        fn = len(fn_df)
+        tp, fp, fn = (int(count) for count in bins_counts[i])
         recall = tp / (tp + fn) if tp + fn > 0 else 0
         precision = tp / (tp + fp) if tp + fp > 0 else 0
         f1 = 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0
@@ -240,8 +291,8 @@ def compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size
         protein_affected_genes = set()
         protein_affected_driver_genes = set()
         # Check if there are any genes in the GENES column
-        if 'GENES' in tp_df.columns and tp_df['GENES'].apply(len).sum() > 0:
-            protein_affected_genes = combine_genes_symbols(tp_df['GENES'])
+        if 'GENES' in df_tp.columns and tp_genes_count[tp_membership[i]].sum() > 0:
+            protein_affected_genes = combine_genes_symbols(tp_genes[tp_membership[i]])
             protein_affected_driver_genes = protein_affected_genes & get_cancer_census_genes()
         row.append(len(protein_affected_genes))
         row.append(len(protein_affected_driver_genes))
@@ -251,3 +302,52 @@ def compute_metrics(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size
 
     return pd.DataFrame(rows, columns=METRICS_COLUMNS)
 
+
+def compute_pr_curves(df_tp, df_fp, df_fn, indel_threshold, window_radius, sv_size_bins, variant_types):
+    # Precision-recall curves over the score column of the test variants, with the same bins as compute_metrics
+    # Each point keeps the variants with a score greater or equal than score_threshold
+    # Variants without score are only kept in the last point of each curve (score_threshold is NaN)
+    df_tp = df_tp.assign(benchmark='TP')
+    df_fp = df_fp.assign(benchmark='FP')
+    df_fn = df_fn.assign(benchmark='FN')
+
+    df = pd.concat([df_tp, df_fp, df_fn], ignore_index=True)
+
+    bin_names, bin_sizes_names, window_radius_names, (types, edges, membership) = _metrics_bins(
+        indel_threshold, window_radius, tuple(sv_size_bins), tuple(variant_types))
+    leaves = _variant_leaves(df, types, edges)
+
+    scores = df['score'].to_numpy(dtype=float)
+    benchmark = df['benchmark'].to_numpy()
+    curves = []
+    for i, bin_name in enumerate(bin_names):
+        bin_mask = membership[i][leaves]
+        total_fn = np.count_nonzero(bin_mask & (benchmark == 'FN'))
+        test_mask = bin_mask & (benchmark != 'FN')
+        bin_scores = scores[test_mask]
+        bin_tp = benchmark[test_mask] == 'TP'
+        # Sort by descending score (NaN last) and accumulate TP and FP
+        order = np.argsort(np.where(np.isnan(bin_scores), np.inf, -bin_scores), kind='stable')
+        sorted_scores = bin_scores[order]
+        tp = np.cumsum(bin_tp[order])
+        fp = np.arange(1, len(order) + 1) - tp
+        # One point per distinct score, at its last variant
+        last_mask = np.ones(len(order), dtype=bool)
+        last_mask[:-1] = (sorted_scores[1:] != sorted_scores[:-1]) & ~(np.isnan(sorted_scores[1:]) & np.isnan(sorted_scores[:-1]))
+        thresholds = sorted_scores[last_mask]
+        tp = tp[last_mask]
+        fp = fp[last_mask]
+        if len(order) == 0:
+            # Bins without test variants only have the point with all of them
+            thresholds, tp, fp = np.array([np.nan]), np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+        # The TP with a lower score become FN
+        fn = total_fn + np.count_nonzero(bin_tp) - tp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            recall = np.nan_to_num(tp / (tp + fn))
+            precision = np.nan_to_num(tp / (tp + fp))
+            f1 = np.nan_to_num(2 * recall * precision / (recall + precision))
+        curves.append(pd.DataFrame({'variant_type': bin_name, 'variant_size': bin_sizes_names[i],
+                                    'window_radius': window_radius_names[i], 'score_threshold': thresholds,
+                                    'recall': recall, 'precision': precision, 'f1_score': f1, 'tp': tp, 'fp': fp, 'fn': fn},
+                                   columns=PR_CURVES_COLUMNS))
+    return pd.concat(curves, ignore_index=True)
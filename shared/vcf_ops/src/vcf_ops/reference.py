@@ -0,0 +1,134 @@
+# Copyright 2023 - Barcelona Supercomputing Center
+# Author: Rodrigo Martín
+# BSC Dual License
+import os
+import json
+import logging
+import tempfile
+import numpy as np
+import pysam
+
+from .constants import REFERENCE_FETCH_SIZE  # noqa
+
+# References already opened by this process, by path and signature of their FASTA file
+_REFERENCES = {}
+
+
+def _packed_paths(fasta_ref: str):
+    # Bases of the contigs (1 byte per base) and table with the offset and length of each contig in them
+    return fasta_ref + '.bases', fasta_ref + '.bases.json'
+
+
+def _fasta_signature(fasta_ref: str):
+    stat = os.stat(fasta_ref)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _packed_contigs(fasta_ref: str):
+    # Contigs of the packed reference of fasta_ref, or None if it is not prepared or outdated
+    bases_path, table_path = _packed_paths(fasta_ref)
+    try:
+        with open(table_path) as f:
+            table = json.load(f)
+        if table['signature'] != _fasta_signature(fasta_ref) or \
+                os.path.getsize(bases_path) != sum(length for _, _, length in table['contigs']):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return table['contigs']
+
+
+def prepare_reference(fasta_ref: str) -> bool:
+    # Write the packed reference of fasta_ref next to it (nothing is done if it is up to date), so that open_reference
+    # memory-maps it instead of reading the FASTA file. Bases keep their case
+    # Returns whether the packed reference is available
+    if _packed_contigs(fasta_ref) is not None:
+        return True
+    bases_path, table_path = _packed_paths(fasta_ref)
+    temp_paths = []
+    try:
+        signature = _fasta_signature(fasta_ref)
+        fasta = pysam.FastaFile(fasta_ref)
+        bases_fd, temp_bases_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(fasta_ref)))
+        temp_paths.append(temp_bases_path)
+        contigs = []
+        offset = 0
+        with os.fdopen(bases_fd, 'wb') as f:
+            for contig, length in zip(fasta.references, fasta.lengths):
+                for start in range(0, length, REFERENCE_FETCH_SIZE):
+                    f.write(fasta.fetch(contig, start, min(start + REFERENCE_FETCH_SIZE, length)).encode('latin-1'))
+                contigs.append([contig, offset, length])
+                offset += length
+        fasta.close()
+        table_fd, temp_table_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(fasta_ref)))
+        temp_paths.append(temp_table_path)
+        with os.fdopen(table_fd, 'w') as f:
+            json.dump({'signature': signature, 'contigs': contigs}, f)
+        # The table is moved last, as it marks the packed reference as complete
+        os.replace(temp_bases_path, bases_path)
+        os.replace(temp_table_path, table_path)
+    except OSError as e:
+        # e.g. read-only reference folder, the FASTA file is read instead
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logging.warning(f'Could not prepare packed reference of {fasta_ref}: {e}')
+        return False
+    return True
+
+
+class PackedReference:
+    # Reference memory-mapped from the files written by prepare_reference. All the processes share its pages through
+    # the page cache, and bases returns views of them
+    def __init__(self, fasta_ref: str, contigs):
+        bases_path, _ = _packed_paths(fasta_ref)
+        self.__bases = np.memmap(bases_path, dtype=np.uint8, mode='r') if os.path.getsize(bases_path) > 0 \
+            else np.zeros(0, dtype=np.uint8)
+        self.__contigs = {contig: (offset, length) for contig, offset, length in contigs}
+        self.references = tuple(contig for contig, _, _ in contigs)
+        self.lengths = tuple(length for _, _, length in contigs)
+
+    def get_reference_length(self, contig: str) -> int:
+        return self.__contigs[contig][1]
+
+    def bases(self, contig: str, start=None, end=None) -> np.ndarray:
+        # Same range as pysam.FastaFile.fetch (0-based, truncated at the end of the contig)
+        offset, length = self.__contigs[contig]
+        start = 0 if start is None else start
+        if start < 0:
+            raise ValueError(f'start out of range ({start})')
+        if end is not None and start > end:
+            raise ValueError(f'invalid coordinates: start ({start}) > stop ({end})')
+        start = min(start, length)
+        end = length if end is None else max(min(end, length), start)
+        return self.__bases[offset + start:offset + end]
+
+    def fetch(self, contig: str, start=None, end=None) -> str:
+        return self.bases(contig, start, end).tobytes().decode('latin-1')
+
+
+class _FastaReference:
+    # Same interface as PackedReference, reading the FASTA file
+    def __init__(self, fasta_ref: str):
+        self.__fasta = pysam.FastaFile(fasta_ref)
+        self.references = self.__fasta.references
+        self.lengths = self.__fasta.lengths
+
+    def get_reference_length(self, contig: str) -> int:
+        return self.__fasta.get_reference_length(contig)
+
+    def bases(self, contig: str, start=None, end=None) -> np.ndarray:
+        return np.frombuffer(self.fetch(contig, start, end).encode('latin-1'), dtype=np.uint8)
+
+    def fetch(self, contig: str, start=None, end=None) -> str:
+        return self.__fasta.fetch(contig, start, end)
+
+
+def open_reference(fasta_ref: str):
+    # Packed reference of fasta_ref if it is prepared (see prepare_reference), or the FASTA file otherwise
+    # References are opened once per process
+    key = (os.path.abspath(fasta_ref), tuple(_fasta_signature(fasta_ref)))
+    if key not in _REFERENCES:
+        contigs = _packed_contigs(fasta_ref)
+        _REFERENCES[key] = PackedReference(fasta_ref, contigs) if contigs is not None else _FastaReference(fasta_ref)
+    return _REFERENCES[key]
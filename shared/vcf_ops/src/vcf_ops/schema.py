@@ -0,0 +1,85 @@
+# Copyright 2023 - Barcelona Supercomputing Center
+# Author: Rodrigo Martín
+# BSC Dual License
+from typing import Iterable
+import numpy as np
+import pandas as pd
+
+from .constants import VARIANTS_CATEGORICAL_COLUMNS, VARIANTS_POSITION_COLUMNS  # noqa
+
+
+# Types of the columns of VariantExtractor.to_dataframe (variant-extractor 5.2.0), positions are downcast (see extractor_variants)
+_EXTRACTOR_DTYPES = {'start_chrom': 'category', 'start': 'uint64', 'end_chrom': 'category', 'end': 'uint64', 'ref': 'category',
+                     'alt': 'category', 'length': 'uint64', 'brackets': 'category', 'type_inferred': 'category'}
+
+
+def extractor_variants(variants_df: pd.DataFrame) -> pd.DataFrame:
+    # Same types as VariantExtractor.to_dataframe, so that variants dataframes built from its parts match it
+    # Positions and lengths are stored in the smallest unsigned integer type that fits them
+    variants_df = variants_df.astype(_EXTRACTOR_DTYPES)
+    for column in ['start', 'end', 'length']:
+        column_max = variants_df[column].max()
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if column_max < np.iinfo(dtype).max + 1:
+                variants_df[column] = variants_df[column].astype(dtype)
+                break
+    return variants_df
+
+
+def compact_variants(variants_df: pd.DataFrame) -> pd.DataFrame:
+    # Compact types of the variants dataframe columns, so that type and chromosome comparisons compare category codes
+    # Positions and lengths are signed, so that they can be subtracted without overflowing
+    dtypes = {}
+    for column in VARIANTS_CATEGORICAL_COLUMNS:
+        if column in variants_df.columns and not isinstance(variants_df[column].dtype, pd.CategoricalDtype):
+            dtypes[column] = 'category'
+    for column in VARIANTS_POSITION_COLUMNS:
+        if column in variants_df.columns:
+            fits_int32 = len(variants_df) == 0 or variants_df[column].max() <= np.iinfo(np.int32).max
+            dtypes[column] = np.int32 if fits_int32 else np.int64
+    return variants_df.astype(dtypes)
+
+
+def concat_variants(variants_dfs: Iterable[pd.DataFrame], ignore_index=False) -> pd.DataFrame:
+    # pd.concat of variants dataframes that keeps categorical columns as categories
+    # (pd.concat turns them into objects if their categories differ)
+    # As in pd.concat, None objects are dropped
+    # The regions of the variants read restricted to them (see regions_view) are kept
+    variants_dfs = [df for df in variants_dfs if df is not None]
+    # Placeholder dataframes without columns do not contribute any variant
+    variants_dfs = [df for df in variants_dfs if len(df.columns) > 0] or variants_dfs
+    if len(variants_dfs) == 0:
+        return pd.DataFrame()
+    unified_dfs = variants_dfs
+    for column in variants_dfs[0].columns:
+        if not all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in variants_dfs):
+            continue
+        categories = variants_dfs[0][column].cat.categories
+        if all(df[column].cat.categories.equals(categories) for df in variants_dfs):
+            continue
+        for df in variants_dfs[1:]:
+            categories = categories.union(df[column].cat.categories)
+        unified_dfs = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in unified_dfs]
+    variants_df = pd.concat(unified_dfs, ignore_index=ignore_index)
+    views = {}
+    for df in variants_dfs:
+        for view, regions in df.attrs.get('regions', {}).items():
+            if views.setdefault(view, regions) is not regions and repr(views[view]) != repr(regions):
+                raise ValueError(f'Variants of {view[0]} read restricted to different regions cannot be concatenated')
+    if len(views) > 0:
+        # Variants of a file read with and without regions are numbered differently
+        for df in variants_dfs:
+            df_views = df.attrs.get('regions', {})
+            if 'vcf_file' not in df.columns:
+                continue
+            for view in df[['vcf_file', 'pass_only']].drop_duplicates().itertuples(index=False, name=None):
+                if view in views and view not in df_views:
+                    raise ValueError(f'Variants of {view[0]} read with and without regions cannot be concatenated')
+        variants_df.attrs['regions'] = views
+    return variants_df
+
+
+def regions_view(variants_df: pd.DataFrame, vcf_file: str, pass_only: bool):
+    # Regions the variants of vcf_file in variants_df were read restricted to (None if the whole file was read),
+    # which their idx_in_file refers to, see read_vcfs
+    return variants_df.attrs.get('regions', {}).get((vcf_file, pass_only))
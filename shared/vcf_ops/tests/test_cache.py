@@ -0,0 +1,109 @@
+import os
+import shutil
+from collections import OrderedDict
+import pandas as pd
+import pytest
+
+from vcf_ops import i_o, gene_annotations, masks  # noqa
+from vcf_ops.i_o import read_vcfs, write_vcf  # noqa
+from vcf_ops.genes import combine_gene_annotations  # noqa
+from vcf_ops.cache import load_cached_variants, store_cached_variants  # noqa
+from vcf_ops.masks import BedMask  # noqa
+
+_HEADER = '##fileformat=VCFv4.2\n' \
+    '##contig=<ID=1,length=1000000>\n' \
+    '##contig=<ID=2,length=1000000>\n' \
+    '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n' \
+    '##INFO=<ID=MATEID,Number=.,Type=String,Description="ID of mate breakends">\n' \
+    '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP">\n' \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def _write_vcf(path, records):
+    with open(path, 'w') as f:
+        f.write(_HEADER)
+        for record in records:
+            f.write('\t'.join(str(field) for field in record) + '\n')
+    return str(path)
+
+
+def _forget_read_files(monkeypatch):
+    # Record indexes, raw records and gene annotations kept by this process, as if another process read the files
+    monkeypatch.setattr(i_o, '_RECORD_INDEXES', OrderedDict())
+    monkeypatch.setattr(i_o, '_RAW_RECORDS', OrderedDict())
+    monkeypatch.setattr(gene_annotations, '_GENE_ANNOTATIONS', {})
+
+
+def test_read_vcfs_warm_read_matches_cold_read(tmp_path, monkeypatch):
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', 30, 'PASS', 'CSQ=C|missense_variant|MODERATE|TP53'),
+        ('1', 200, 'multi1', 'A', 'C,G', 20, 'PASS', '.'),
+        ('1', 300, 'bnd1_a', 'N', 'N[2:500[', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd1_b'),
+        ('1', 400, 'del1', 'ACGT', 'A', '.', 'PASS', '.'),
+        ('2', 500, 'bnd1_b', 'N', ']1:300]N', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd1_a'),
+    ])
+    cache_dir = str(tmp_path / 'cache')
+    cold_df = read_vcfs([vcf_file], score_field='QUAL', keep_raw_records=True, cache_dir=cache_dir, gene_annotations=True)
+    cold_genes = combine_gene_annotations(cold_df)
+    write_vcf(cold_df, str(tmp_path / 'cold.vcf'))
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Files with the same content are loaded from the entry, wherever they are
+    copied_vcf = str(tmp_path / 'copied.vcf')
+    shutil.copy(vcf_file, copied_vcf)
+    _forget_read_files(monkeypatch)
+    monkeypatch.setattr(i_o, '_parse_variants', None)
+    warm_df = read_vcfs([copied_vcf], score_field='QUAL', keep_raw_records=True, cache_dir=cache_dir, gene_annotations=True)
+    assert len(os.listdir(cache_dir)) == 1
+    assert (warm_df['vcf_file'] == copied_vcf).all()
+    pd.testing.assert_frame_equal(warm_df.drop(columns='vcf_file'), cold_df.drop(columns='vcf_file'))
+    pd.testing.assert_series_equal(combine_gene_annotations(warm_df), cold_genes)
+    write_vcf(warm_df, str(tmp_path / 'warm.vcf'))
+    with open(tmp_path / 'cold.vcf') as cold_f, open(tmp_path / 'warm.vcf') as warm_f:
+        assert warm_f.read() == cold_f.read()
+
+
+def test_store_cached_variants_evicts_the_least_recently_used_entries(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    variants_df = pd.DataFrame({'start': pd.Series(range(1000), dtype='int64'),
+                                'alt': pd.Categorical(['A', 'C'] * 500)})
+    variants_df.attrs['skipped_variants'] = 3
+    store_cached_variants(cache_dir, 'first', variants_df)
+    entry_size = sum(f.stat().st_size for f in os.scandir(os.path.join(cache_dir, 'first')))
+    loaded_df, record_index, raw_records, genes = load_cached_variants(cache_dir, 'first')
+    pd.testing.assert_frame_equal(loaded_df, variants_df)
+    assert loaded_df.attrs == {'skipped_variants': 3}
+    assert record_index is None and raw_records is None and genes is None
+    store_cached_variants(cache_dir, 'second', variants_df)
+    # Entries are used in order first, second, first
+    os.utime(os.path.join(cache_dir, 'first', 'columns.json'), (1000, 1000))
+    os.utime(os.path.join(cache_dir, 'second', 'columns.json'), (2000, 2000))
+    load_cached_variants(cache_dir, 'first')
+    store_cached_variants(cache_dir, 'third', variants_df, max_size=2 * entry_size)
+    assert sorted(os.listdir(cache_dir)) == ['first', 'third']
+    assert load_cached_variants(cache_dir, 'second') is None
+
+
+@pytest.mark.parametrize('bed_content', ['chr2\t500\t600\tname\nchr1\t100\t200\tname\nchr1\t150\t300\tname\nchrX\t10\t20\tname\n', ''])
+def test_read_bed_regions_cached_regions_match_preprocessed_regions(tmp_path, monkeypatch, bed_content):
+    bed_file = tmp_path / 'regions.bed'
+    bed_file.write_text(bed_content)
+    cache_dir = str(tmp_path / 'cache')
+    variants_df = pd.DataFrame({'start_chrom': ['1', '1', '2', 'X', '3'], 'start': [120, 250, 550, 15, 100],
+                                'end_chrom': ['1', '1', '2', 'X', '3'], 'end': [121, 400, 551, 16, 101]})
+    cold_mask = BedMask([str(bed_file)], cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    # Files with the same content are loaded from the entry, wherever they are
+    copied_bed = str(tmp_path / 'copied.bed')
+    shutil.copy(bed_file, copied_bed)
+    monkeypatch.setattr(masks, '_BED_REGIONS', {})
+    monkeypatch.setattr(masks, '_preprocess_bed', None)
+    warm_mask = BedMask([copied_bed], cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    assert list(warm_mask.regions) == list(cold_mask.regions)
+    for chrom, (starts, ends) in cold_mask.regions.items():
+        assert warm_mask.regions[chrom][0].tolist() == starts.tolist()
+        assert warm_mask.regions[chrom][1].tolist() == ends.tolist()
+    assert repr(warm_mask) == repr(cold_mask)
+    pd.testing.assert_series_equal(warm_mask.mask(variants_df), cold_mask.mask(variants_df))
+    assert warm_mask.mask(variants_df).tolist() == ([True, True, True, True, False] if bed_content else [False] * 5)
@@ -0,0 +1,41 @@
+import pandas as pd
+
+from vcf_ops.i_o import read_vcfs  # noqa
+from vcf_ops.genes import combine_gene_annotations  # noqa
+from vcf_ops import gene_annotations  # noqa
+
+_HEADER = '##fileformat=VCFv4.2\n' \
+    '##contig=<ID=1,length=1000000>\n' \
+    '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP">\n' \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def _write_vcf(path, records):
+    with open(path, 'w') as f:
+        f.write(_HEADER)
+        for record in records:
+            f.write('\t'.join(str(field) for field in record) + '\n')
+    return str(path)
+
+
+def test_combine_gene_annotations_reads_the_files_not_captured(tmp_path, monkeypatch):
+    test_vcf = _write_vcf(tmp_path / 'test.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', '.', 'PASS', 'CSQ=C|missense_variant|MODERATE|TP53'),
+        ('1', 200, 'multi1', 'A', 'C,G', '.', 'PASS', 'CSQ=C|synonymous_variant|LOW|KRAS'),
+        ('1', 300, 'snv2', 'G', 'T', '.', 'PASS', '.'),
+    ])
+    truth_vcf = _write_vcf(tmp_path / 'truth.vcf', [
+        ('1', 200, 'truth1', 'A', 'C', '.', 'PASS', 'CSQ=C|stop_gained|HIGH|KRAS'),
+        ('1', 300, 'truth2', 'G', 'C', '.', 'PASS', 'CSQ=C|frameshift_variant|HIGH|BRCA1'),
+    ])
+    df_test = read_vcfs([test_vcf], gene_annotations=True)
+    df_truth = read_vcfs([truth_vcf], gene_annotations=True)
+    df_tp = df_test.iloc[[0, 1, 3]].assign(idx_truth=[1, 0, 1])
+    expected = [{'TP53', 'BRCA1'}, {'KRAS'}, {'BRCA1'}]
+    assert combine_gene_annotations(df_tp, df_truth).tolist() == expected
+    # Variants read without gene annotations (or by another process)
+    monkeypatch.setattr(gene_annotations, '_GENE_ANNOTATIONS', {})
+    genes = combine_gene_annotations(df_tp, df_truth)
+    assert genes.tolist() == expected
+    pd.testing.assert_index_equal(genes.index, df_tp.index)
+    assert combine_gene_annotations(df_tp).tolist() == [{'TP53'}, set(), set()]
@@ -0,0 +1,253 @@
+import os
+import pickle
+import pysam
+import pytest
+import pandas as pd
+from collections import OrderedDict
+
+from variant_extractor import VariantExtractor
+
+from vcf_ops import i_o, gene_annotations  # noqa
+from vcf_ops.i_o import read_vcfs, write_vcf, write_vcfs, extract_variants, _get_record_index  # noqa
+from vcf_ops.schema import concat_variants  # noqa
+from vcf_ops.masks import BedMask, VariantFilter  # noqa
+from vcf_ops.genes import combine_gene_annotations  # noqa
+
+_HEADER = '##fileformat=VCFv4.2\n' \
+    '##contig=<ID=1,length=1000000>\n' \
+    '##contig=<ID=2,length=1000000>\n' \
+    '##contig=<ID=3,length=1000000>\n' \
+    '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n' \
+    '##INFO=<ID=MATEID,Number=.,Type=String,Description="ID of mate breakends">\n' \
+    '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP">\n' \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def _write_vcf(path, records):
+    with open(path, 'w') as f:
+        f.write(_HEADER)
+        for record in records:
+            f.write('\t'.join(str(field) for field in record) + '\n')
+    return str(path)
+
+
+def test_write_vcfs_checks_index_outputs_before_opening(tmp_path):
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [('1', 100, 'snv1', 'A', 'C', '.', 'PASS', '.')])
+    variants_df = read_vcfs([vcf_file])
+    compressed_vcf = str(tmp_path / 'first.vcf.gz')
+    plain_vcf = str(tmp_path / 'second.vcf')
+    with pytest.raises(ValueError, match='Only compressed VCF files can be indexed'):
+        write_vcfs({compressed_vcf: variants_df, plain_vcf: variants_df}, index='tbi')
+    assert not os.path.exists(compressed_vcf)
+    assert not os.path.exists(plain_vcf)
+
+
+@pytest.mark.parametrize('mate_ids', [True, False])
+def test_read_vcfs_regions_pairs_breakends_sharing_a_mate_position(tmp_path, mate_ids):
+    # tra1_a is in the region, and its mate tra1_b shares its position with tra3_a, whose mate tra3_b is out of the region
+    # Only tra1_b must be read with tra1_a, otherwise tra3_a is left unpaired
+    def info(mate_id):
+        return f'SVTYPE=BND;MATEID={mate_id}' if mate_ids else 'SVTYPE=BND'
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', '.', 'PASS', '.'),
+        ('1', 113020, 'tra1_b', 'N', ']2:67719]N', '.', 'PASS', info('tra1_a')),
+        ('1', 113020, 'tra3_a', 'N', 'N[3:5000[', '.', 'PASS', info('tra3_b')),
+        ('2', 67500, 'snv2', 'G', 'T', '.', 'PASS', '.'),
+        ('2', 67719, 'tra1_a', 'N', 'N[1:113020[', '.', 'PASS', info('tra1_b')),
+        ('3', 5000, 'tra3_b', 'N', ']1:113020]N', '.', 'PASS', info('tra3_a')),
+    ])
+    pysam.tabix_index(vcf_file, preset='vcf', force=True)
+    bed_file = tmp_path / 'regions.bed'
+    bed_file.write_text('2\t67000\t68000\n')
+    regions = BedMask([str(bed_file)])
+    variants_df = read_vcfs([vcf_file + '.gz'], regions=regions)
+    full_df = read_vcfs([vcf_file + '.gz'])
+    expected_df = full_df[regions.mask(full_df)]
+    columns = ['start_chrom', 'start', 'end_chrom', 'end', 'type_inferred']
+    assert sorted(variants_df[columns].astype(str).values.tolist()) == sorted(expected_df[columns].astype(str).values.tolist())
+    assert len(variants_df) == 2
+    assert (variants_df['type_inferred'] == 'TRA').sum() == 1
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_extract_variants_seeks_indexed_records(tmp_path, compressed):
+    # Multiallelic records and MNVs are split into several variants of the same record
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', '.', 'PASS', '.'),
+        ('1', 200, 'multi1', 'A', 'C,G,T', '.', 'PASS', '.'),
+        ('1', 300, 'mnv1', 'AC', 'GT', '.', 'PASS', '.'),
+        ('1', 400, 'filtered1', 'A', 'C', '.', 'LowQual', '.'),
+        ('2', 100, 'del1', 'ACGT', 'A', '.', 'PASS', '.'),
+        ('2', 200, 'ins1', 'A', 'ACGT', '.', 'PASS', '.'),
+        ('3', 100, 'multi2', 'A', 'C,G', '.', 'PASS', '.'),
+        ('3', 200, 'snv2', 'G', 'T', '.', 'PASS', '.'),
+    ])
+    if compressed:
+        vcf_file = pysam.tabix_index(vcf_file, preset='vcf', force=True)
+    all_variants = [str(variant_record) for variant_record in VariantExtractor(vcf_file, pass_only=True)]
+    variants_df = read_vcfs([vcf_file])
+    assert len(variants_df) == len(all_variants)
+    offsets, ordinals = _get_record_index(vcf_file, True)
+    assert (offsets >= 0).all()
+    assert ordinals.tolist() == [0, 0, 1, 2, 0, 1, 0, 0, 0, 1, 0]
+    idx_list = [2, 5, 9]
+    assert [str(variant_record) for variant_record in extract_variants(vcf_file, idx_list)] == \
+        [all_variants[i] for i in idx_list]
+
+
+@pytest.mark.parametrize('keep_raw_records', [False, True])
+def test_read_vcfs_regions_keeps_the_numbering_with_the_dataframe(tmp_path, keep_raw_records):
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', '.', 'PASS', '.'),
+        ('1', 200, 'snv2', 'A', 'G', '.', 'PASS', '.'),
+        ('2', 100, 'snv3', 'C', 'T', '.', 'PASS', '.'),
+        ('2', 5000, 'snv4', 'G', 'A', '.', 'PASS', '.'),
+        ('3', 100, 'snv5', 'T', 'C', '.', 'PASS', '.'),
+    ])
+    vcf_file = pysam.tabix_index(vcf_file, preset='vcf', force=True)
+    bed_file = tmp_path / 'regions.bed'
+    bed_file.write_text('1\t150\t250\n2\t4000\t6000\n')
+    regions_df = read_vcfs([vcf_file], keep_raw_records=keep_raw_records, regions=BedMask([str(bed_file)]))
+    # Later reads of the same file (here, or in another process) do not change what the variants refer to
+    full_df = read_vcfs([vcf_file], keep_raw_records=keep_raw_records)
+    regions_df = pickle.loads(pickle.dumps(regions_df))
+    assert regions_df['idx_in_file'].tolist() == [0, 1]
+    output_vcf = str(tmp_path / 'output.vcf')
+    write_vcf(regions_df.iloc[::-1], output_vcf)
+    with pysam.VariantFile(output_vcf) as f:
+        assert [record.id for record in f] == ['snv2', 'snv4']
+    with pytest.raises(ValueError, match='read with and without regions'):
+        concat_variants([regions_df, full_df])
+
+
+@pytest.mark.parametrize('remove_chr', [False, True])
+def test_write_vcfs_raw_records_match_parsed_records(tmp_path, monkeypatch, remove_chr):
+    header = '##fileformat=VCFv4.2\n' \
+        '##contig=<ID=chr1,length=1000000>\n' \
+        '##contig=<ID=chr2,length=1000000>\n' \
+        '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">\n' \
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n' \
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n' \
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tTUMOR\n'
+    depth_vcf = str(tmp_path / 'depth.vcf')
+    with open(depth_vcf, 'w') as f:
+        f.write(header)
+        f.write('chr1\t100\tsnv1\tA\tC\t30\tPASS\t.\tGT:DP\t0/0:20\t0|1:15\n')
+        f.write('chr1\t200\tmulti1\tA\tC,G\t.\tPASS\t.\tGT:DP\t0/0:10\t1/2:12\n')
+        f.write('chr1\t300\tbnd1\tN\tN[chr2:500[\t.\tPASS\tSVTYPE=BND\tGT:DP\t0/0:8\t0/1:9\n')
+        f.write('chr2\t500\tbnd2\tN\t]chr1:300]N\t.\tPASS\tSVTYPE=BND\tGT:DP\t0/0:8\t0/1:9\n')
+    gt_vcf = str(tmp_path / 'gt.vcf')
+    with open(gt_vcf, 'w') as f:
+        f.write(header.replace('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n', ''))
+        f.write('chr2\t100\tdel1\tACGT\tA\t.\tPASS\t.\tGT\t0/0\t0/1\n')
+    variants_df = read_vcfs([depth_vcf, gt_vcf], keep_raw_records=True)
+    variants_df['GENES'] = [['TP53'], [], ['KRAS', 'BRCA1'], [], []]
+
+    def outputs(prefix):
+        # Outputs with the same formats, with different formats and with records in several outputs
+        return {str(tmp_path / f'{prefix}_depth.vcf'): variants_df[variants_df['vcf_file'] == depth_vcf],
+                str(tmp_path / f'{prefix}_all.vcf'): variants_df.iloc[::-1]}
+    # Without raw records, the records are parsed again
+    with monkeypatch.context() as m:
+        m.setattr(i_o, '_RAW_RECORDS', OrderedDict())
+        write_vcfs(outputs('parsed'), remove_chr=remove_chr)
+    with monkeypatch.context() as m:
+        m.setattr(i_o, 'extract_variants', None)
+        write_vcfs(outputs('raw'), remove_chr=remove_chr)
+    for output in ('depth', 'all'):
+        with open(tmp_path / f'parsed_{output}.vcf') as parsed_f, open(tmp_path / f'raw_{output}.vcf') as raw_f:
+            assert raw_f.read() == parsed_f.read()
+
+
+@pytest.mark.parametrize('index', [None, 'tbi', 'csi'])
+def test_write_vcfs_threaded_compression_matches_single_thread(tmp_path, monkeypatch, index):
+    # Small blocks, so that the records span many blocks compressed by different threads
+    monkeypatch.setattr(i_o, '_BGZF_BLOCK_SIZE', 256)
+    records = [(str(chrom), pos * 10, f'snv{chrom}_{pos}', 'A', 'C', '.', 'PASS', '.') for chrom in (1, 2, 3) for pos in range(1, 200)]
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', records)
+    variants_df = read_vcfs([vcf_file])
+    # Unsorted, as written by the assessment
+    variants_df = variants_df.sample(frac=1, random_state=1)
+    single_vcf = str(tmp_path / 'single.vcf.gz')
+    threaded_vcf = str(tmp_path / 'threaded.vcf.gz')
+    write_vcf(variants_df, single_vcf, index=index)
+    write_vcf(variants_df, threaded_vcf, threads=4, index=index)
+    with open(single_vcf, 'rb') as single_f, open(threaded_vcf, 'rb') as threaded_f:
+        assert threaded_f.read() == single_f.read()
+    with pysam.VariantFile(threaded_vcf) as f:
+        if index is None:
+            assert sorted(record.id for record in f) == sorted(record[2] for record in records)
+        else:
+            assert os.path.exists(threaded_vcf + '.' + index)
+            assert [record.id for record in f] == [record[2] for record in records]
+            assert [record.id for record in f.fetch('2', 100, 300)] == [f'snv2_{pos}' for pos in range(11, 31)]
+
+
+@pytest.mark.parametrize('variant_filter', [None, VariantFilter(['1', '2'], ['SNV', 'INDEL-DEL', 'SV-TRA'], 50)])
+def test_read_vcfs_parallel_read_matches_serial_read(tmp_path, monkeypatch, variant_filter):
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', 30, 'PASS', 'CSQ=C|missense_variant|MODERATE|TP53'),
+        ('1', 200, 'bnd1_a', 'N', 'N[2:500[', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd1_b'),
+        ('1', 300, 'multi1', 'A', 'C,G', 20, 'PASS', 'CSQ=G|stop_gained|HIGH|KRAS'),
+        ('1', 400, 'filtered1', 'A', 'C', '.', 'LowQual', '.'),
+        ('1', 500, 'bnd2_a', 'N', 'N[3:100[', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd2_b'),
+        ('2', 100, 'del1', 'ACGT', 'A', 40, 'PASS', 'CSQ=-|frameshift_variant|HIGH|BRCA1'),
+        ('2', 500, 'bnd1_b', 'N', ']1:200]N', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd1_a'),
+        ('2', 600, 'bnd3_a', 'N', 'N[3:900[', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd3_b'),
+        ('2', 700, 'ins1', 'A', 'ACGT', '.', 'PASS', '.'),
+        ('3', 100, 'bnd2_b', 'N', ']1:500]N', 10, 'PASS', 'SVTYPE=BND;MATEID=bnd2_a'),
+        ('3', 200, 'filtered2', 'G', 'T', '.', 'LowQual', '.'),
+    ])
+    vcf_file = pysam.tabix_index(vcf_file, preset='vcf', force=True)
+
+    def read(processes):
+        variants_df = read_vcfs([vcf_file], ensure_pairs=False, score_field='QUAL', keep_raw_records=True, processes=processes,
+                                variant_filter=variant_filter, gene_annotations=True)
+        raw_data, raw_ends = i_o._get_raw_records(vcf_file, True)
+        return variants_df, i_o._get_record_index(vcf_file, True), bytes(raw_data), raw_ends, combine_gene_annotations(variants_df)
+    serial_df, serial_index, serial_raw_data, serial_raw_ends, serial_genes = read(1)
+    # What the parallel read stores must not come from the serial read
+    monkeypatch.setattr(i_o, '_RECORD_INDEXES', OrderedDict())
+    monkeypatch.setattr(i_o, '_RAW_RECORDS', OrderedDict())
+    monkeypatch.setattr(gene_annotations, '_GENE_ANNOTATIONS', {})
+    parallel_df, parallel_index, parallel_raw_data, parallel_raw_ends, parallel_genes = read(2)
+    pd.testing.assert_frame_equal(parallel_df, serial_df)
+    assert parallel_df.attrs == serial_df.attrs
+    for serial_array, parallel_array in zip(serial_index, parallel_index):
+        assert parallel_array.tolist() == serial_array.tolist()
+    assert parallel_raw_data == serial_raw_data
+    assert parallel_raw_ends.tolist() == serial_raw_ends.tolist()
+    pd.testing.assert_series_equal(parallel_genes, serial_genes)
+    assert any(len(genes) > 0 for genes in parallel_genes)
+    # A few variants are seeked with the index stored by the parallel read (reading the whole file fails, as bnd3_a is unpaired)
+    all_variants = [str(variant_record) for variant_record in VariantExtractor(vcf_file, pass_only=True, ensure_pairs=False)]
+    idx_list = parallel_df.loc[parallel_df['type_inferred'] != 'TRA', 'idx_in_file'].tolist()[-3:]
+    assert [str(variant_record) for variant_record in extract_variants(vcf_file, idx_list)] == [all_variants[i] for i in idx_list]
+
+
+@pytest.mark.parametrize('keep_raw_records', [False, True])
+def test_read_vcfs_variant_filter_matches_masking_the_full_read(tmp_path, keep_raw_records):
+    vcf_file = _write_vcf(tmp_path / 'input.vcf', [
+        ('1', 100, 'snv1', 'A', 'C', '.', 'PASS', '.'),
+        ('1', 200, 'multi1', 'A', 'C,GTTT', '.', 'PASS', '.'),
+        ('1', 300, 'filtered1', 'A', 'C', '.', 'LowQual', '.'),
+        ('1', 400, 'bnd1_a', 'N', 'N[2:500[', '.', 'PASS', 'SVTYPE=BND;MATEID=bnd1_b'),
+        ('1', 500, 'bnd2_a', 'N', 'N[3:500[', '.', 'PASS', 'SVTYPE=BND;MATEID=bnd2_b'),
+        ('2', 100, 'del1', 'ACGT', 'A', '.', 'PASS', '.'),
+        ('2', 500, 'bnd1_b', 'N', ']1:400]N', '.', 'PASS', 'SVTYPE=BND;MATEID=bnd1_a'),
+        ('3', 100, 'snv2', 'G', 'T', '.', 'PASS', '.'),
+        ('3', 500, 'bnd2_b', 'N', ']1:500]N', '.', 'PASS', 'SVTYPE=BND;MATEID=bnd2_a'),
+    ])
+    variant_filter = VariantFilter(['1', '2'], ['SNV', 'INDEL-DEL', 'SV-TRA'], 50)
+    filtered_df = read_vcfs([vcf_file], keep_raw_records=keep_raw_records, variant_filter=variant_filter)
+    write_vcf(filtered_df, str(tmp_path / 'filtered.vcf'))
+    full_df = read_vcfs([vcf_file], keep_raw_records=keep_raw_records)
+    expected_df = full_df[variant_filter.mask(full_df)].reset_index(drop=True)
+    write_vcf(expected_df, str(tmp_path / 'expected.vcf'))
+    # The categories of the filtered read only have the values of the variants it selected
+    pd.testing.assert_frame_equal(filtered_df.astype(str), expected_df.astype(str))
+    assert filtered_df[['start_chrom', 'start', 'type_inferred']].astype(str).values.tolist() == \
+        [['1', '100', 'SNV'], ['1', '200', 'SNV'], ['2', '100', 'DEL'], ['1', '400', 'TRA']]
+    assert filtered_df.attrs['skipped_variants'] == len(full_df) - len(expected_df)
+    with open(tmp_path / 'filtered.vcf') as filtered_f, open(tmp_path / 'expected.vcf') as expected_f:
+        assert filtered_f.read() == expected_f.read()
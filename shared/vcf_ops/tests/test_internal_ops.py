@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vcf_ops._internal.internal_ops import _matching_window_entries, _matching_window_duplicate_entries, intersect_window, \
+    window_index, window_candidates  # noqa
+
+_INS_FIELDS = (['start_chrom'], ['start', 'length'])
+_SV_FIELDS = (['start_chrom', 'end_chrom'], ['start', 'end'])
+
+
+# Reference implementation: the row by row matching that _matching_window_entries and _matching_window_duplicate_entries
+# replaced, with the pairs sorted by window_fields_sum_diff with a stable sort, so that ties keep the order of a merge
+# on the matching fields (truth order first, then test order)
+def _reference_entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius):
+    necessary_cols = matching_fields + window_fields
+    cross_merge = pd.merge(df_truth[necessary_cols].reset_index(), df_test[necessary_cols].reset_index(),
+                           suffixes=('_truth', '_test'), how='inner', on=matching_fields)
+    for window_field in window_fields:
+        diff = (cross_merge[window_field + '_truth'].astype(int) - cross_merge[window_field + '_test'].astype(int)).abs()
+        cross_merge = cross_merge[diff <= window_radius]
+    cross_merge = cross_merge.drop(matching_fields, axis=1)
+    cross_merge['window_fields_sum_diff'] = (cross_merge[[w + '_test' for w in window_fields]].sum(axis=1) -
+                                             cross_merge[[w + '_truth' for w in window_fields]].sum(axis=1)).abs()
+    return cross_merge
+
+
+def _reference_matching_window_entries(df_truth, df_test, matching_fields, window_fields, window_radius):
+    cross_merge = _reference_entries_in_window(df_truth, df_test, matching_fields, window_fields, window_radius)
+    cross_merge = cross_merge.sort_values(by='window_fields_sum_diff', kind='stable')
+    entries_to_keep = pd.Series(False, index=cross_merge.index)
+    curr_cross_merge = cross_merge
+    while True:
+        duplicated_truth_mask = curr_cross_merge.duplicated(subset=['index_truth'], keep=False)
+        unique_truth_df = curr_cross_merge[~duplicated_truth_mask]
+        duplicated_truth_df = curr_cross_merge[duplicated_truth_mask]
+        new_duplicated_truth_df = duplicated_truth_df[~duplicated_truth_df['index_test'].isin(unique_truth_df['index_test'])]
+        entries_to_keep.loc[unique_truth_df.index.union(new_duplicated_truth_df.index)] = True
+        curr_cross_merge = curr_cross_merge.loc[unique_truth_df.index.union(new_duplicated_truth_df.index)]
+        if len(new_duplicated_truth_df) == len(duplicated_truth_df):
+            break
+    cross_merge = cross_merge[entries_to_keep]
+    selected_entries = pd.Series(False, index=cross_merge.index)
+    possible_duplications = dict()
+    already_selected_test_entries = set()
+    already_selected_truth_entries = set()
+    for idx, row in cross_merge.iterrows():
+        if row['index_test'] in already_selected_test_entries:
+            continue
+        if row['index_truth'] in already_selected_truth_entries:
+            possible_duplications.setdefault(row['index_test'], []).append(idx)
+            continue
+        already_selected_test_entries.add(row['index_test'])
+        already_selected_truth_entries.add(row['index_truth'])
+        selected_entries.loc[idx] = True
+    duplicated_entries = pd.Series(False, index=cross_merge.index)
+    for index_test, duplicated_idxs in possible_duplications.items():
+        if index_test in already_selected_test_entries:
+            continue
+        duplicated_entries.loc[duplicated_idxs[0]] = True
+    selected_cross_merge = cross_merge[selected_entries]
+    duplicated_cross_merge = cross_merge[duplicated_entries]
+    df_tp_test = df_test.loc[selected_cross_merge['index_test']]
+    df_tp_dup_test = df_test.loc[duplicated_cross_merge['index_test']]
+    df_tp_truth = df_truth.loc[selected_cross_merge['index_truth'].unique()]
+    df_tp_test['idx_truth'] = df_truth.loc[selected_cross_merge['index_truth']].index
+    return df_tp_test, df_tp_dup_test, df_tp_truth
+
+
+def _reference_matching_window_duplicate_entries(df, matching_fields, window_fields, window_radius):
+    cross_merge = _reference_entries_in_window(df, df, matching_fields, window_fields, window_radius)
+    cross_merge = cross_merge[cross_merge['index_truth'] != cross_merge['index_test']]
+    grouped = cross_merge.groupby('index_truth', sort=False).agg({'index_test': 'count', 'window_fields_sum_diff': 'sum'})
+    grouped.rename(columns={'index_test': 'mate_count'}, inplace=True)
+    grouped.sort_values(by=['mate_count', 'window_fields_sum_diff'], ascending=[False, True], kind='stable', inplace=True)
+    duplicated_entries = set()
+    while len(grouped) > 0:
+        mates_to_remove = cross_merge.loc[cross_merge['index_truth'] == grouped.index[0], 'index_test']
+        grouped.drop(index=grouped.index[0], inplace=True)
+        grouped.drop(index=mates_to_remove, inplace=True, errors='ignore')
+        duplicated_entries.update(mates_to_remove.values)
+    duplicated_entries = df.loc[list(duplicated_entries)]
+    original_entries = df.loc[df.index.difference(duplicated_entries.index)]
+    return original_entries, duplicated_entries
+
+
+def _reference_intersect_window(df_truth, df_test, matching_fields, window_fields, window_radius):
+    df_tp, df_tp_dup_test, df_all_truth_tp = _reference_matching_window_entries(
+        df_truth, df_test, matching_fields, window_fields, window_radius)
+    df_all_test_tp = df_test.loc[df_tp.index.union(df_tp_dup_test.index)]
+    df_all_fp = df_test.loc[~df_test.index.isin(df_all_test_tp.index)]
+    df_fp, df_fp_dup = _reference_matching_window_duplicate_entries(df_all_fp, matching_fields, window_fields, window_radius)
+    df_all_fn = df_truth.drop(df_all_truth_tp.index)
+    df_1, df_2, df_tp_dup_truth = _reference_matching_window_entries(
+        df_all_truth_tp, df_all_fn, matching_fields, window_fields, window_radius)
+    df_tp_dup = pd.concat([df_tp_dup_test, df_tp_dup_truth], ignore_index=True)
+    df_all_fn = df_all_fn.drop(df_1.index.union(df_2.index))
+    df_fn, df_fn_dup = _reference_matching_window_duplicate_entries(df_all_fn, matching_fields, window_fields, window_radius)
+    return df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup
+
+
+def _random_variants(rng, size, window_fields, span, step, label_offset):
+    # Positions on a coarse grid of a short span, so that windows are dense and window_fields_sum_diff ties are frequent
+    # Index labels are shuffled and not a range, as in the filtered dataframes intersected by intersect
+    df = pd.DataFrame({'start_chrom': rng.choice(['1', '2'], size),
+                       'end_chrom': rng.choice(['1', '2'], size)})
+    for window_field in window_fields:
+        df[window_field] = rng.integers(0, span // step, size) * step + (1000 if window_field == 'end' else 0)
+    df.index = rng.permutation(size) * 3 + label_offset
+    return df
+
+
+def _assert_same_entries(result, expected, sort_rows):
+    assert len(result) == len(expected)
+    for result_df, expected_df in zip(result, expected):
+        if sort_rows:
+            # Duplicates of a cluster are a set
+            result_df, expected_df = result_df.sort_index(), expected_df.sort_index()
+        pd.testing.assert_frame_equal(result_df, expected_df, check_dtype=False, check_index_type=False)
+
+
+_CASES = [(fields, size, span, step, seed)
+          for fields in (_INS_FIELDS, _SV_FIELDS)
+          for size, span, step in ((30, 200, 10), (300, 500, 25), (2000, 2000, 50))
+          for seed in range(3)]
+
+
+@pytest.mark.parametrize('fields, size, span, step, seed', _CASES)
+def test_matching_window_entries_matches_reference(fields, size, span, step, seed):
+    rng = np.random.default_rng(seed)
+    matching_fields, window_fields = fields
+    df_truth = _random_variants(rng, size, window_fields, span, step, 0)
+    df_test = _random_variants(rng, size, window_fields, span, step, 1)
+    expected = _reference_matching_window_entries(df_truth, df_test, matching_fields, window_fields, 100)
+    result = _matching_window_entries(df_truth, df_test, matching_fields, window_fields, 100)
+    _assert_same_entries(result, expected, sort_rows=False)
+
+
+@pytest.mark.parametrize('fields, size, span, step, seed', _CASES)
+def test_matching_window_duplicate_entries_matches_reference(fields, size, span, step, seed):
+    rng = np.random.default_rng(seed)
+    matching_fields, window_fields = fields
+    df = _random_variants(rng, size, window_fields, span, step, 0)
+    expected = _reference_matching_window_duplicate_entries(df, matching_fields, window_fields, 100)
+    result = _matching_window_duplicate_entries(df, matching_fields, window_fields, 100)
+    _assert_same_entries(result, expected, sort_rows=True)
+
+
+@pytest.mark.parametrize('fields, size, span, step, seed', _CASES)
+def test_intersect_window_matches_reference(fields, size, span, step, seed):
+    rng = np.random.default_rng(seed)
+    matching_fields, window_fields = fields
+    df_truth = _random_variants(rng, size, window_fields, span, step, 0)
+    df_test = _random_variants(rng, size, window_fields, span, step, 1)
+    expected = _reference_intersect_window(df_truth, df_test, matching_fields, window_fields, 100)
+    # Same results with the window indexes built beforehand, candidates of a larger radius and chunked pair generation
+    truth_window_index = window_index(df_truth, matching_fields, window_fields)
+    test_window_index = window_index(df_test, matching_fields, window_fields)
+    candidates = window_candidates(df_truth, df_test, matching_fields, window_fields, 150)
+    for kwargs in ({}, {'truth_window_index': truth_window_index, 'test_window_index': test_window_index},
+                   {'candidates': candidates}, {'max_window_pairs': 7}):
+        result = intersect_window(df_truth, df_test, matching_fields, window_fields, 100, **kwargs)
+        _assert_same_entries(result, expected, sort_rows=True)
+
+
+def test_matching_window_entries_ties_keep_pair_order():
+    # Two identical test records at the same distance of a truth record: the first one is the TP, the second one its duplicate
+    df_truth = pd.DataFrame({'start_chrom': ['1'], 'start': [1000], 'length': [200]}, index=[5])
+    df_test = pd.DataFrame({'start_chrom': ['1', '1'], 'start': [1010, 1010], 'length': [200, 200]}, index=[8, 3])
+    df_tp, df_tp_dup, df_tp_truth = _matching_window_entries(df_truth, df_test, *_INS_FIELDS, 100)
+    assert df_tp.index.tolist() == [8]
+    assert df_tp['idx_truth'].tolist() == [5]
+    assert df_tp_dup.index.tolist() == [3]
+    assert df_tp_truth.index.tolist() == [5]
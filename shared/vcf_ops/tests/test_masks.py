@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from vcf_ops.masks import BedMask  # noqa
+
+
+def test_bed_mask_matches_chromosomes_with_or_without_chr(tmp_path):
+    chr_bed = tmp_path / 'chr.bed'
+    chr_bed.write_text('chr1\t100\t200\nchrX\t500\t600\n')
+    plain_bed = tmp_path / 'plain.bed'
+    plain_bed.write_text('1\t100\t200\nX\t500\t600\n')
+    # Chromosomes of the variants dataframes are named without chr
+    variants_df = pd.DataFrame({'start_chrom': ['1', '1', 'X', '2'], 'start': [150, 300, 550, 150],
+                                'end_chrom': ['1', '1', 'X', '2'], 'end': [151, 301, 551, 151]})
+    chr_mask = BedMask([str(chr_bed)], cache_dir=str(tmp_path / 'cache'))
+    plain_mask = BedMask([str(plain_bed)], cache_dir=str(tmp_path / 'cache'))
+    assert chr_mask.mask(variants_df).tolist() == [True, False, True, False]
+    pd.testing.assert_series_equal(chr_mask.mask(variants_df), plain_mask.mask(variants_df))
+    assert repr(chr_mask) == repr(plain_mask)
+
+
+def _baseline_skip_fp_variants(df, bed_masks):
+    # Row by row masking of each BED file, as skip_fp_variants did before the interval index
+    for bed_mask in bed_masks:
+        bed_df = pd.read_csv(bed_mask, sep='\t', header=None)
+        bed_df[0] = bed_df[0].astype(str)
+        for _, row in bed_df.iterrows():
+            start_mask = (df['start_chrom'] == row[0]) & (df['start'] >= row[1]) & (df['start'] <= row[2])
+            end_mask = (df['end_chrom'] == row[0]) & (df['end'] >= row[1]) & (df['end'] <= row[2])
+            df = df[~(start_mask | end_mask)]
+    return df
+
+
+def test_bed_mask_matches_the_row_by_row_mask(tmp_path):
+    rng = np.random.default_rng(1)
+    chroms = np.array(['1', '2', 'X'])
+    n_variants = 2000
+    start_chroms = rng.choice(chroms, n_variants)
+    starts = rng.integers(1, 10000, n_variants)
+    # Some variants end in another chromosome
+    end_chroms = np.where(rng.random(n_variants) < 0.2, rng.choice(chroms, n_variants), start_chroms)
+    ends = np.where(end_chroms == start_chroms, starts + rng.integers(0, 500, n_variants), rng.integers(1, 10000, n_variants))
+    variants_df = pd.DataFrame({'start_chrom': pd.Categorical(start_chroms), 'start': starts,
+                                'end_chrom': pd.Categorical(end_chroms), 'end': ends}, index=rng.permutation(n_variants))
+    bed_paths = []
+    for i in range(3):
+        # Unsorted, overlapping, nested and adjacent regions, with extra columns, and in chromosomes without variants
+        bed_starts = rng.integers(0, 10000, 40)
+        bed_df = pd.DataFrame({0: rng.choice(['1', '2', 'X', '5'], 40), 1: bed_starts, 2: bed_starts + rng.integers(0, 300, 40),
+                               3: 'name'})
+        bed_df = pd.concat([bed_df, pd.DataFrame({0: ['1', '1', '1'], 1: [500, 550, 601], 2: [600, 560, 700], 3: 'name'})])
+        bed_paths.append(str(tmp_path / f'regions{i}.bed'))
+        bed_df.to_csv(bed_paths[-1], sep='\t', header=False, index=False)
+    for bed_paths_subset in (bed_paths[:1], bed_paths):
+        mask = BedMask(bed_paths_subset).mask(variants_df)
+        pd.testing.assert_index_equal(mask.index, variants_df.index)
+        expected_df = _baseline_skip_fp_variants(variants_df, bed_paths_subset)
+        pd.testing.assert_frame_equal(variants_df[~mask], expected_df)
+        assert 0 < mask.sum() < n_variants
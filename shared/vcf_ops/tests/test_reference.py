@@ -0,0 +1,61 @@
+import random
+import pysam
+import pytest
+
+from vcf_ops import reference  # noqa
+from vcf_ops.reference import PackedReference, prepare_reference, open_reference  # noqa
+
+
+def _write_fasta(path, sequences):
+    with open(path, 'w') as f:
+        for contig, sequence in sequences.items():
+            f.write(f'>{contig}\n')
+            f.write('\n'.join(sequence[i:i + 60] for i in range(0, len(sequence), 60)) + '\n')
+    pysam.faidx(str(path))
+    return str(path)
+
+
+def test_packed_reference_fetch_matches_fasta_fetch(tmp_path, monkeypatch):
+    # Lowercase bases too, as in soft-masked references
+    rng = random.Random(1)
+    sequences = {'chr1': ''.join(rng.choice('ACGTNacgtn') for _ in range(1000)), 'chr2': ''.join(rng.choice('ACGT') for _ in range(7)),
+                 'chrM': ''.join(rng.choice('acgt') for _ in range(130))}
+    fasta_ref = _write_fasta(tmp_path / 'ref.fa', sequences)
+    # Contigs written in several chunks
+    monkeypatch.setattr(reference, 'REFERENCE_FETCH_SIZE', 64)
+    assert prepare_reference(fasta_ref)
+    packed = open_reference(fasta_ref)
+    assert isinstance(packed, PackedReference)
+    fasta = pysam.FastaFile(fasta_ref)
+    assert packed.references == tuple(fasta.references)
+    assert packed.lengths == tuple(fasta.lengths)
+    for contig, length in zip(fasta.references, fasta.lengths):
+        assert packed.get_reference_length(contig) == length
+        ranges = [(None, None), (0, None), (None, 5), (0, length), (length - 1, length), (length, length + 10),
+                  (length + 5, length + 10), (3, 3), (0, length + 100)]
+        ranges += [tuple(sorted(rng.randrange(length + 20) for _ in range(2))) for _ in range(50)]
+        for start, end in ranges:
+            assert packed.fetch(contig, start, end) == fasta.fetch(contig, start, end), (contig, start, end)
+            assert packed.bases(contig, start, end).tobytes().decode() == fasta.fetch(contig, start, end)
+        for start, end in [(-1, 5), (5, 2)]:
+            with pytest.raises(ValueError):
+                fasta.fetch(contig, start, end)
+            with pytest.raises(ValueError):
+                packed.fetch(contig, start, end)
+
+
+def test_prepare_reference_rewrites_outdated_packed_references(tmp_path, monkeypatch):
+    fasta_ref = _write_fasta(tmp_path / 'ref.fa', {'1': 'ACGTACGTAC'})
+    assert prepare_reference(fasta_ref)
+    assert open_reference(fasta_ref).fetch('1', 2, 6) == 'GTAC'
+    # The FASTA file changes (new size), so its packed reference is outdated
+    fasta_ref = _write_fasta(tmp_path / 'ref.fa', {'1': 'TTTTGGGG', '2': 'CC'})
+    assert not isinstance(open_reference(fasta_ref), PackedReference)
+    assert open_reference(fasta_ref).fetch('1', 2, 6) == 'TTGG'
+    assert prepare_reference(fasta_ref)
+    # References already opened by the process are kept
+    monkeypatch.setattr(reference, '_REFERENCES', {})
+    packed = open_reference(fasta_ref)
+    assert isinstance(packed, PackedReference)
+    assert packed.fetch('1', 2, 6) == 'TTGG'
+    assert packed.fetch('2') == 'CC'
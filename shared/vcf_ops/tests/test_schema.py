@@ -0,0 +1,19 @@
+import pandas as pd
+
+from variant_extractor import VariantExtractor
+from vcf_ops.schema import extractor_variants  # noqa
+
+
+def test_extractor_variants_matches_variant_extractor(tmp_path):
+    # Guards the copy of the VariantExtractor.to_dataframe types against upstream changes
+    vcf_file = tmp_path / 'input.vcf'
+    vcf_file.write_text('##fileformat=VCFv4.2\n##contig=<ID=1,length=1000000>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+                        '1\t100\tsnv\tA\tC\t.\tPASS\t.\n'
+                        '1\t70000\tdel\tACGT\tA\t.\tPASS\t.\n')
+    expected_df = VariantExtractor(str(vcf_file)).to_dataframe()
+    # Types lost in a concatenation of parts
+    variants_df = expected_df.astype({column: object for column in expected_df.columns})
+    variants_df = variants_df.astype({'start': 'int64', 'end': 'int64', 'length': 'int64'})
+    pd.testing.assert_frame_equal(extractor_variants(variants_df), expected_df)
+    empty_df = VariantExtractor.empty_dataframe()
+    pd.testing.assert_frame_equal(extractor_variants(empty_df.astype(object)), empty_df, check_index_type=False)
@@ -17,6 +17,7 @@ from vcf_ops.metrics import filter_metrics_recommendations  # noqa
 from vcf_ops.intersect import intersect  # noqa
 from vcf_ops.union import union  # noqa
 from vcf_ops.i_o import read_vcfs, write_masked_vcfs  # noqa
+from vcf_ops.reference import prepare_reference  # noqa
 from vcf_ops.constants import UNION_SYMBOL, INTERSECTION_SYMBOL  # noqa
 from combinator import generate_combinations, split_operation  # noqa
 
@@ -336,6 +337,9 @@ def main(args):
     # Create output folder for combinations
     output_combinations = os.path.join(args.output, 'combinations')
     os.makedirs(output_combinations, exist_ok=True)
+    # Prepare the packed references before the evaluations, which share them
+    for fasta_ref in config['reference_fasta_path'].unique():
+        prepare_reference(fasta_ref)
     # Evaluate the callers
     print('Evaluating callers...')
     original_caller_folders = [os.path.join(args.variant_callers, caller_name) for caller_name in callers_names]
@@ -4,7 +4,7 @@ import sys
 
 # Add vcf-ops to the path
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..', '..', 'shared', 'vcf_ops', 'src'))
-from vcf_ops.i_o import read_vcfs, write_masked_vcfs  # noqa
+from vcf_ops.i_o import read_vcfs, write_labelled_vcfs  # noqa
 from vcf_ops.genes import combine_gene_annotations  # noqa
 from vcf_ops.constants import DEFAULT_INDEL_THRESHOLD, DEFAULT_WINDOW_RADIUS  # noqa
 from vcf_ops.intersect import intersect  # noqa
@@ -18,36 +18,31 @@ if __name__ == '__main__':
                         help=f'Indel threshold, inclusive (default={DEFAULT_INDEL_THRESHOLD})', default=DEFAULT_INDEL_THRESHOLD, type=int)
     parser.add_argument('-wr', '--window-radius',
                         help=f'Window radius (default={DEFAULT_WINDOW_RADIUS})', default=DEFAULT_WINDOW_RADIUS, type=float)
+    parser.add_argument('-p', '--processes', help='Number of processes to use, sharding by chromosome and reading indexed VCF files by contig (default=1)',
+                        default=1, type=int)
     parser.add_argument('--combine-genes-annotations', action='store_true',
                         help='Combine genes and annotations from the input VCF files')
     args = parser.parse_args()
 
     # Read the input files
-    df_truth = read_vcfs(args.files_1)
-    df_test = read_vcfs(args.files_2)
+    df_truth = read_vcfs(args.files_1, processes=args.processes, gene_annotations=args.combine_genes_annotations)
+    df_test = read_vcfs(args.files_2, processes=args.processes, gene_annotations=args.combine_genes_annotations)
 
     # Intersect
-    df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup = intersect(df_truth, df_test, args.indel_threshold, args.window_radius)
+    df_tp, df_tp_dup, df_fp, df_fp_dup, df_fn, df_fn_dup = intersect(df_truth, df_test, args.indel_threshold, args.window_radius,
+                                                                     processes=args.processes)
     # Combine genes annotations
     if args.combine_genes_annotations:
         df_tp['GENES'] = combine_gene_annotations(df_tp, df_truth)
 
-    # Write VCF files
-    if len(df_tp) > 0:
-        write_masked_vcfs(df_tp, args.output + 'intersect_in.', args.indel_threshold)
-        print(f'True positives can be found in {args.output}intersect_in.*')
-    if len(df_tp_dup) > 0:
-        write_masked_vcfs(df_tp_dup, args.output + 'intersect_in_dup.', args.indel_threshold)
-        print(f'True positives with duplicates can be found in {args.output}intersect_in_dup.*')
-    if len(df_fp) > 0:
-        write_masked_vcfs(df_fp, args.output + 'intersect_outside_2.', args.indel_threshold)
-        print(f'False positives can be found in {args.output}intersect_outside_2.*')
-    if len(df_fp_dup) > 0:
-        write_masked_vcfs(df_fp_dup, args.output + 'intersect_outside_2_dup.',args.indel_threshold)
-        print(f'False positives with duplicates can be found in {args.output}intersect_outside_2_dup.*')
-    if len(df_fn) > 0:
-        write_masked_vcfs(df_fn, args.output + 'intersect_outside_1.', args.indel_threshold)
-        print(f'False negatives can be found in {args.output}intersect_out_1.*')
-    if len(df_fn_dup) > 0:
-        write_masked_vcfs(df_fn_dup, args.output + 'intersect_outside_1_dup.', args.indel_threshold)
-        print(f'False negatives with duplicates can be found in {args.output}intersect_outside_1_dup.*')
+    # Write VCF files (all at once, so that each input VCF is read once)
+    outputs = [(df_tp, 'intersect_in', 'True positives'),
+               (df_tp_dup, 'intersect_in_dup', 'True positives with duplicates'),
+               (df_fp, 'intersect_outside_2', 'False positives'),
+               (df_fp_dup, 'intersect_outside_2_dup', 'False positives with duplicates'),
+               (df_fn, 'intersect_outside_1', 'False negatives'),
+               (df_fn_dup, 'intersect_outside_1_dup', 'False negatives with duplicates')]
+    write_labelled_vcfs({f'{args.output}{label}.': df for df, label, _ in outputs if len(df) > 0}, args.indel_threshold)
+    for df, label, description in outputs:
+        if len(df) > 0:
+            print(f'{description} can be found in {args.output}{label}.*')
@@ -17,14 +17,16 @@ if __name__ == '__main__':
                         help=f'Indel threshold, inclusive (default={DEFAULT_INDEL_THRESHOLD})', default=DEFAULT_INDEL_THRESHOLD, type=int)
     parser.add_argument('-wr', '--window-radius',
                         help=f'Window radius (default={DEFAULT_WINDOW_RADIUS})', default=DEFAULT_WINDOW_RADIUS, type=float)
+    parser.add_argument('-p', '--processes', help='Number of processes to use, sharding by chromosome and reading indexed VCF files by contig (default=1)',
+                        default=1, type=int)
     args = parser.parse_args()
 
     # Read the input files
-    df_truth = read_vcfs(args.files_1)
-    df_test = read_vcfs(args.files_2)
+    df_truth = read_vcfs(args.files_1, processes=args.processes)
+    df_test = read_vcfs(args.files_2, processes=args.processes)
 
     # Union
-    df_union, df_union_dup = union(df_truth, df_test, args.indel_threshold, args.window_radius)
+    df_union, df_union_dup = union(df_truth, df_test, args.indel_threshold, args.window_radius, args.processes)
 
     # Write VCF files
     if len(df_union) > 0: